@@ -0,0 +1,64 @@
+"""
+addresses.py
+
+Aggregazione di liste di indirizzi/CIDR per i set `flags interval` di nftables.
+
+- aggregate(): separa IPv4/IPv6, converte ogni CIDR in un intervallo di interi,
+  ordina e fonde gli intervalli sovrapposti o adiacenti (O(n log n)).
+  Il risultato è il più piccolo insieme equivalente di intervalli.
+- format_interval(): rende un intervallo come prefisso (`10.0.0.0/8`) quando è un CIDR
+  esatto, altrimenti come range (`10.0.0.5-10.0.0.9`), entrambi accettati dai set interval.
+"""
+
+import ipaddress
+import sys
+from typing import Dict, Iterable, List, Tuple
+
+Interval = Tuple[int, int]
+
+
+def _merge(intervals: List[Interval]) -> List[Interval]:
+    if not intervals:
+        return []
+    intervals.sort()
+    merged = [intervals[0]]
+    for start, end in intervals[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            if end > last_end:
+                merged[-1] = (last_start, end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def aggregate(entries: Iterable[str]) -> Dict[int, List[Interval]]:
+    """
+    Ritorna {4: [(start, end), ...], 6: [...]} con gli intervalli fusi e ordinati.
+    Le voci non valide vengono segnalate e saltate; gli host bit sono ignorati (strict=False).
+    """
+    by_version = {4: [], 6: []}
+    for raw in entries:
+        text = str(raw).strip()
+        if not text or text.startswith("#"):
+            continue
+        try:
+            net = ipaddress.ip_network(text, strict=False)
+        except ValueError:
+            print(f"WARN: salto indirizzo non valido: {text}", file=sys.stderr)
+            continue
+        by_version[net.version].append((int(net.network_address), int(net.broadcast_address)))
+    return {v: _merge(iv) for v, iv in by_version.items()}
+
+
+def format_interval(start: int, end: int, version: int) -> str:
+    addr_cls = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    size = end - start + 1
+    if size & (size - 1) == 0 and start % size == 0:
+        bits = 32 if version == 4 else 128
+        prefix = bits - (size.bit_length() - 1)
+        if prefix == bits:
+            return str(addr_cls(start))
+        return f"{addr_cls(start)}/{prefix}"
+    return f"{addr_cls(start)}-{addr_cls(end)}"
+
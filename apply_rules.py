@@ -1,44 +1,78 @@
 """
 Logica per sincronizzare i servizi con i set nft.
-- add_service_element: aggiunge elemento al set se mancante
-- apply_rule: high-level, chiama ensure_table_chains_sets e add_service_element
+- add_service_element: aggiunge elemento al set (o alla verdict map) se mancante
+- apply_rule: high-level, chiama ensure_table_chains_sets (opzionale) e add_service_element
 """
 import subprocess
-from nft_utils import ensure_table_chains_sets
+import nft_exec
+from nft_utils import load_live_object, ensure_table_chains_sets, set_supports_timeout
+from ruleset import Table
 from telegram_utils import notify_markdown
-from typing import Dict
+from typing import Dict, Optional
 
-def element_in_set(set_name: str, port: int) -> bool:
-    try:
-        out = subprocess.run(["nft", "list", "set", "inet", "filter", set_name], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-        return str(port) in out.stdout
-    except subprocess.CalledProcessError:
-        return False
+def element_in_set(set_name: str, element, kind: str = "set", live: Optional[Table] = None) -> bool:
+    """
+    True se l'elemento (porta o chiave concatenata "tcp . 22") compare nel set/map.
+    Il confronto è sulla chiave normalizzata degli elementi JSON: la porta 22 non corrisponde a 2283.
+    Con `live` (stato letto una volta da ensure_table_chains_sets) non viene interrogato nft.
+    """
+    live = live or load_live_object(kind, set_name)
+    return live.has_element(set_name, element)
+
+def service_target(proto: str, set_mode: str = "split"):
+    """Ritorna (kind, nome) del set/map che contiene i servizi per il protocollo dato."""
+    if set_mode == "concat":
+        return "set", "services"
+    if set_mode == "vmap":
+        return "map", "service_verdicts"
+    return "set", "tcp_services" if proto == "tcp" else "udp_services"
 
-def add_service_element(proto: str, port: int) -> bool:
-    set_name = "tcp_services" if proto == "tcp" else "udp_services"
-    if element_in_set(set_name, port):
+def add_service_element(proto: str, port: int, timeout: int = None, set_mode: str = "split",
+                        action: str = "accept", live: Optional[Table] = None) -> bool:
+    """
+    Aggiunge la porta al set. Con timeout (secondi) l'elemento scade nel kernel;
+    se è già presente non viene toccato, così il timeout residuo non riparte.
+    Con set_mode "concat"/"vmap" l'elemento è la chiave `proto . porta`
+    (nella verdict map seguita da `: action`).
+    """
+    kind, set_name = service_target(proto, set_mode)
+    key = str(port) if set_mode == "split" else f"{proto} . {port}"
+    if element_in_set(set_name, key, kind=kind, live=live):
         return False
-    subprocess.run(["nft", "add", "element", "inet", "filter", set_name, "{", str(port), "}"], check=True)
+    element = key
+    if timeout:
+        if not set_supports_timeout(set_name, kind=kind, live=live):
+            raise RuntimeError(f"il {kind} {set_name} non ha il flag timeout: ricrealo (--flush) per gli accessi temporanei")
+        element += f" timeout {int(timeout)}s"
+    if kind == "map":
+        element += f" : {action}"
+    nft_exec.run(["add", "element", "inet", "filter", set_name, "{", element, "}"])
     return True
 
-def apply_rule(service: Dict, dry_run: bool = False):
+def apply_rule(service: Dict, dry_run: bool = False, ensure: bool = True, set_mode: str = "split",
+               live: Optional[Table] = None):
     port = service["port"]
     proto = service["protocol"]
     name = service["name"]
 
-    ensure_table_chains_sets()
-
+    # in dry-run non tocchiamo il kernel: nessuna creazione di table/chain/sets
     if dry_run:
         print(f"[DRY RUN] add element {port}/{proto} to set")
         return
 
+    if ensure:
+        live = ensure_table_chains_sets(set_mode=set_mode)
+
+    timeout = service.get("timeout")
+    action = service.get("action", "accept")
     try:
-        added = add_service_element(proto, port)
+        added = add_service_element(proto, port, timeout=timeout, set_mode=set_mode, action=action, live=live)
         if added:
-            notify_markdown(f"✅ Aggiunto {name} ({port}/{proto}) a @{'tcp_services' if proto=='tcp' else 'udp_services'}")
+            expiry = f" per {timeout}s" if timeout else ""
+            target = service_target(proto, set_mode)[1]
+            notify_markdown(f"✅ Aggiunto {name} ({port}/{proto}) a @{target}{expiry}")
         else:
             # non inviamo notifica per skip per evitare flood
             pass
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, RuntimeError) as e:
         notify_markdown(f"❌ Errore aggiunta elemento {name} ({port}/{proto}): {e}")
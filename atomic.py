@@ -0,0 +1,251 @@
+"""
+atomic.py
+
+Applicazione atomica di rules/firewall.rules con generazioni e rollback.
+
+apply --atomic:
+1. fotografa la table attuale (`nft list table inet filter`) in data/generations/;
+2. costruisce UN file di transazione:
+       add table inet filter
+       flush table inet filter          # rimuove tutte le regole
+       flush set/map inet filter <x>    # svuota i set gestiti (flush table non lo fa)
+       add table netdev fwai_ingress     # la table di ingress (se configurata) viene
+       delete table netdev fwai_ingress  # sempre ricreata: nessuna chain di device rimasti
+       <contenuto di rules/firewall.rules>
+       insert rule ... @blocklist_v4 drop   # se i set dei feed esistono
+3. lo valida con `nft -c -f` e solo allora lo applica con `nft -f`.
+Il kernel applica la transazione per intero o per niente: non esiste un momento
+in cui la table è vuota (nessuna finestra a firewall aperto).
+
+I set @blocklist_v4/@blocklist_v6 (feeds.py) non vengono mai svuotati né salvati nelle
+generazioni: il loro contenuto deve restare allineato allo snapshot in data/feeds/.
+
+build_replace_transaction(): la stessa sostituzione senza leggere lo stato live, per i ruleset
+applicati altrove (host di fleet.py, namespace di netns.py).
+
+rollback: riapplica l'ultima generazione con la stessa struttura (flush + contenuto),
+in una sola transazione, senza rigenerare nulla. Si conservano le ultime N generazioni.
+Se prima dell'apply la table non esisteva la generazione contiene solo ABSENT_MARK e il
+rollback elimina la table: un flush lascerebbe le chain con policy drop e nessuna regola.
+"""
+
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import nft_exec
+from feeds import FEED_SETS
+from nft_utils import APPLY_TIMEOUT, load_live_table
+from rules_generator import INGRESS_TABLE
+from ruleset import Rule, Table, strip_comment
+
+GENERATIONS_DIR = "data/generations"
+DEFAULT_KEEP = 5
+ABSENT_MARK = "# fwai: table inet filter assente"
+# generazione delle versioni precedenti per una table assente
+_LEGACY_EMPTY = "table inet filter {\n}"
+
+_FEED_SET_NAMES = {name for name, _, _ in FEED_SETS.values()}
+
+
+def _strip_feed_sets(listing: str) -> str:
+    """
+    Rimuove dal listato di `nft list table` i blocchi dei set dei feed (anche molto grandi)
+    e le loro regole di drop, che build_transaction reinserisce sempre in testa.
+    Dei set dinamici (meter dei limiti) si tiene la definizione ma non gli elementi:
+    sono stato del kernel (limit per sorgente) e ripartono vuoti.
+    """
+    feed_rules = {f"{fam} saddr @{name} drop" for name, _, fam in FEED_SETS.values()}
+    out = []
+    skipping = dynamic = in_elements = False
+    for line in listing.splitlines():
+        stripped = line.strip()
+        if skipping:
+            # il blocco termina con la graffa allo stesso livello di `set ... {`
+            if stripped == "}" and len(line) - len(line.lstrip()) == indent:
+                skipping = False
+            continue
+        if stripped.startswith("set ") and stripped.endswith("{") and stripped.split()[1] in _FEED_SET_NAMES:
+            skipping = True
+            indent = len(line) - len(line.lstrip())
+            continue
+        if stripped.startswith(("set ", "map ")) and stripped.endswith("{"):
+            dynamic = False
+        elif stripped.startswith("flags ") and "dynamic" in stripped:
+            dynamic = True
+        if dynamic and (in_elements or stripped.startswith("elements = ")):
+            # gli elementi possono occupare più righe: fino alla graffa che chiude `elements = {`
+            in_elements = not stripped.endswith("}")
+            continue
+        if strip_comment(stripped) in feed_rules:
+            continue
+        out.append(line)
+    return "\n".join(out) + "\n"
+
+
+def snapshot_table(family: str = "inet", table: str = "filter") -> Optional[str]:
+    """Listato della table senza i set dei feed; None se la table non esiste."""
+    try:
+        out = nft_exec.run(["list", "table", family, table])
+    except subprocess.CalledProcessError:
+        return None
+    return _strip_feed_sets(out.stdout or "")
+
+
+def build_transaction(content: str, family: str = "inet", table: str = "filter") -> str:
+    """
+    Transazione che sostituisce la table con `content` (formato `table inet filter { ... }`).
+    I flush dei set sono calcolati sullo stato live: `flush set` su un set inesistente fallirebbe.
+    """
+    live = load_live_table(family, table)
+    lines = [f"add table {family} {table}", f"flush table {family} {table}"]
+    for name, s in live.sets.items():
+        if name not in _FEED_SET_NAMES:
+            lines.append(f"flush {s.kind} {family} {table} {name}")
+    # `add` rende il delete valido anche se la table non esiste; se `content` la contiene viene ricreata
+    lines += [f"add table netdev {INGRESS_TABLE}", f"delete table netdev {INGRESS_TABLE}"]
+    body = "\n".join(l for l in content.splitlines() if not l.startswith("#!"))
+    lines.append(body)
+    # flush table ha rimosso anche le regole di drop dei feed: tornano in testa alla chain input
+    for name, _, addr_family in FEED_SETS.values():
+        if name in live.sets:
+            rule = Rule.parse(f"{addr_family} saddr @{name} drop")
+            lines.append(f"insert rule {family} {table} input {rule.to_text()}")
+    return "#!/usr/sbin/nft -f\n" + "\n".join(lines) + "\n"
+
+
+def build_delete_transaction(content: str = "", family: str = "inet", table: str = "filter") -> str:
+    """
+    Transazione di rollback verso "table assente": elimina la table (con `add` il delete è valido
+    anche se nel frattempo è sparita) e quella di ingress; `content` è l'eventuale table di
+    ingress salvata nella generazione, ricreata nella stessa transazione.
+    """
+    lines = [f"add table {family} {table}", f"delete table {family} {table}",
+             f"add table netdev {INGRESS_TABLE}", f"delete table netdev {INGRESS_TABLE}"]
+    body = "\n".join(l for l in content.splitlines() if not l.startswith("#")).strip()
+    if body:
+        lines.append(body)
+    return "#!/usr/sbin/nft -f\n" + "\n".join(lines) + "\n"
+
+
+def build_replace_transaction(table: Table, ingress: Optional[Table] = None) -> str:
+    """
+    Transazione che sostituisce la table senza leggere lo stato live (host remoti di fleet.py,
+    namespace di netns.py): `add` + `flush` della table e di ogni set/map del ruleset, poi il
+    contenuto. `add set` con la stessa definizione non fa nulla se il set esiste già, quindi il
+    flush è valido in entrambi i casi; i set che non fanno parte del ruleset restano invariati.
+    Applicata più volte lascia lo stesso stato: nessuna regola duplicata.
+    """
+    family, name = table.family, table.name
+    lines = [f"add table {family} {name}", f"flush table {family} {name}"]
+    for s in table.sets.values():
+        lines.append(f"add {s.kind} {family} {name} {s.name} {{ {s.definition} }}")
+        lines.append(f"flush {s.kind} {family} {name} {s.name}")
+    lines += [f"add table netdev {INGRESS_TABLE}", f"delete table netdev {INGRESS_TABLE}"]
+    lines.append(table.to_text(header=False).rstrip())
+    if ingress:
+        lines.append(ingress.to_text(header=False).rstrip())
+    return "#!/usr/sbin/nft -f\n" + "\n".join(lines) + "\n"
+
+
+def _run_nft_file(script: str, check_only: bool = False) -> None:
+    """Esegue `nft [-c] -f` su un file temporaneo; solleva RuntimeError con lo stderr di nft."""
+    with tempfile.NamedTemporaryFile("w", delete=False, prefix="nft_atomic_", suffix=".nft") as fh:
+        fh.write(script)
+        path = Path(fh.name)
+    try:
+        args = ["-c", "-f", str(path)] if check_only else ["-f", str(path)]
+        p = nft_exec.run(args, timeout=APPLY_TIMEOUT, check=False)
+        if p.returncode != 0:
+            step = "validazione (nft -c)" if check_only else "applicazione"
+            raise RuntimeError(f"{step} fallita: {(p.stderr or p.stdout or '').strip() or f'exit {p.returncode}'}")
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def list_generations(base: Path) -> List[Path]:
+    """Generazioni salvate, dalla più vecchia alla più recente."""
+    folder = base / GENERATIONS_DIR
+    return sorted(folder.glob("gen-*.nft")) if folder.is_dir() else []
+
+
+def save_generation(base: Path, listing: str, keep: int = DEFAULT_KEEP) -> Path:
+    folder = base / GENERATIONS_DIR
+    folder.mkdir(parents=True, exist_ok=True)
+    now = time.time()
+    path = folder / f"gen-{time.strftime('%Y%m%dT%H%M%S', time.localtime(now))}.{int(now * 1000) % 1000:03d}.nft"
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(listing, encoding="utf-8")
+    tmp.replace(path)
+    for old in list_generations(base)[:-keep] if keep > 0 else []:
+        old.unlink(missing_ok=True)
+    return path
+
+
+def apply_atomic(base_dir: str, rules_file: Optional[str] = None, keep: int = DEFAULT_KEEP) -> Path:
+    """
+    Valida e applica rules/firewall.rules in una sola transazione.
+    Ritorna il path della generazione salvata (lo stato precedente).
+    Solleva RuntimeError se la validazione o l'applicazione falliscono: in entrambi i casi
+    il kernel non è stato modificato e la generazione non viene salvata.
+    """
+    base = Path(base_dir).expanduser().resolve()
+    path = Path(rules_file) if rules_file else base / "rules" / "firewall.rules"
+    script = build_transaction(path.read_text(encoding="utf-8"))
+    previous = snapshot_table()
+    ingress = snapshot_table("netdev", INGRESS_TABLE)
+    # una table assente non ha stato da ripristinare: il rollback la elimina
+    previous = previous or ABSENT_MARK + "\n"
+    if ingress:
+        previous += ingress
+    _run_nft_file(script, check_only=True)
+    _run_nft_file(script)
+    return save_generation(base, previous, keep=keep)
+
+
+def _rollback_script(content: str) -> str:
+    if content.startswith(ABSENT_MARK) or content.strip() == _LEGACY_EMPTY:
+        return build_delete_transaction(content.replace(ABSENT_MARK, "", 1))
+    return build_transaction(content)
+
+
+def rollback(base_dir: str) -> Path:
+    """Riapplica l'ultima generazione (e la rimuove dall'elenco). Ritorna il path usato."""
+    base = Path(base_dir).expanduser().resolve()
+    generations = list_generations(base)
+    if not generations:
+        raise RuntimeError(f"nessuna generazione in {base / GENERATIONS_DIR}")
+    latest = generations[-1]
+    script = _rollback_script(latest.read_text(encoding="utf-8"))
+    _run_nft_file(script, check_only=True)
+    _run_nft_file(script)
+    latest.unlink()
+    return latest
+
+
+def run_atomic_apply(base_dir: str, keep: int = DEFAULT_KEEP) -> int:
+    """Entrypoint CLI di `apply --atomic`."""
+    start = time.monotonic()
+    try:
+        generation = apply_atomic(base_dir, keep=keep)
+    except Exception as e:
+        print(f"ERR: apply atomico fallito, ruleset invariato: {e}", file=sys.stderr)
+        return 1
+    print(f"Ruleset applicato in una transazione ({time.monotonic() - start:.2f}s); "
+          f"stato precedente in {generation.name}")
+    return 0
+
+
+def run_rollback(base_dir: str) -> int:
+    """Entrypoint CLI di `rollback`."""
+    try:
+        generation = rollback(base_dir)
+    except Exception as e:
+        print(f"ERR: rollback fallito: {e}", file=sys.stderr)
+        return 1
+    remaining = len(list_generations(Path(base_dir).expanduser().resolve()))
+    print(f"Ripristinata la generazione {generation.name} ({remaining} rimanenti)")
+    return 0
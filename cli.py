@@ -7,29 +7,177 @@ Si occupa di:
 - assicurare table/chain/sets
 - sincronizzare servizi (aggiungere elementi ai set)
 - flush notifiche
+- plan: calcolo offline del changeset (nessuna modifica al kernel)
+- fleet: applicazione parallela su più host (vedi fleet.py)
+- netns: applicazione parallela in più network namespace (vedi netns.py)
+- ingest: caricamento incrementale delle blocklist (vedi feeds.py)
+- optimize: riordino delle regole della chain input in base ai contatori (vedi optimizer.py)
+- collect / traffic: campionamento e interrogazione dei counter per servizio (vedi traffic.py)
+- apply --atomic / rollback: sostituzione della table in una transazione e ripristino (vedi atomic.py)
+- monitor: flusso in tempo reale delle modifiche esterne al ruleset (vedi nft_monitor.py)
+- docker: servizi dalle porte pubblicate dei container, via eventi Docker (vedi docker_discovery.py)
+- api: control plane residente con API JSON su socket unix (vedi control_plane.py)
+- drops: campionamento NFLOG dei pacchetti scartati dalla policy (vedi drops.py)
 """
 import argparse
+import atexit
 import sys
 from pathlib import Path
 
-from config import DEFAULT_BASE_DIR, load_services
-from rules_generator import ensure_rules_file_from_services
+from atomic import DEFAULT_KEEP, build_replace_transaction, run_atomic_apply, run_rollback
+from control_plane import DEFAULT_SOCKET, run_control_plane
+from config import DEFAULT_BASE_DIR, load_address_lists, load_blocklist_feeds
+from docker_discovery import DOCKER_SOCKET, run_docker_discovery
+from drops import format_drops, run_drops, top_drops
+from feeds import DEFAULT_CHUNK_SIZE, feeds_changed, run_ingest
+from grants import load_active_services
+from rules_generator import (build_tables_from_services, ensure_rules_file_from_services, rules_config,
+                             effective_set_mode, service_actions)
+import nft_exec
 from nft_utils import ensure_table_chains_sets, check_nft_available, check_net_admin, flush_rules
 from apply_rules import apply_rule
+from fleet import TRANSPORTS, run_fleet
+from netns import run_netns
+from nft_monitor import run_monitor
+from optimizer import DEFAULT_WINDOW, run_optimize
+from traffic import format_top, period_since, run_collect, top_services
+from watchdog import record_fingerprint
+from plan import format_plan, load_ruleset_json, plan_services
 
 try:
     import telegram_utils
 except Exception:
     telegram_utils = None
 
-def run_cli():
+def _record_fingerprint(base: Path) -> None:
+    try:
+        record_fingerprint(str(base))
+    except Exception as e:
+        print(f"WARN: fingerprint del ruleset non registrato: {e}", file=sys.stderr)
+
+
+def run_plan(base: Path, snapshot=None) -> int:
+    """
+    Calcola e stampa il changeset senza toccare il kernel.
+    Lo stato viene letto una sola volta (snapshot JSON o ruleset live).
+    """
+    try:
+        data = load_ruleset_json(snapshot)
+    except Exception as e:
+        print(f"ERR: impossibile leggere lo stato del ruleset: {e}", file=sys.stderr)
+        return 2
+
+    services = load_active_services(str(base), persist=False)
+    # con uno snapshot il piano può essere calcolato altrove: interfacce come da config
+    changes = plan_services(data, services, rules_config(str(base)), load_address_lists(str(base)),
+                            local=snapshot is None)
+    source = f"snapshot {snapshot}" if snapshot else "ruleset live"
+    sys.stdout.write(format_plan(changes, source=source))
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(prog="firewall_ai")
+    parser.add_argument("command", nargs="?", default="apply", choices=["apply", "plan", "fleet", "ingest", "optimize", "collect", "traffic", "rollback", "monitor", "docker", "api", "drops"],
+                        help="apply (default) applica le regole, plan mostra il changeset senza applicarlo, "
+                             "fleet applica su tutti gli host di config/fleet.yaml, "
+                             "ingest carica i delta delle blocklist_feeds, "
+                             "optimize riordina le regole in base ai contatori, "
+                             "collect campiona i counter dei servizi, traffic mostra i servizi più attivi, "
+                             "rollback ripristina la generazione precedente all'ultimo apply --atomic, "
+                             "monitor segue in tempo reale le modifiche esterne al ruleset, "
+                             "docker genera config/services.d/docker.yaml dalle porte pubblicate dei container, "
+                             "api avvia il control plane (API JSON su socket unix, scrive config/services.d/api.yaml), "
+                             "drops aggrega i drop campionati via NFLOG (rules: drop_log)")
     parser.add_argument("--base-dir", default=DEFAULT_BASE_DIR, help="Base dir del progetto")
     parser.add_argument("--flush", action="store_true", help="Svuota le regole prima di applicare")
-    parser.add_argument("--dry-run", action="store_true", help="Simula l'applicazione delle regole")
-    args = parser.parse_args()
+    parser.add_argument("--atomic", action="store_true",
+                        help="apply: valida (nft -c) e sostituisce la table in una sola transazione, "
+                             "salvando lo stato precedente per il rollback")
+    parser.add_argument("--docker-socket", default=DOCKER_SOCKET, help="docker: socket unix del Docker Engine")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="api: socket unix del control plane")
+    parser.add_argument("--dry-run", action="store_true", help="Simula l'applicazione delle regole (equivale a plan)")
+    parser.add_argument("--snapshot", default=None,
+                        help="File JSON (nft -j list ruleset) da usare come stato attuale per plan")
+    parser.add_argument("--transport", default="ssh", choices=sorted(TRANSPORTS),
+                        help="fleet: trasporto verso gli host")
+    parser.add_argument("--workers", type=int, default=8, help="fleet/netns: host o namespace applicati in parallelo")
+    parser.add_argument("--canary", type=int, default=0,
+                        help="fleet: numero di host canary se nessuno è marcato canary in fleet.yaml")
+    parser.add_argument("--timeout", type=float, default=60, help="fleet/netns: timeout per host o namespace (secondi)")
+    parser.add_argument("--netns", action="append", default=None, metavar="NOME",
+                        help="applica il ruleset nel namespace di rete indicato (nome ip netns, path o pid:<n>); ripetibile")
+    parser.add_argument("--all-netns", action="store_true",
+                        help="applica il ruleset in tutti i namespace di rete (/run/netns e /proc/*/ns/net)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="ingest: elementi per transazione nft")
+    parser.add_argument("--full", action="store_true", help="ingest: ignora lo snapshot e ricarica tutti i feed")
+    parser.add_argument("--window", type=float, default=DEFAULT_WINDOW,
+                        help="optimize: durata del campionamento dei contatori (secondi)")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="collect: secondi tra due letture (0 = una sola lettura)")
+    parser.add_argument("--top", type=int, default=10, help="traffic/drops: numero di righe mostrate")
+    parser.add_argument("--period", default="day", choices=["day", "24h", "all"],
+                        help="traffic/drops: finestra (day = da mezzanotte)")
+    parser.add_argument("--summary", action="store_true",
+                        help="drops: mostra sorgenti, porte e protocolli più scartati invece di avviare il consumer")
+    return parser
+
+
+def is_read_only(args) -> bool:
+    """
+    True se il comando non modifica il kernel locale (plan / dry-run / fleet / optimize / collect /
+    traffic / monitor / docker / api / drops: docker e api lanciano apply separati, ognuno con il suo lock).
+    """
+    return args.command in ("plan", "fleet", "optimize", "collect", "traffic", "monitor", "docker", "api",
+                            "drops") or args.dry_run
+
+
+def run_cli(argv=None):
+    args = build_parser().parse_args(argv)
 
     base = Path(args.base_dir).expanduser().resolve()
+    if not is_read_only(args):
+        # metriche dei comandi nft di questo run, sommate in data/nft_metrics.json a ogni uscita
+        atexit.register(nft_exec.save_metrics, str(base))
+
+    if args.command == "fleet":
+        sys.exit(run_fleet(str(base), transport_name=args.transport, workers=args.workers,
+                           canary=args.canary, timeout=args.timeout))
+
+    # optimize: legge solo i contatori; con --dry-run mostra il nuovo ordine senza salvarlo
+    if args.command == "optimize":
+        sys.exit(run_optimize(str(base), window=args.window, dry_run=args.dry_run))
+
+    if args.command == "collect":
+        sys.exit(run_collect(str(base), interval=args.interval))
+
+    if args.command == "traffic":
+        sys.stdout.write(format_top(top_services(str(base), args.top, period_since(args.period))))
+        sys.exit(0)
+
+    # monitor: a lunga vita e in sola lettura, fuori dal lock (i run di apply restano liberi)
+    if args.command == "monitor":
+        sys.exit(run_monitor(str(base)))
+
+    # docker: a lunga vita; con --dry-run aggiorna solo docker.yaml senza lanciare apply
+    if args.command == "docker":
+        sys.exit(run_docker_discovery(str(base), socket_path=args.docker_socket, apply=not args.dry_run))
+
+    # drops: a lunga vita e in sola lettura (legge il gruppo NFLOG, scrive solo data/drops/)
+    if args.command == "drops":
+        if args.summary:
+            sys.stdout.write(format_drops(top_drops(str(base), args.top, args.period)))
+            sys.exit(0)
+        sys.exit(run_drops(str(base)))
+
+    # api: a lunga vita; con --dry-run aggiorna solo api.yaml senza lanciare apply
+    if args.command == "api":
+        sys.exit(run_control_plane(str(base), socket_path=args.socket, apply=not args.dry_run))
+
+    # plan / dry-run: nessun controllo NET_ADMIN e nessuna modifica al kernel
+    if is_read_only(args):
+        sys.exit(run_plan(base, snapshot=args.snapshot))
 
     # prerequisiti
     try:
@@ -44,35 +192,76 @@ def run_cli():
         print(f"ERR: permessi NET_ADMIN mancanti: {e}", file=sys.stderr)
         sys.exit(3)
 
+    # rollback: riapplica lo stato salvato prima dell'ultimo apply --atomic, senza rigenerare nulla
+    if args.command == "rollback":
+        rc = run_rollback(str(base))
+        if rc == 0:
+            _record_fingerprint(base)
+        sys.exit(rc)
+
+    cfg = rules_config(str(base))
+
     # genera rules file (idempotente)
-    ok = ensure_rules_file_from_services(str(base))
+    ok = ensure_rules_file_from_services(str(base), cfg)
     if not ok:
         print("WARN: generazione rules file fallita, procedo comunque a tentativi", file=sys.stderr)
 
-    # assicurati table/chain/sets e regole che usano i set
-    try:
-        ensure_table_chains_sets()
-    except Exception as e:
-        print(f"ERR: non posso creare table/chain/sets: {e}", file=sys.stderr)
-        sys.exit(4)
+    if args.command == "ingest":
+        sys.exit(run_ingest(str(base), load_blocklist_feeds(str(base)),
+                            chunk_size=args.chunk_size, full=args.full))
 
-    # opzionale flush
-    if args.flush:
-        try:
-            flush_rules()
-        except Exception as e:
-            print(f"WARN: flush rules fallito: {e}", file=sys.stderr)
+    # namespace di rete: stesso ruleset applicato in parallelo a ogni namespace
+    if args.netns or args.all_netns:
+        # le interfacce dell'host non esistono nei namespace: solo quelle configurate esplicitamente
+        content = build_replace_transaction(*build_tables_from_services(
+            load_active_services(str(base)), cfg, load_address_lists(str(base)), local=False))
+        sys.exit(run_netns(content, names=args.netns, workers=args.workers, timeout=args.timeout))
 
-    # carica services e applica (aggiunge solo elementi mancanti ai set)
-    services = load_services(str(base))
-    if args.dry_run:
-        print("DRY RUN: non verranno modificate regole. Simulazione in corso...")
+    # apply --atomic: rules/firewall.rules sostituisce la table in una sola transazione validata,
+    # al posto di flush + ensure_table_chains_sets + apply_rule
+    if args.atomic:
+        if not ok:
+            print("ERR: rules file non generato, apply atomico annullato", file=sys.stderr)
+            sys.exit(4)
+        rc = run_atomic_apply(str(base), keep=int(cfg.get("generations", DEFAULT_KEEP)))
+        if rc != 0:
+            sys.exit(rc)
+    else:
+        # opzionale flush (prima di ricreare table/chain/sets)
+        if args.flush:
+            try:
+                flush_rules()
+            except Exception as e:
+                print(f"WARN: flush rules fallito: {e}", file=sys.stderr)
 
-    for svc in services:
+        # carica services (gli accessi temporanei entrano con il timeout residuo,
+        # quelli scaduti sono esclusi) e scegli set separati, set concatenato o verdict map
+        services = load_active_services(str(base))
+        set_mode = effective_set_mode(cfg["service_set_mode"], service_actions(services))
+
+        # assicurati table/chain/sets e regole che usano i set
         try:
-            apply_rule(svc, dry_run=args.dry_run)
+            live = ensure_table_chains_sets(policy=cfg["policy"], set_mode=set_mode)
         except Exception as e:
-            print(f"WARN: apply_rule fallita per {svc.get('name','?')}: {e}", file=sys.stderr)
+            print(f"ERR: non posso creare table/chain/sets: {e}", file=sys.stderr)
+            sys.exit(4)
+
+        # aggiunge solo elementi mancanti ai set
+        for svc in services:
+            try:
+                # table/chain/sets sono già stati assicurati sopra, una sola volta:
+                # lo stato letto lì evita una `nft list` per ogni servizio
+                apply_rule(svc, ensure=False, set_mode=set_mode, live=live)
+            except Exception as e:
+                print(f"WARN: apply_rule fallita per {svc.get('name','?')}: {e}", file=sys.stderr)
+
+    # blocklist: solo se i feed sono cambiati dall'ultimo snapshot (o se il set va ricreato)
+    feeds = load_blocklist_feeds(str(base))
+    if feeds and (args.flush or feeds_changed(str(base), feeds)):
+        run_ingest(str(base), feeds, chunk_size=args.chunk_size, full=args.flush)
+
+    # stato applicato: il watchdog interviene solo se la table si discosta da questo
+    _record_fingerprint(base)
 
 # flush notifiche Telegram (se il modulo fornisce la funzione)
     if telegram_utils is not None:
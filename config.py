@@ -2,8 +2,21 @@
 Parsing della configurazione e valori di default.
 Espone load_services(base_dir) che ritorna lista di dict:
 [{"name":..., "port":..., "protocol":...}, ...]
+Le voci temporanee hanno in più "ttl" (secondi) e/o "expires" (epoch), vedi grants.py;
+"action" (accept|drop) è presente solo se indicata in YAML (usata dalla verdict map);
+"limit" ("10/second") e "burst" (pacchetti) limitano le nuove connessioni per sorgente,
+vedi rules_generator (set dinamici @meter_*); "stateless" (True) esclude il servizio da conntrack.
+
+I servizi possono essere suddivisi anche in config/services.d/*.yaml (un file per gruppo,
+stesso formato `allowed_services:` oppure lista semplice): vedi load_service_shards().
 """
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import hashlib
+import json
+import os
 from pathlib import Path
+import re
 import sys
 
 DEFAULT_BASE_DIR = "/home/roberto/docker-stacks/firewall_ai"
@@ -13,50 +26,370 @@ try:
 except Exception:
     yaml = None
 
-def load_services(base_dir=None, services_path="config/services.yaml"):
+_TTL_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_LIMIT_UNITS = ("second", "minute", "hour", "day")
+
+SERVICES_DIR = "config/services.d"
+SHARD_CACHE_FILE = "data/services_cache.json"
+SHARD_CACHE_VERSION = 3     # da incrementare quando cambia il formato delle voci normalizzate
+PARALLEL_MIN_SHARDS = 4     # sotto questa soglia il pool di processi costa più del parsing
+
+# cache dei file di services.d nel processo: path -> {"mtime", "size", "sha256", "entries"}
+_shards = {}
+
+
+def parse_ttl(value) -> int:
     """
-    Legge config/services.yaml e ritorna lista di dict.
-    Se PyYAML non è installato ritorna lista vuota e stampa istruzioni.
+    Converte un ttl in secondi: intero (secondi) o stringa tipo "90s", "30m", "4h", "2d", "1h30m".
+    Solleva ValueError se il formato non è valido o il valore non è positivo.
     """
-    if base_dir:
-        base = Path(base_dir).expanduser().resolve()
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        seconds = int(value)
     else:
-        try:
-            base = Path(__file__).parent.resolve()
-        except Exception:
-            base = Path.cwd()
+        text = str(value).strip().lower()
+        if text.isdigit():
+            seconds = int(text)
+        else:
+            if not re.fullmatch(r"(?:\d+\s*[smhd]\s*)+", text):
+                raise ValueError(f"ttl non valido: {value!r}")
+            parts = re.findall(r"(\d+)\s*([smhd])", text)
+            seconds = sum(int(n) * _TTL_UNITS[u] for n, u in parts)
+    if seconds <= 0:
+        raise ValueError(f"ttl non positivo: {value!r}")
+    return seconds
+
+
+def parse_limit(value) -> str:
+    """
+    Normalizza `limit` nella forma di nft "N/unità": intero (al secondo) o stringa
+    tipo "10/second", "30/minute", "10/s". Solleva ValueError se non valido.
+    """
+    text = str(value).strip().lower().replace(" ", "")
+    rate, _, unit = text.partition("/")
+    unit = next((u for u in _LIMIT_UNITS if unit and u.startswith(unit)), None) if unit else "second"
+    if not rate.isdigit() or int(rate) <= 0 or unit is None:
+        raise ValueError(f"limit non valido: {value!r}")
+    return f"{int(rate)}/{unit}"
+
+
+def parse_expires(value) -> float:
+    """
+    Converte `expires` in epoch (secondi). Accetta datetime (YAML li converte già)
+    o stringa ISO 8601; le date senza fuso orario sono interpretate come ora locale.
+    """
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        dt = datetime.fromisoformat(str(value).strip())
+    return dt.timestamp()
+
 
-    services_file = base / services_path
+def default_lock_path():
+    """Lock (flock) dei run che modificano il kernel, condiviso da firewall_ai.py e nft_monitor.py."""
+    # se siamo root, usa /var/run
+    if os.geteuid() == 0:
+        return "/var/run/firewall_ai.lock"
+    # prova XDG_RUNTIME_DIR
+    xdg = os.environ.get("XDG_RUNTIME_DIR")
+    if xdg:
+        return os.path.join(xdg, "firewall_ai.lock")
+    # prova /run/user/<uid>
+    run_user = f"/run/user/{os.geteuid()}"
+    if os.path.isdir(run_user):
+        return os.path.join(run_user, "firewall_ai.lock")
+    # fallback su /tmp
+    return os.path.join("/tmp", f"firewall_ai-{os.geteuid()}.lock")
+
+
+def _resolve_base(base_dir=None) -> Path:
+    if base_dir:
+        return Path(base_dir).expanduser().resolve()
+    try:
+        return Path(__file__).parent.resolve()
+    except Exception:
+        return Path.cwd()
+
+
+def _read_config(base_dir=None, services_path="config/services.yaml"):
+    """
+    Legge e valida il file YAML. Ritorna il dict grezzo o None (errori già stampati).
+    """
+    services_file = _resolve_base(base_dir) / services_path
     if not services_file.exists():
         print(f"WARN: services file non trovato: {services_file}", file=sys.stderr)
-        return []
+        return None
 
     if yaml is None:
         print("ERR: PyYAML non installato. Installa con: sudo apt install python3-yaml OR pip3 install pyyaml", file=sys.stderr)
-        return []
+        return None
 
     try:
         raw = yaml.safe_load(services_file.read_text(encoding="utf-8"))
     except Exception as e:
         print(f"ERR: parsing {services_file}: {e}", file=sys.stderr)
-        return []
+        return None
 
     if not isinstance(raw, dict):
         print(f"WARN: formato invalido in {services_file}", file=sys.stderr)
+        return None
+    return raw
+
+
+def _iter_address_entries(items, base: Path):
+    """Voci CIDR inline oppure `file:<path>` (un CIDR per riga, letto in streaming)."""
+    for item in items or []:
+        text = str(item).strip()
+        if not text.startswith("file:"):
+            yield text
+            continue
+        path = Path(text[5:].strip()).expanduser()
+        if not path.is_absolute():
+            path = base / path
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    yield line.split("#", 1)[0]
+        except OSError as e:
+            print(f"WARN: lista indirizzi non leggibile {path}: {e}", file=sys.stderr)
+
+
+def load_address_lists(base_dir=None, services_path="config/services.yaml"):
+    """
+    Ritorna {"allow": iterabile di CIDR, "deny": iterabile di CIDR} dalle sezioni
+    `allow_addresses` / `deny_addresses` di services.yaml (IPv4 e IPv6 insieme,
+    la separazione per famiglia avviene in addresses.aggregate).
+    """
+    raw = _read_config(base_dir, services_path)
+    if raw is None:
+        return {"allow": [], "deny": []}
+    base = _resolve_base(base_dir)
+    return {
+        "allow": list(_iter_address_entries(raw.get("allow_addresses"), base)),
+        "deny": list(_iter_address_entries(raw.get("deny_addresses"), base)),
+    }
+
+
+def load_rules_config(base_dir=None, services_path="config/services.yaml"):
+    """
+    Ritorna la sezione opzionale `rules:` di services.yaml (override di
+    rules_generator.DEFAULT_RULES, es. policy, lan_cidr, service_set_mode).
+    """
+    raw = _read_config(base_dir, services_path)
+    if raw is None:
+        return {}
+    section = raw.get("rules") or {}
+    if not isinstance(section, dict):
+        print("WARN: sezione `rules` non valida in services.yaml, ignorata", file=sys.stderr)
+        return {}
+    return section
+
+
+def load_blocklist_feeds(base_dir=None, services_path="config/services.yaml"):
+    """Ritorna i path dei feed di `blocklist_feeds` in services.yaml (vedi feeds.py)."""
+    raw = _read_config(base_dir, services_path)
+    if raw is None:
         return []
+    return [str(p) for p in raw.get("blocklist_feeds") or []]
+
 
+def _parse_entries(services, source="services.yaml"):
+    """Normalizza le voci di `allowed_services`; le voci malformate sono saltate con un WARN."""
     entries = []
-    services = raw.get("allowed_services") or []
-    for item in services:
+    for item in services or []:
         try:
             name = item.get("name") or item.get("service") or "unknown"
             port = int(item.get("port"))
             proto = (item.get("protocol") or "tcp").lower()
             if proto not in ("tcp", "udp"):
                 proto = "tcp"
-            entries.append({"name": name, "port": port, "protocol": proto})
+            entry = {"name": name, "port": port, "protocol": proto}
+            if item.get("ttl") is not None:
+                entry["ttl"] = parse_ttl(item["ttl"])
+            if item.get("expires") is not None:
+                entry["expires"] = parse_expires(item["expires"])
+            if item.get("action") is not None:
+                action = str(item["action"]).lower()
+                if action == "reject":
+                    # reject non è un verdetto ammesso negli elementi di una verdict map:
+                    # nft rifiuterebbe l'intera transazione
+                    print(f"WARN: {name}: action reject non supportata nella verdict map, uso drop ({source})",
+                          file=sys.stderr)
+                    action = "drop"
+                if action not in ("accept", "drop"):
+                    raise ValueError(f"action non valida: {action}")
+                entry["action"] = action
+            if item.get("limit") is not None:
+                entry["limit"] = parse_limit(item["limit"])
+                if item.get("burst") is not None:
+                    entry["burst"] = int(item["burst"])
+                    if entry["burst"] <= 0:
+                        raise ValueError(f"burst non positivo: {item['burst']}")
+            if item.get("stateless"):
+                entry["stateless"] = True
+                if "limit" in entry:
+                    # il limite conta le connessioni nuove (ct state new): senza conntrack non esistono
+                    print(f"WARN: {name}: limit ignorato per un servizio stateless ({source})", file=sys.stderr)
+                    entry.pop("limit")
+                    entry.pop("burst", None)
+            entries.append(entry)
         except Exception:
-            print(f"WARN: salto voce malformata in services.yaml: {item}", file=sys.stderr)
+            print(f"WARN: salto voce malformata in {source}: {item}", file=sys.stderr)
+            continue
+
+    return entries
+
+
+def _parse_shard(path: str, data: bytes = None):
+    """
+    Parsing di un file di services.d (eseguito anche nei processi del pool).
+    Ritorna (sha256 del contenuto, voci normalizzate).
+    """
+    if data is None:
+        data = Path(path).read_bytes()
+    raw = yaml.safe_load(data.decode("utf-8"))
+    services = raw.get("allowed_services") if isinstance(raw, dict) else raw
+    if services is not None and not isinstance(services, list):
+        raise ValueError("atteso `allowed_services:` o una lista di servizi")
+    return hashlib.sha256(data).hexdigest(), _parse_entries(services, Path(path).name)
+
+
+def _load_shard_cache(base: Path) -> dict:
+    try:
+        cache = json.loads((base / SHARD_CACHE_FILE).read_text(encoding="utf-8"))
+        # una cache scritta con un formato diverso delle voci si riparte da zero
+        if not isinstance(cache, dict) or cache.pop("__version__", None) != SHARD_CACHE_VERSION:
+            return {}
+        return cache
+    except Exception:
+        return {}
+
+
+def _save_shard_cache(base: Path, cache: dict) -> None:
+    path = base / SHARD_CACHE_FILE
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(dict(cache, __version__=SHARD_CACHE_VERSION)), encoding="utf-8")
+        tmp.replace(path)
+    except OSError as e:
+        print(f"WARN: cache di services.d non salvata: {e}", file=sys.stderr)
+
+
+def load_service_shards(base_dir=None, workers=None):
+    """
+    Servizi di config/services.d/*.yaml, nell'ordine dei nomi file.
+    Ogni file è riletto solo se mtime/dimensione sono cambiati e riparsato solo se
+    cambia anche l'hash del contenuto; le voci degli altri file vengono dalla cache
+    del processo (_shards) o, a freddo, da data/services_cache.json. Se a freddo i file
+    da parsare sono almeno PARALLEL_MIN_SHARDS, il parsing avviene in un pool di processi.
+    Ritorna (voci, nomi dei file riparsati).
+    """
+    base = _resolve_base(base_dir)
+    folder = base / SERVICES_DIR
+    if not folder.is_dir():
+        return [], []
+    if yaml is None:
+        print("ERR: PyYAML non installato. Installa con: sudo apt install python3-yaml OR pip3 install pyyaml", file=sys.stderr)
+        return [], []
+
+    persisted = None
+    current = {}
+    stale = []
+    for path in sorted(folder.glob("*.yaml")):
+        key = str(path)
+        try:
+            st = path.stat()
+        except OSError:
             continue
+        cached = _shards.get(key)
+        if cached is None:
+            if persisted is None:
+                persisted = _load_shard_cache(base)
+            cached = persisted.get(key)
+        if cached and cached["mtime"] == st.st_mtime_ns and cached["size"] == st.st_size:
+            current[key] = cached
+        else:
+            stale.append((key, st, cached))
+
+    changed = []
+    dirty = False
+    if stale:
+        jobs = {}
+        for key, st, cached in stale:
+            try:
+                data = Path(key).read_bytes()
+            except OSError as e:
+                print(f"WARN: {key} non leggibile: {e}", file=sys.stderr)
+                continue
+            if cached and cached["sha256"] == hashlib.sha256(data).hexdigest():
+                # toccato ma non modificato (touch, checkout): basta aggiornare lo stamp
+                current[key] = dict(cached, mtime=st.st_mtime_ns, size=st.st_size)
+                dirty = True
+            else:
+                jobs[key] = (st, data)
+        if len(jobs) >= PARALLEL_MIN_SHARDS:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {key: pool.submit(_parse_shard, key, data) for key, (_, data) in jobs.items()}
+                results = {}
+                for key, fut in futures.items():
+                    try:
+                        results[key] = fut.result()
+                    except Exception as e:
+                        results[key] = e
+        else:
+            results = {}
+            for key, (_, data) in jobs.items():
+                try:
+                    results[key] = _parse_shard(key, data)
+                except Exception as e:
+                    results[key] = e
+        for key, result in results.items():
+            if isinstance(result, Exception):
+                # un file non valido non deve far sparire i servizi degli altri file:
+                # si tengono le ultime voci valide (se note)
+                print(f"ERR: parsing {key}: {result}", file=sys.stderr)
+                previous = _shards.get(key) or (persisted or {}).get(key)
+                if previous:
+                    current[key] = previous
+                continue
+            st = jobs[key][0]
+            current[key] = {"mtime": st.st_mtime_ns, "size": st.st_size,
+                            "sha256": result[0], "entries": result[1]}
+            changed.append(Path(key).name)
 
+    # i file rimossi escono dalla cache; le voci si uniscono per file, in ordine di nome
+    prefix = str(folder) + "/"
+    known = {k for k in list(_shards) + list(persisted or {}) if k.startswith(prefix)}
+    for key in known - set(current):
+        _shards.pop(key, None)
+    _shards.update(current)
+    if changed or dirty or known != set(current):
+        _save_shard_cache(base, {k: v for k, v in _shards.items() if k.startswith(prefix)})
+    return [e for key in sorted(current) for e in current[key]["entries"]], changed
+
+
+def load_services(base_dir=None, services_path="config/services.yaml"):
+    """
+    Legge config/services.yaml e config/services.d/*.yaml e ritorna lista di dict.
+    A parità di protocollo/porta vale la prima voce (services.yaml, poi i file in ordine di nome).
+    Se PyYAML non è installato ritorna lista vuota e stampa istruzioni.
+    """
+    base = _resolve_base(base_dir)
+    entries = []
+    if (base / services_path).exists() or not (base / SERVICES_DIR).is_dir():
+        raw = _read_config(base_dir, services_path)
+        if raw is not None:
+            entries = _parse_entries(raw.get("allowed_services"))
+
+    shard_entries, _ = load_service_shards(base_dir)
+    if not shard_entries:
+        return entries
+    seen = {(e["protocol"], e["port"]) for e in entries}
+    for e in shard_entries:
+        key = (e["protocol"], e["port"])
+        if key in seen:
+            print(f"WARN: {e['protocol']}/{e['port']} ({e['name']}) duplicato in services.d, ignorato", file=sys.stderr)
+            continue
+        seen.add(key)
+        entries.append(e)
     return entries
@@ -0,0 +1,361 @@
+"""
+control_plane.py
+
+Processo residente che espone una piccola API JSON su socket unix, per gli altri servizi
+della macchina (automazioni di Home Assistant, script di deploy, ...) al posto di
+`fw-add-tcp` o delle modifiche a mano allo YAML seguite da un run della CLI.
+
+Protocollo: una richiesta JSON per riga, una risposta JSON per riga, sulla stessa connessione.
+
+    {"op": "open",  "port": 8123, "protocol": "tcp", "name": "homeassistant"}
+    {"op": "close", "port": 8123, "protocol": "tcp"}
+    {"op": "grant", "port": 2222, "protocol": "tcp", "ttl": "4h", "name": "support"}
+    {"op": "status"}
+    {"op": "plan"}
+
+Risposta: {"ok": true, ...} oppure {"ok": false, "error": "..."}.
+
+- le porte aperte via API sono voci di config/services.d/api.yaml (file generato, come
+  docker.yaml): apply completi, watchdog e plan vedono lo stesso stato dell'API;
+- open/close/grant vengono accodati: il committer attende COALESCE_WINDOW dall'arrivo della
+  prima richiesta, poi scrive api.yaml una volta sola e lancia UN reconcile
+  (`firewall_ai.py --atomic`, stesso lock coalescente degli altri trigger), cioè una sola
+  transazione nft per tutto il lotto. Centinaia di chiamate al secondo diventano pochi commit;
+- le richieste di un lotto ricevono la risposta solo a commit concluso (o fallito). Se un altro
+  run tiene il lock il reconcile viene solo accodato: il committer lo ripete ogni LOCK_POLL
+  secondi (al più LOCK_WAIT) finché non lo esegue davvero; oltre, la risposta ha `"queued": true`
+  (le modifiche saranno applicate dal giro aggiuntivo del run in corso);
+- grant usa `expires` (istante assoluto) invece di `ttl`: una concessione rinnovata riparte
+  da ora, e la scadenza è comunque gestita dal kernel (timeout degli elementi, vedi grants.py);
+- lo snapshot del ruleset (`nft -j list ruleset`) resta in memoria e viene riletto solo dopo
+  ogni commit: status e plan non eseguono nft.
+"""
+
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import nft_exec
+from config import SERVICES_DIR, load_address_lists, parse_expires, parse_ttl
+from grants import load_active_services
+from plan import format_plan, load_ruleset_json, plan_services
+from rules_generator import rules_config
+from watchdog import reconcile_status
+
+try:
+    import yaml
+except Exception:
+    yaml = None
+
+DEFAULT_SOCKET = "/run/firewall_ai.sock"
+SHARD_NAME = "api.yaml"
+COALESCE_WINDOW = 0.2        # secondi di attesa dopo la prima richiesta di un lotto
+MAX_BATCH = 1000             # richieste al massimo per commit
+REQUEST_TIMEOUT = 150        # secondi di attesa di una risposta (reconcile compreso)
+LOCK_WAIT = 20               # secondi di attesa di un run concorrente prima di rispondere "queued"
+LOCK_POLL = 0.5
+MAX_LINE = 64 * 1024
+_WRITE_OPS = ("open", "close", "grant")
+
+
+class _Pending:
+    """Richiesta di modifica in attesa del commit del suo lotto."""
+
+    __slots__ = ("request", "done", "response")
+
+    def __init__(self, request: Dict):
+        self.request = request
+        self.done = threading.Event()
+        self.response: Dict = {}
+
+
+def _key(entry: Dict) -> Tuple[str, int]:
+    return entry["protocol"], entry["port"]
+
+
+def _parse_request(request: Dict) -> Dict:
+    """Valida open/close/grant; ritorna la voce normalizzata. Solleva ValueError."""
+    try:
+        port = int(request.get("port"))
+    except (TypeError, ValueError):
+        raise ValueError(f"porta non valida: {request.get('port')!r}")
+    if not 0 < port < 65536:
+        raise ValueError(f"porta fuori intervallo: {port}")
+    proto = str(request.get("protocol") or "tcp").lower()
+    if proto not in ("tcp", "udp"):
+        raise ValueError(f"protocollo non valido: {proto}")
+    entry = {"name": str(request.get("name") or f"api-{proto}-{port}"), "port": port, "protocol": proto}
+    if request["op"] == "grant":
+        if request.get("ttl") is None:
+            raise ValueError("grant richiede ttl")
+        entry["ttl"] = parse_ttl(request["ttl"])
+    return entry
+
+
+class ControlPlane:
+    """Stato delle voci API, coda delle modifiche e snapshot del ruleset in memoria."""
+
+    def __init__(self, base_dir: str, window: float = COALESCE_WINDOW, apply: bool = True):
+        self.base = Path(base_dir).expanduser().resolve()
+        self.window = window
+        self.apply = apply
+        self.entries: Dict[Tuple[str, int], Dict] = {}
+        self.snapshot: Optional[Dict] = None
+        self.stats = {"requests": 0, "commits": 0, "failed_commits": 0, "last_commit": None,
+                      "last_batch": 0, "last_seconds": 0.0}
+        self._queue: "queue.Queue[_Pending]" = queue.Queue()
+        self._lock = threading.Lock()
+
+    @property
+    def shard_path(self) -> Path:
+        return self.base / SERVICES_DIR / SHARD_NAME
+
+    # --- stato ---
+
+    def load(self) -> None:
+        """Voci già presenti in api.yaml (riavvio del processo); le concessioni scadute vengono perse."""
+        if yaml is None or not self.shard_path.exists():
+            return
+        try:
+            raw = yaml.safe_load(self.shard_path.read_text(encoding="utf-8")) or {}
+        except Exception as e:
+            print(f"WARN: {self.shard_path} illeggibile, riparto da vuoto: {e}", file=sys.stderr)
+            return
+        now = time.time()
+        for item in raw.get("allowed_services") or []:
+            try:
+                entry = {"name": str(item["name"]), "port": int(item["port"]), "protocol": item["protocol"]}
+                if item.get("expires") is not None:
+                    entry["expires"] = parse_expires(item["expires"])
+            except Exception:
+                print(f"WARN: salto voce malformata in {SHARD_NAME}: {item}", file=sys.stderr)
+                continue
+            if entry.get("expires", now + 1) > now:
+                self.entries[_key(entry)] = entry
+
+    def refresh_snapshot(self) -> None:
+        try:
+            self.snapshot = load_ruleset_json()
+        except Exception as e:
+            print(f"WARN: snapshot del ruleset non aggiornato: {e}", file=sys.stderr)
+
+    def services(self) -> List[Dict]:
+        now = time.time()
+        return [self.entries[k] for k in sorted(self.entries)
+                if self.entries[k].get("expires") is None or self.entries[k]["expires"] > now]
+
+    def write_shard(self) -> bool:
+        """Scrive api.yaml solo se il contenuto cambia (l'mtime guida il reload incrementale)."""
+        if yaml is None:
+            raise RuntimeError("PyYAML non installato. Installa con: sudo apt install python3-yaml OR pip3 install pyyaml")
+        services = []
+        for entry in self.services():
+            if "expires" in entry:
+                # config.parse_expires accetta datetime (o ISO 8601), non epoch
+                entry = dict(entry, expires=datetime.fromtimestamp(entry["expires"], timezone.utc))
+            services.append(entry)
+        text = "# generato da control_plane.py: non modificare a mano\n" + \
+               yaml.safe_dump({"allowed_services": services}, sort_keys=False)
+        path = self.shard_path
+        try:
+            if path.read_text(encoding="utf-8") == text:
+                return False
+        except OSError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+        return True
+
+    # --- modifiche ---
+
+    def _merge(self, request: Dict, entry: Dict) -> Dict:
+        """Applica una richiesta alle voci in memoria; ritorna la risposta (senza esito del commit)."""
+        key = _key(entry)
+        if request["op"] == "close":
+            if key not in self.entries:
+                return {"ok": False, "error": f"{entry['protocol']}/{entry['port']} non è gestita dall'API"}
+            self.entries.pop(key)
+            return {"ok": True, "closed": f"{entry['protocol']}/{entry['port']}"}
+        if "ttl" in entry:
+            entry["expires"] = int(time.time()) + entry.pop("ttl")
+        self.entries[key] = entry
+        response = {"ok": True, "opened": f"{entry['protocol']}/{entry['port']}"}
+        if "expires" in entry:
+            response["expires"] = entry["expires"]
+        return response
+
+    def commit(self, batch: List[_Pending]) -> None:
+        """Un lotto: fusione in memoria, una scrittura di api.yaml, un reconcile, poi le risposte."""
+        with self._lock:
+            before = dict(self.entries)
+            for p in batch:
+                try:
+                    p.response = self._merge(p.request, _parse_request(p.request))
+                except ValueError as e:
+                    p.response = {"ok": False, "error": str(e)}
+            start = time.monotonic()
+            error = None
+            queued = False
+            try:
+                if self.write_shard() and self.apply:
+                    outcome = self._reconcile()
+                    if outcome == "failed":
+                        error = "reconcile fallito, vedi il log del control plane"
+                    queued = outcome == "queued"
+            except Exception as e:
+                error = str(e)
+            if error:
+                # il kernel non è cambiato: le voci tornano allo stato precedente
+                self.entries = before
+                try:
+                    self.write_shard()
+                except Exception:
+                    pass
+                self.stats["failed_commits"] += 1
+                for p in batch:
+                    if p.response.get("ok"):
+                        p.response = {"ok": False, "error": error}
+            else:
+                self.stats["commits"] += 1
+                self.refresh_snapshot()
+                for p in batch:
+                    if queued and p.response.get("ok"):
+                        p.response["queued"] = True
+            self.stats.update(last_commit=time.time(), last_batch=len(batch),
+                              last_seconds=round(time.monotonic() - start, 3))
+        for p in batch:
+            p.done.set()
+
+    def _reconcile(self) -> str:
+        """
+        Reconcile del lotto. Se un altro run tiene il lock il figlio accoda solo il trigger:
+        si riprova finché il lock si libera, così la risposta riflette un apply vero.
+        """
+        deadline = time.monotonic() + LOCK_WAIT
+        while True:
+            outcome = reconcile_status(self.base)
+            if outcome != "queued" or time.monotonic() >= deadline:
+                return outcome
+            time.sleep(LOCK_POLL)
+
+    def committer(self) -> None:
+        """Thread di commit: attende la prima richiesta, poi raccoglie il resto del lotto per `window`."""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.commit(batch)
+            except Exception as e:
+                print(f"ERR: commit del control plane fallito: {e}", file=sys.stderr)
+                for p in batch:
+                    p.response = p.response or {"ok": False, "error": str(e)}
+                    p.done.set()
+
+    # --- API ---
+
+    def status(self) -> Dict:
+        sets = {}
+        for item in (self.snapshot or {}).get("nftables", []):
+            s = item.get("set") or item.get("map")
+            if s and s.get("table") == "filter":
+                sets[s["name"]] = len(s.get("elem") or [])
+        with self._lock:
+            return {"ok": True, "api_services": self.services(), "pending": self._queue.qsize(),
+                    "stats": dict(self.stats), "sets": sets, "nft_circuit": nft_exec.breaker.state}
+
+    def plan(self) -> Dict:
+        """Changeset tra lo snapshot in memoria e i servizi desiderati (senza eseguire nft)."""
+        if self.snapshot is None:
+            return {"ok": False, "error": "snapshot del ruleset non disponibile"}
+        # load_active_services tocca la cache globale degli shard (config) e services_cache.json:
+        # serializzato con i commit
+        with self._lock:
+            services = load_active_services(str(self.base), persist=False)
+            changes = plan_services(self.snapshot, services, rules_config(str(self.base)),
+                                    load_address_lists(str(self.base)))
+        return {"ok": True, "changes": len(changes), "plan": format_plan(changes, source="snapshot in memoria")}
+
+    def handle(self, request: Dict) -> Dict:
+        op = request.get("op") if isinstance(request, dict) else None
+        self.stats["requests"] += 1
+        if op == "status":
+            return self.status()
+        if op == "plan":
+            return self.plan()
+        if op not in _WRITE_OPS:
+            return {"ok": False, "error": f"op non valida: {op!r} (open, close, grant, status, plan)"}
+        try:
+            _parse_request(request)
+        except ValueError as e:
+            return {"ok": False, "error": str(e)}
+        pending = _Pending(request)
+        self._queue.put(pending)
+        if not pending.done.wait(REQUEST_TIMEOUT):
+            return {"ok": False, "error": f"nessun commit entro {REQUEST_TIMEOUT}s"}
+        return pending.response
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line:
+                return
+            if not line.strip():
+                continue
+            try:
+                response = self.server.control.handle(json.loads(line))
+            except ValueError as e:
+                response = {"ok": False, "error": f"JSON non valido: {e}"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def run_control_plane(base_dir: str, socket_path: str = DEFAULT_SOCKET, apply: bool = True) -> int:
+    """Entrypoint CLI: carica api.yaml, legge lo snapshot e serve il socket fino a Ctrl-C."""
+    control = ControlPlane(base_dir, apply=apply)
+    control.load()
+    control.refresh_snapshot()
+    threading.Thread(target=control.committer, name="committer", daemon=True).start()
+
+    path = Path(socket_path)
+    path.unlink(missing_ok=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        server = _Server(str(path), _Handler)
+    except OSError as e:
+        print(f"ERR: impossibile aprire il socket {path}: {e}", file=sys.stderr)
+        return 2
+    server.control = control
+    # solo root e il gruppo del processo possono aprire o chiudere porte
+    os.chmod(path, 0o660)
+    print(f"Control plane in ascolto su {path} ({len(control.entries)} servizi API)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        server.server_close()
+        path.unlink(missing_ok=True)
+        nft_exec.save_metrics(str(control.base))
+    return 0
@@ -0,0 +1,233 @@
+"""
+docker_discovery.py
+
+Servizi dalle porte pubblicate dei container Docker, via Docker Engine API sul socket unix.
+
+1. una sola lista iniziale (`GET /containers/json`);
+2. poi solo eventi (`GET /events`, stream JSON): start -> inspect del container,
+   die/destroy -> rimozione delle sue porte. Nessun polling.
+3. le porte pubblicate diventano voci di config/services.d/docker.yaml (file generato,
+   caricato in modo incrementale da config.load_service_shards); a ogni modifica viene
+   lanciato `firewall_ai.py --atomic`, che con il lock coalescente assorbe le raffiche
+   di eventi (es. `docker compose up`) in pochi reconcile.
+
+Nome del servizio: label `firewall_ai.name`, poi `com.docker.compose.service`, poi il nome
+del container. Con la label `firewall_ai.expose=false` il container viene ignorato.
+Le porte pubblicate solo su loopback (127.0.0.1, ::1) non sono raggiungibili da fuori e
+vengono saltate.
+"""
+
+import http.client
+import json
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+from config import SERVICES_DIR
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+SHARD_NAME = "docker.yaml"
+NAME_LABELS = ("firewall_ai.name", "com.docker.compose.service")
+EXPOSE_LABEL = "firewall_ai.expose"
+_STOP_EVENTS = ("die", "destroy")     # `kill` no: un segnale non ferma necessariamente il container
+_LOOPBACK = ("127.0.0.1", "::1")
+
+try:
+    import yaml
+except Exception:
+    yaml = None
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection su socket unix (l'host serve solo per l'header Host)."""
+
+    def __init__(self, path: str = DOCKER_SOCKET, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+def _get_json(path: str, socket_path: str = DOCKER_SOCKET, timeout: float = 10):
+    conn = UnixHTTPConnection(socket_path, timeout=timeout)
+    try:
+        conn.request("GET", path)
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f"Docker API {path}: HTTP {resp.status} {body[:200]!r}")
+        return json.loads(body)
+    finally:
+        conn.close()
+
+
+def _service_name(container_name: str, labels: Dict) -> str:
+    for label in NAME_LABELS:
+        if labels.get(label):
+            return str(labels[label])
+    return container_name.lstrip("/") or "docker"
+
+
+def _entries(name: str, labels: Dict, ports: Iterable[Tuple[str, int, str]]) -> List[Dict]:
+    """Voci di servizio da (host ip, porta pubblicata, protocollo), senza duplicati IPv4/IPv6."""
+    if str(labels.get(EXPOSE_LABEL, "")).lower() in ("false", "0", "no"):
+        return []
+    seen = {}
+    for ip, port, proto in ports:
+        if ip in _LOOPBACK or proto not in ("tcp", "udp") or not port:
+            continue
+        seen.setdefault((int(port), proto), {"name": name, "port": int(port), "protocol": proto})
+    return [seen[k] for k in sorted(seen)]
+
+
+def entries_from_summary(c: Dict) -> List[Dict]:
+    """Voci da un elemento di `GET /containers/json`."""
+    labels = c.get("Labels") or {}
+    name = _service_name((c.get("Names") or [""])[0], labels)
+    ports = ((p.get("IP", ""), p.get("PublicPort"), p.get("Type")) for p in c.get("Ports") or [])
+    return _entries(name, labels, ports)
+
+
+def entries_from_inspect(c: Dict) -> List[Dict]:
+    """Voci da `GET /containers/<id>/json` (NetworkSettings.Ports: {"80/tcp": [{HostIp, HostPort}]})."""
+    labels = (c.get("Config") or {}).get("Labels") or {}
+    name = _service_name(c.get("Name", ""), labels)
+    ports = []
+    for spec, bindings in ((c.get("NetworkSettings") or {}).get("Ports") or {}).items():
+        proto = spec.split("/", 1)[1] if "/" in spec else "tcp"
+        for b in bindings or []:
+            if str(b.get("HostPort", "")).isdigit():
+                ports.append((b.get("HostIp", ""), int(b["HostPort"]), proto))
+    return _entries(name, labels, ports)
+
+
+class DockerDiscovery:
+    """Stato {container id: voci} mantenuto dagli eventi e scritto in services.d/docker.yaml."""
+
+    def __init__(self, base_dir: str, socket_path: str = DOCKER_SOCKET, apply: bool = True):
+        self.base = Path(base_dir).expanduser().resolve()
+        self.socket_path = socket_path
+        self.apply = apply
+        self.containers: Dict[str, List[Dict]] = {}
+        self._runs: List[subprocess.Popen] = []
+
+    @property
+    def shard_path(self) -> Path:
+        return self.base / SERVICES_DIR / SHARD_NAME
+
+    def services(self) -> List[Dict]:
+        """Voci desiderate, ordinate e senza porte ripetute tra container."""
+        merged = {}
+        for cid in sorted(self.containers):
+            for e in self.containers[cid]:
+                merged.setdefault((e["protocol"], e["port"]), e)
+        return [merged[k] for k in sorted(merged)]
+
+    def resync(self) -> None:
+        """Lista completa dei container in esecuzione (avvio e riconnessione)."""
+        containers = _get_json("/containers/json", self.socket_path)
+        self.containers = {c["Id"]: entries_from_summary(c) for c in containers}
+
+    def handle_event(self, event: Dict) -> bool:
+        """Aggiorna lo stato con un evento container; True se le voci desiderate sono cambiate."""
+        if event.get("Type") != "container":
+            return False
+        action = str(event.get("Action") or event.get("status") or "")
+        cid = (event.get("Actor") or {}).get("ID") or event.get("id")
+        if not cid:
+            return False
+        before = self.containers.get(cid)
+        if action == "start":
+            try:
+                entries = entries_from_inspect(_get_json(f"/containers/{quote(cid)}/json", self.socket_path))
+            except Exception as e:
+                print(f"WARN: inspect del container {cid[:12]} fallito: {e}", file=sys.stderr)
+                return False
+            self.containers[cid] = entries
+        elif action in _STOP_EVENTS:
+            self.containers.pop(cid, None)
+        else:
+            return False
+        return before != self.containers.get(cid)
+
+    def write_shard(self) -> bool:
+        """Scrive docker.yaml solo se il contenuto cambia (l'mtime guida il reload incrementale)."""
+        if yaml is None:
+            print("ERR: PyYAML non installato. Installa con: sudo apt install python3-yaml OR pip3 install pyyaml", file=sys.stderr)
+            return False
+        text = "# generato da docker_discovery.py: non modificare a mano\n" + \
+               yaml.safe_dump({"allowed_services": self.services()}, sort_keys=False)
+        path = self.shard_path
+        try:
+            if path.read_text(encoding="utf-8") == text:
+                return False
+        except OSError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(text, encoding="utf-8")
+        tmp.replace(path)
+        return True
+
+    def trigger_apply(self) -> None:
+        """Lancia un apply senza attenderlo: i trigger ravvicinati vengono fusi dal lock coalescente."""
+        self._runs = [p for p in self._runs if p.poll() is None]
+        if not self.apply:
+            return
+        entry = Path(__file__).resolve().parent / "firewall_ai.py"
+        self._runs.append(subprocess.Popen([sys.executable, str(entry), "--atomic", "--base-dir", str(self.base)]))
+
+    def publish(self) -> None:
+        if self.write_shard():
+            print(f"Docker: {len(self.services())} porte pubblicate -> {self.shard_path.name}")
+            self.trigger_apply()
+
+    def events(self, since: int):
+        """Stream di `GET /events` (una riga JSON per evento) a partire da `since`."""
+        filters = quote(json.dumps({"type": ["container"], "event": ["start", *_STOP_EVENTS]}))
+        conn = UnixHTTPConnection(self.socket_path)
+        try:
+            conn.request("GET", f"/events?since={since}&filters={filters}")
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise RuntimeError(f"Docker API /events: HTTP {resp.status}")
+            while True:
+                line = resp.readline()
+                if not line:
+                    return
+                if line.strip():
+                    yield json.loads(line)
+        finally:
+            conn.close()
+
+    def run(self, retry_delay: float = 5) -> int:
+        """Ciclo: lista iniziale, poi eventi; a ogni riconnessione una nuova lista completa."""
+        while True:
+            try:
+                # gli eventi partono da prima della lista: nessun cambio di stato può andare perso
+                since = int(time.time())
+                self.resync()
+                self.publish()
+                for event in self.events(since):
+                    if self.handle_event(event):
+                        self.publish()
+                print("WARN: stream eventi Docker chiuso, mi riconnetto", file=sys.stderr)
+            except KeyboardInterrupt:
+                return 0
+            except (OSError, RuntimeError, ValueError, http.client.HTTPException) as e:
+                print(f"WARN: Docker API non disponibile ({self.socket_path}): {e}", file=sys.stderr)
+            time.sleep(retry_delay)
+
+
+def run_docker_discovery(base_dir: str, socket_path: str = DOCKER_SOCKET, apply: bool = True) -> int:
+    """Entrypoint CLI."""
+    return DockerDiscovery(base_dir, socket_path=socket_path, apply=apply).run()
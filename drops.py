@@ -0,0 +1,357 @@
+"""
+drops.py
+
+Campionamento dei pacchetti scartati dalla policy drop della chain input.
+
+Con `rules: drop_log: true` l'ultima regola della chain input manda al gruppo NFLOG
+`drop_log_group` al più `drop_log_rate` pacchetti (rules_generator.drop_log_rule), troncati
+a DROP_LOG_SNAPLEN byte: bastano gli header IP e le porte.
+
+`firewall_ai.py drops` legge il gruppo direttamente via netlink (NETLINK_NETFILTER, nessuna
+dipendenza esterna) e aggrega i pacchetti in tre sketch Space-Saving a memoria limitata
+(SKETCH_SIZE voci ciascuno): sorgenti, porte probe (proto/porta) e protocolli.
+Nessun pacchetto viene scritto su disco: ogni SAVE_EVERY secondi si salva solo il riassunto
+del giorno in data/drops/<AAAA-MM-GG>.json (gli ultimi KEEP_DAYS giorni), letto dal digest
+Telegram con top_drops().
+
+Space-Saving: con k contatori, ogni elemento con frequenza > totale/k è sicuramente
+presente; il conteggio è una sovrastima di al più `error` (il minimo al momento dell'ingresso).
+"""
+
+import errno
+import ipaddress
+import json
+import os
+import socket
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from rules_generator import DEFAULT_RULES, DROP_LOG_SNAPLEN, rules_config
+
+DROPS_DIR = "data/drops"
+SKETCH_SIZE = 256
+SAVE_EVERY = 60             # secondi tra due salvataggi del riassunto
+KEEP_DAYS = 7
+RCVBUF = 1 << 20
+
+# netlink / nfnetlink_log (linux/netfilter/nfnetlink_log.h)
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_ULOG = 4
+NFULNL_MSG_PACKET = NFNL_SUBSYS_ULOG << 8
+NFULNL_MSG_CONFIG = NFNL_SUBSYS_ULOG << 8 | 1
+NFULA_CFG_CMD = 1
+NFULA_CFG_MODE = 2
+NFULNL_CFG_CMD_BIND = 1
+NFULNL_COPY_PACKET = 2
+NFULA_PAYLOAD = 9
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 1
+NLM_F_ACK = 4
+_NLMSGHDR = struct.Struct("=IHHII")
+_NLATTR = struct.Struct("=HH")
+_NFGENMSG_LEN = 4
+_NLA_TYPE_MASK = 0x3FFF
+
+_PROTOCOLS = {1: "icmp", 6: "tcp", 17: "udp", 58: "icmpv6", 132: "sctp"}
+_PORT_PROTOCOLS = (6, 17, 132)
+
+
+class SpaceSaving:
+    """Top-k approssimato (Space-Saving) con al più `capacity` contatori."""
+
+    __slots__ = ("capacity", "counts", "errors", "total")
+
+    def __init__(self, capacity: int = SKETCH_SIZE):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.total = 0
+
+    def add(self, item: str, weight: int = 1) -> None:
+        self.total += weight
+        if item in self.counts:
+            self.counts[item] += weight
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = weight
+            self.errors[item] = 0
+            return
+        # il nuovo elemento prende il posto del minimo ed eredita il suo conteggio come errore
+        victim = min(self.counts, key=self.counts.__getitem__)
+        floor = self.counts.pop(victim)
+        self.errors.pop(victim)
+        self.counts[item] = floor + weight
+        self.errors[item] = floor
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        """[(elemento, conteggio, errore massimo)] dal più frequente."""
+        items = sorted(self.counts.items(), key=lambda kv: (-kv[1], kv[0]))[:n]
+        return [(item, count, self.errors[item]) for item, count in items]
+
+    def to_json(self) -> Dict:
+        return {"total": self.total, "top": [list(t) for t in self.top(self.capacity)]}
+
+    @classmethod
+    def from_json(cls, data: Dict, capacity: int = SKETCH_SIZE) -> "SpaceSaving":
+        sketch = cls(capacity)
+        for item, count, error in (data or {}).get("top", [])[:capacity]:
+            sketch.counts[item] = int(count)
+            sketch.errors[item] = int(error)
+        sketch.total = int((data or {}).get("total", sum(sketch.counts.values())))
+        return sketch
+
+    def merge(self, other: "SpaceSaving") -> None:
+        """Unione approssimata (somma dei conteggi), poi troncamento a `capacity`."""
+        self.total += other.total
+        for item, count in other.counts.items():
+            self.counts[item] = self.counts.get(item, 0) + count
+            self.errors[item] = self.errors.get(item, 0) + other.errors[item]
+        for item, _, _ in self.top(len(self.counts))[self.capacity:]:
+            del self.counts[item], self.errors[item]
+
+
+def parse_packet(payload: bytes) -> Optional[Tuple[str, str, Optional[int]]]:
+    """(sorgente, protocollo, porta di destinazione o None) dall'header IP; None se illeggibile."""
+    if not payload:
+        return None
+    version = payload[0] >> 4
+    if version == 4 and len(payload) >= 20:
+        ihl = (payload[0] & 0x0F) * 4
+        proto = payload[9]
+        src = str(ipaddress.IPv4Address(payload[12:16]))
+        l4 = payload[ihl:]
+        # i frammenti successivi al primo non hanno l'header L4
+        if struct.unpack("!H", payload[6:8])[0] & 0x1FFF:
+            l4 = b""
+    elif version == 6 and len(payload) >= 40:
+        proto = payload[6]
+        src = str(ipaddress.IPv6Address(payload[8:24]))
+        l4 = payload[40:]       # extension header non seguiti: restano senza porta
+    else:
+        return None
+    port = struct.unpack("!H", l4[2:4])[0] if proto in _PORT_PROTOCOLS and len(l4) >= 4 else None
+    return src, _PROTOCOLS.get(proto, str(proto)), port
+
+
+def _attr(kind: int, data: bytes) -> bytes:
+    raw = _NLATTR.pack(_NLATTR.size + len(data), kind) + data
+    return raw + b"\0" * (-len(raw) % 4)
+
+
+def _config_message(group: int, attrs: bytes, seq: int) -> bytes:
+    # nfgenmsg: famiglia AF_UNSPEC, versione 0, res_id = gruppo (big endian)
+    body = struct.pack("=BB", socket.AF_UNSPEC, 0) + struct.pack("!H", group) + attrs
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), NFULNL_MSG_CONFIG, NLM_F_REQUEST | NLM_F_ACK, seq, 0) + body
+
+
+def _messages(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """(tipo, payload) dei messaggi netlink contenuti in un datagramma."""
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, kind, _, _, _ = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            return
+        yield kind, data[offset + _NLMSGHDR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def _attrs(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    offset = 0
+    while offset + _NLATTR.size <= len(data):
+        length, kind = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            return
+        yield kind & _NLA_TYPE_MASK, data[offset + _NLATTR.size:offset + length]
+        offset += (length + 3) & ~3
+
+
+def open_nflog(group: int, copy_range: int = DROP_LOG_SNAPLEN) -> socket.socket:
+    """Socket netlink legato al gruppo NFLOG `group`. Solleva OSError (es. EPERM senza NET_ADMIN)."""
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+        sock.bind((0, 0))
+        requests = [_attr(NFULA_CFG_CMD, bytes([NFULNL_CFG_CMD_BIND])),
+                    _attr(NFULA_CFG_MODE, struct.pack("!IBB", copy_range, NFULNL_COPY_PACKET, 0))]
+        for seq, attrs in enumerate(requests, 1):
+            sock.send(_config_message(group, attrs, seq))
+            for kind, payload in _messages(sock.recv(65536)):
+                if kind == NLMSG_ERROR:
+                    code = -struct.unpack_from("=i", payload)[0]
+                    if code:
+                        raise OSError(code, f"configurazione NFLOG gruppo {group}: {os.strerror(code)}")
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+def packets(sock: socket.socket) -> Iterator[bytes]:
+    """Payload (dall'header IP) dei pacchetti ricevuti sul gruppo; gli overrun vengono contati e saltati."""
+    while True:
+        try:
+            data = sock.recv(65536)
+        except OSError as e:
+            # ENOBUFS: il kernel ha scartato messaggi perché il consumer era indietro; si continua
+            if e.errno == errno.ENOBUFS:
+                yield b""
+                continue
+            raise
+        for kind, body in _messages(data):
+            if kind != NFULNL_MSG_PACKET:
+                continue
+            for attr, value in _attrs(body[_NFGENMSG_LEN:]):
+                if attr == NFULA_PAYLOAD:
+                    yield value
+
+
+class DropStats:
+    """Riassunto dei drop di un giorno: tre sketch e i contatori dei pacchetti."""
+
+    def __init__(self, day: str, capacity: int = SKETCH_SIZE):
+        self.day = day
+        self.sources = SpaceSaving(capacity)
+        self.ports = SpaceSaving(capacity)
+        self.protocols = SpaceSaving(capacity)
+        self.unparsed = 0
+        self.overruns = 0
+
+    def observe(self, payload: bytes) -> None:
+        if not payload:
+            self.overruns += 1
+            return
+        parsed = parse_packet(payload)
+        if parsed is None:
+            self.unparsed += 1
+            return
+        src, proto, port = parsed
+        self.sources.add(src)
+        self.protocols.add(proto)
+        if port is not None:
+            self.ports.add(f"{proto}/{port}")
+
+    def to_json(self) -> Dict:
+        return {"day": self.day, "updated": time.time(), "unparsed": self.unparsed, "overruns": self.overruns,
+                "sources": self.sources.to_json(), "ports": self.ports.to_json(),
+                "protocols": self.protocols.to_json()}
+
+    @classmethod
+    def from_json(cls, data: Dict, capacity: int = SKETCH_SIZE) -> "DropStats":
+        stats = cls(data.get("day", ""), capacity)
+        stats.sources = SpaceSaving.from_json(data.get("sources"), capacity)
+        stats.ports = SpaceSaving.from_json(data.get("ports"), capacity)
+        stats.protocols = SpaceSaving.from_json(data.get("protocols"), capacity)
+        stats.unparsed = int(data.get("unparsed", 0))
+        stats.overruns = int(data.get("overruns", 0))
+        return stats
+
+
+def _today(now: Optional[float] = None) -> str:
+    return time.strftime("%Y-%m-%d", time.localtime(now))
+
+
+def _day_path(base: Path, day: str) -> Path:
+    return base / DROPS_DIR / f"{day}.json"
+
+
+def load_day(base: Path, day: str) -> Optional[DropStats]:
+    try:
+        return DropStats.from_json(json.loads(_day_path(base, day).read_text(encoding="utf-8")))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"WARN: riassunto dei drop {day} illeggibile: {e}", file=sys.stderr)
+        return None
+
+
+def save_day(base: Path, stats: DropStats, keep: int = KEEP_DAYS) -> None:
+    path = _day_path(base, stats.day)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(stats.to_json()), encoding="utf-8")
+    tmp.replace(path)
+    for old in sorted(path.parent.glob("*.json"))[:-keep] if keep > 0 else []:
+        old.unlink(missing_ok=True)
+
+
+def top_drops(base_dir: str, n: int = 5, period: str = "day", now: Optional[float] = None) -> Optional[Dict]:
+    """
+    Top sorgenti, porte e protocolli scartati: {"total", "sources", "ports", "protocols"}
+    (liste di (elemento, conteggio, errore)). period: "day" (oggi), "24h" (ieri e oggi), "all".
+    None se non ci sono riassunti. Solo lettura dei file, nessuna chiamata a nft.
+    """
+    base = Path(base_dir).expanduser().resolve()
+    now = time.time() if now is None else now
+    if period == "all":
+        days = [p.stem for p in sorted((base / DROPS_DIR).glob("*.json"))]
+    elif period == "24h":
+        days = [_today(now - 86400), _today(now)]
+    else:
+        days = [_today(now)]
+    merged = None
+    for day in days:
+        stats = load_day(base, day)
+        if stats is None:
+            continue
+        if merged is None:
+            merged = stats
+            continue
+        merged.sources.merge(stats.sources)
+        merged.ports.merge(stats.ports)
+        merged.protocols.merge(stats.protocols)
+    if merged is None or not merged.sources.total:
+        return None
+    return {"total": merged.sources.total, "sources": merged.sources.top(n),
+            "ports": merged.ports.top(n), "protocols": merged.protocols.top(n)}
+
+
+def format_drops(summary: Optional[Dict]) -> str:
+    if not summary:
+        return "Nessun drop campionato.\n"
+    lines = [f"Drop campionati: {summary['total']}"]
+    for title, key in (("Sorgenti", "sources"), ("Porte", "ports"), ("Protocolli", "protocols")):
+        lines.append(f"{title}:")
+        lines += [f"  {item:<40} {count:>10}" + (f"  (±{error})" if error else "")
+                  for item, count, error in summary[key]]
+    return "\n".join(lines) + "\n"
+
+
+def run_drops(base_dir: str, group: Optional[int] = None, save_every: float = SAVE_EVERY) -> int:
+    """Entrypoint CLI: consumer a lunga vita del gruppo NFLOG di drop_log."""
+    base = Path(base_dir).expanduser().resolve()
+    cfg = rules_config(str(base))
+    if group is None:
+        group = int(cfg.get("drop_log_group", DEFAULT_RULES["drop_log_group"]))
+    if not cfg.get("drop_log"):
+        print("WARN: `rules: drop_log` non è attivo: nessun pacchetto arriverà al gruppo NFLOG", file=sys.stderr)
+    try:
+        sock = open_nflog(group)
+    except OSError as e:
+        print(f"ERR: impossibile leggere il gruppo NFLOG {group}: {e}", file=sys.stderr)
+        return 2
+    # un riavvio nello stesso giorno riparte dal riassunto salvato
+    stats = load_day(base, _today()) or DropStats(_today())
+    sock.settimeout(save_every)
+    print(f"Campionamento dei drop dal gruppo NFLOG {group} -> {base / DROPS_DIR}")
+    last_save = time.monotonic()
+    try:
+        while True:
+            try:
+                for payload in packets(sock):
+                    stats.observe(payload)
+                    if time.monotonic() - last_save >= save_every:
+                        break
+            except socket.timeout:
+                pass
+            save_day(base, stats)
+            last_save = time.monotonic()
+            if stats.day != _today():
+                stats = DropStats(_today())
+    except KeyboardInterrupt:
+        save_day(base, stats)
+        return 0
+    finally:
+        sock.close()
@@ -0,0 +1,263 @@
+"""
+feeds.py
+
+Ingestione incrementale di blocklist (feed threat-intel) da file locali.
+
+Pipeline:
+1. i file dei feed vengono letti in streaming, riga per riga (commenti `#`/`;` ignorati);
+2. ogni voce è normalizzata in un intervallo e impacchettata in un solo intero
+   (start << bits | end), ordinata e fusa con gli adiacenti/sovrapposti;
+3. il risultato viene confrontato con l'ultimo snapshot in data/feeds/
+   (IPv4 binario array('Q'), IPv6 esadecimale) e si applicano solo le differenze;
+4. le differenze vanno al kernel in transazioni `nft -f` a blocchi di chunk_size
+   elementi (prima tutte le rimozioni, poi le aggiunte: negli interval set due
+   intervalli sovrapposti non possono coesistere).
+
+I set gestiti sono @blocklist_v4 e @blocklist_v6 (table inet filter), separati dai
+set deny_* generati da rules_generator così che il rendering non tocchi gli elementi
+caricati dai feed.
+
+Esempio services.yaml:
+```yaml
+blocklist_feeds:
+  - /var/lib/firewall_ai/feeds/firehol_level1.netset
+  - config/feeds/local_blocklist.txt
+```
+"""
+
+import ipaddress
+import subprocess
+import sys
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import nft_exec
+from addresses import format_interval
+from nft_utils import _write_and_apply_nft, ensure_set, load_live_object
+from ruleset import Rule
+
+FEED_SETS = {4: ("blocklist_v4", "ipv4_addr", "ip"), 6: ("blocklist_v6", "ipv6_addr", "ip6")}
+SNAPSHOT_DIR = "data/feeds"
+DEFAULT_CHUNK_SIZE = 4096
+
+_BITS = {4: 32, 6: 128}
+
+
+def _pack(start: int, end: int, version: int) -> int:
+    return (start << _BITS[version]) | end
+
+
+def _unpack(key: int, version: int):
+    bits = _BITS[version]
+    return key >> bits, key & ((1 << bits) - 1)
+
+
+def iter_feed_entries(paths: Iterable[str]):
+    """Genera le voci grezze dei feed, una riga alla volta (nessun file letto per intero)."""
+    for p in paths:
+        try:
+            with open(p, "r", encoding="utf-8", errors="replace") as fh:
+                for line in fh:
+                    text = line.split("#", 1)[0].split(";", 1)[0].strip()
+                    if text:
+                        # alcuni feed hanno colonne aggiuntive separate da spazi
+                        yield text.split()[0]
+        except OSError as e:
+            print(f"WARN: feed non leggibile {p}: {e}", file=sys.stderr)
+
+
+def normalize(entries: Iterable[str]) -> Dict[int, List[int]]:
+    """
+    Ritorna {4: [chiavi], 6: [chiavi]} ordinate, deduplicate e fuse.
+    Ogni chiave impacchetta un intervallo (vedi _pack); le voci non valide sono contate e saltate.
+    """
+    raw = {4: [], 6: []}
+    invalid = 0
+    for text in entries:
+        try:
+            net = ipaddress.ip_network(text, strict=False)
+        except ValueError:
+            invalid += 1
+            continue
+        v = net.version
+        raw[v].append(_pack(int(net.network_address), int(net.broadcast_address), v))
+    if invalid:
+        print(f"WARN: {invalid} voci non valide ignorate nei feed", file=sys.stderr)
+
+    out = {}
+    for v, keys in raw.items():
+        keys.sort()
+        merged = []
+        cur_start = cur_end = None
+        for k in keys:
+            start, end = _unpack(k, v)
+            if cur_start is None:
+                cur_start, cur_end = start, end
+            elif start <= cur_end + 1:
+                if end > cur_end:
+                    cur_end = end
+            else:
+                merged.append(_pack(cur_start, cur_end, v))
+                cur_start, cur_end = start, end
+        if cur_start is not None:
+            merged.append(_pack(cur_start, cur_end, v))
+        out[v] = merged
+    return out
+
+
+def _snapshot_path(base: Path, version: int) -> Path:
+    suffix = "v4.bin" if version == 4 else "v6.txt"
+    return base / SNAPSHOT_DIR / f"blocklist.{suffix}"
+
+
+def load_snapshot(base: Path, version: int) -> Optional[set]:
+    """Ritorna l'insieme delle chiavi dell'ultimo snapshot o None se assente/illeggibile."""
+    path = _snapshot_path(base, version)
+    if not path.exists():
+        return None
+    try:
+        if version == 4:
+            arr = array("Q")
+            arr.frombytes(path.read_bytes())
+            return set(arr)
+        return {int(line, 16) for line in path.read_text(encoding="ascii").split()}
+    except Exception as e:
+        print(f"WARN: snapshot {path} illeggibile, ricarico tutto: {e}", file=sys.stderr)
+        return None
+
+
+def save_snapshot(base: Path, version: int, keys: List[int]) -> None:
+    path = _snapshot_path(base, version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    if version == 4:
+        tmp.write_bytes(array("Q", keys).tobytes())
+    else:
+        tmp.write_text("\n".join(format(k, "x") for k in keys), encoding="ascii")
+    tmp.replace(path)
+
+
+def _chunks(items: List, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _ensure_feed_set(version: int) -> bool:
+    """Crea set e regola di drop se mancanti. Ritorna True se il set è stato (ri)creato."""
+    name, addr_type, family = FEED_SETS[version]
+    created = ensure_set(name, set_type=addr_type, flags="interval")
+    rule = Rule.parse(f"{family} saddr @{name} drop")
+    if not load_live_object("chain", "input").has_rule("input", rule):
+        try:
+            # in testa alla chain: il traffico bloccato non attraversa le altre regole
+            # insert non è idempotente: nessun retry
+            nft_exec.run(["insert", "rule", "inet", "filter", "input"] + rule.text.split()
+                         + ["comment", f'"{rule.comment}"'], retries=0)
+        except subprocess.CalledProcessError:
+            pass
+    return created
+
+
+def apply_delta(version: int, added: List[int], removed: List[int], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                flush: bool = False, dry_run: bool = False) -> int:
+    """
+    Applica rimozioni e aggiunte in transazioni da chunk_size elementi.
+    Con flush=True il set viene svuotato nella stessa transazione del primo blocco di aggiunte.
+    Ritorna il numero di transazioni.
+    """
+    name = FEED_SETS[version][0]
+    transactions = 0
+    pending_flush = flush
+    for verb, keys in (("delete", removed), ("add", added)):
+        for chunk in _chunks(keys, chunk_size):
+            elems = ", ".join(format_interval(*_unpack(k, version), version) for k in chunk)
+            script = f"{verb} element inet filter {name} {{ {elems} }}\n"
+            if pending_flush and verb == "add":
+                script = f"flush set inet filter {name}\n" + script
+                pending_flush = False
+            if not dry_run:
+                _write_and_apply_nft(script)
+            transactions += 1
+    if pending_flush:
+        if not dry_run:
+            _write_and_apply_nft(f"flush set inet filter {name}\n")
+        transactions += 1
+    return transactions
+
+
+def ingest_feeds(base_dir: str, paths: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 full: bool = False, dry_run: bool = False) -> Dict:
+    """
+    Esegue la pipeline completa. full=True ignora lo snapshot e ricarica tutto;
+    lo stesso avviene se lo snapshot manca o se il set è stato appena creato.
+    Se l'applicazione fallisce a metà lo snapshot viene rimosso: il run successivo
+    ricarica tutto invece di calcolare un delta su uno stato non più noto.
+    Ritorna statistiche per famiglia: {4: {"total", "added", "removed", "transactions"}, 6: {...}}.
+    """
+    base = Path(base_dir).expanduser().resolve()
+    resolved = [str(p if Path(p).is_absolute() else base / p) for p in paths]
+    current = normalize(iter_feed_entries(resolved))
+
+    stats = {}
+    for version, keys in current.items():
+        previous = None if full else load_snapshot(base, version)
+        if not dry_run and _ensure_feed_set(version):
+            previous = None
+        reload_all = previous is None
+
+        new_keys = set(keys)
+        added = sorted(new_keys - previous) if not reload_all else keys
+        removed = sorted(previous - new_keys) if not reload_all else []
+        try:
+            transactions = apply_delta(version, added, removed, chunk_size=chunk_size,
+                                       flush=reload_all, dry_run=dry_run)
+        except Exception:
+            _snapshot_path(base, version).unlink(missing_ok=True)
+            raise
+        if not dry_run:
+            save_snapshot(base, version, keys)
+        stats[version] = {"total": len(keys), "added": len(added), "removed": len(removed),
+                          "transactions": transactions}
+    return stats
+
+
+def feeds_changed(base_dir: str, paths: List[str]) -> bool:
+    """
+    Controllo economico (solo stat): True se uno dei feed è più recente degli snapshot
+    o se gli snapshot mancano. Evita di rileggere i feed a ogni run di apply.
+    """
+    base = Path(base_dir).expanduser().resolve()
+    snapshots = [_snapshot_path(base, v) for v in FEED_SETS]
+    try:
+        oldest = min(p.stat().st_mtime for p in snapshots)
+    except OSError:
+        return True
+    for p in paths:
+        path = Path(p) if Path(p).is_absolute() else base / p
+        try:
+            if path.stat().st_mtime > oldest:
+                return True
+        except OSError:
+            continue
+    return False
+
+
+def run_ingest(base_dir: str, paths: List[str], chunk_size: int = DEFAULT_CHUNK_SIZE,
+               full: bool = False, dry_run: bool = False) -> int:
+    """Entrypoint CLI."""
+    if not paths:
+        print("ERR: nessun feed configurato (blocklist_feeds in services.yaml)", file=sys.stderr)
+        return 2
+    start = time.monotonic()
+    try:
+        stats = ingest_feeds(base_dir, paths, chunk_size=chunk_size, full=full, dry_run=dry_run)
+    except Exception as e:
+        print(f"ERR: ingestione feed fallita: {e}", file=sys.stderr)
+        return 1
+    for version, st in stats.items():
+        print(f"@{FEED_SETS[version][0]}: {st['total']} intervalli, +{st['added']} -{st['removed']} "
+              f"in {st['transactions']} transazioni")
+    print(f"Feed ingeriti in {time.monotonic() - start:.2f}s")
+    return 0
@@ -3,87 +3,163 @@
 Entrypoint minimale: delega a cli.run_cli()
 Mantieni questo file piccolo: tutta la logica è nei moduli.
 """
-import os, sys, atexit, logging
+import os, sys, atexit, logging, fcntl
 from pathlib import Path
-from cli import run_cli
+from cli import build_parser, is_read_only, run_cli
+from config import default_lock_path
 import errno
 
-def _default_lock_path():
-    # se siamo root, usa /var/run
-    if os.geteuid() == 0:
-        return "/var/run/firewall_ai.lock"
-    # prova XDG_RUNTIME_DIR
-    xdg = os.environ.get("XDG_RUNTIME_DIR")
-    if xdg:
-        return os.path.join(xdg, "firewall_ai.lock")
-    # prova /run/user/<uid>
-    run_user = f"/run/user/{os.geteuid()}"
-    if os.path.isdir(run_user):
-        return os.path.join(run_user, "firewall_ai.lock")
-    # fallback su /tmp
-    return os.path.join("/tmp", f"firewall_ai-{os.geteuid()}.lock")
-
-# --- Lockfile per evitare esecuzioni concorrenti ---
-LOCKFILE = _default_lock_path()
-
-
-def acquire_lock():
+# --- Lock (flock) per evitare esecuzioni concorrenti ---
+# Il lock è tenuto dal kernel sul file descriptor: se il processo muore il lock
+# viene rilasciato automaticamente, quindi non esistono lock "stale".
+# Un trigger di reconcile (apply / --atomic: watchdog, docker, api) che arriva durante un
+# run crea il flag DIRTYFILE ed esce: l'istanza attiva lo consuma ed esegue un solo
+# reconcile aggiuntivo, qualunque sia il numero di trigger arrivati nel frattempo.
+# I comandi espliciti (rollback, ingest, --netns, --flush) non si accodano: attendono il lock.
+LOCKFILE = default_lock_path()
+DIRTYFILE = LOCKFILE + ".dirty"
+
+_lock_fd = None
+
+
+def acquire_lock(block: bool = False) -> bool:
+    """
+    Tenta di acquisire il lock esclusivo senza bloccare (con block=True attende il rilascio).
+    Ritorna True se acquisito, False se un'altra istanza lo detiene.
+    """
+    global _lock_fd
     # crea la directory se necessario (solo per percorsi sotto home/runtime)
     lock_dir = os.path.dirname(LOCKFILE)
     try:
         Path(lock_dir).mkdir(parents=True, exist_ok=True)
     except Exception:
-        # se non possiamo creare la dir, continueremo e tenteremo la creazione atomica del file
         pass
 
-    pid = str(os.getpid()).encode("utf-8")
-    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
     try:
-        fd = os.open(LOCKFILE, flags, 0o644)
-        with os.fdopen(fd, "wb") as f:
-            f.write(pid)
+        fd = os.open(LOCKFILE, os.O_RDWR | os.O_CREAT, 0o644)
     except OSError as e:
-        if e.errno == errno.EEXIST:
-            # lock già presente: leggi pid e verifica se il processo esiste
-            try:
-                existing = Path(LOCKFILE).read_text().strip()
-                if existing.isdigit():
-                    existing_pid = int(existing)
-                    # se il processo non esiste, rimuovi il lock e riprova
-                    try:
-                        os.kill(existing_pid, 0)
-                        print("Lockfile presente, un'altra istanza è attiva. Esco.")
-                        sys.exit(1)
-                    except OSError:
-                        # processo non esistente: rimuovi lock e ricrea
-                        try:
-                            Path(LOCKFILE).unlink()
-                            # riprova a creare
-                            fd = os.open(LOCKFILE, flags, 0o644)
-                            with os.fdopen(fd, "wb") as f:
-                                f.write(pid)
-                        except Exception:
-                            print("Impossibile acquisire il lockfile. Esco.")
-                            sys.exit(1)
-                else:
-                    print("Lockfile presente ma non valido. Esco.")
-                    sys.exit(1)
-            except Exception:
-                print("Impossibile leggere il lockfile. Esco.")
-                sys.exit(1)
-        else:
-            print(f"Errore creazione lockfile {LOCKFILE}: {e}. Esco.")
-            sys.exit(1)
+        print(f"Errore apertura lockfile {LOCKFILE}: {e}. Esco.")
+        sys.exit(1)
+
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+            return False
+        print(f"Errore lock {LOCKFILE}: {e}. Esco.")
+        sys.exit(1)
 
-    # rimuovi lockfile all'uscita
+    # pid solo a scopo diagnostico: il lock è il flock, non il contenuto del file
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode("utf-8"))
+    _lock_fd = fd
     atexit.register(release_lock)
+    return True
+
 
 def release_lock():
+    # il file non viene rimosso: cancellarlo aprirebbe una race con chi lo sta aprendo
+    global _lock_fd
+    if _lock_fd is None:
+        return
     try:
-        if os.path.exists(LOCKFILE):
-            os.remove(LOCKFILE)
+        # mtime = fine dell'ultimo run: nft_monitor attribuisce a firewall_ai gli eventi appena precedenti
+        os.utime(_lock_fd)
+        fcntl.flock(_lock_fd, fcntl.LOCK_UN)
+        os.close(_lock_fd)
     except Exception:
         pass
+    _lock_fd = None
+
+
+def mark_dirty():
+    try:
+        Path(DIRTYFILE).touch()
+    except Exception as e:
+        print(f"WARN: impossibile segnare il run come dirty ({DIRTYFILE}): {e}", file=sys.stderr)
+
+
+def consume_dirty() -> bool:
+    """Test-and-clear atomico del flag dirty (unlink). True se era presente."""
+    try:
+        os.unlink(DIRTYFILE)
+        return True
+    except FileNotFoundError:
+        return False
+    except Exception:
+        return False
+
+
+def _run_once(argv=None) -> int:
+    try:
+        run_cli(argv)
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            return e.code
+        return 0 if e.code is None else 1
+    return 0
+
+
+def _is_reconcile(argv=None) -> bool:
+    """
+    True per i run che si possono accodare: apply semplice o --atomic sulla table locale.
+    rollback, ingest, --netns/--all-netns e --flush hanno un effetto proprio, che il giro
+    aggiuntivo (`apply --atomic`) non sostituisce.
+    """
+    args = build_parser().parse_args(argv)
+    return args.command == "apply" and not (args.netns or args.all_netns or args.flush)
+
+
+def _reconcile_argv(argv=None):
+    """
+    Argomenti del giro aggiuntivo: i trigger accodati (watchdog, docker, api) chiedono un
+    `--atomic` sulla stessa base dir, non la ripetizione del comando di chi tiene il lock
+    (rieseguire `rollback` consumerebbe una generazione in più).
+    """
+    args = build_parser().parse_args(argv)
+    return ["apply", "--atomic", "--base-dir", args.base_dir]
+
+
+def run_coalesced(argv=None) -> int:
+    """
+    Esegue run_cli() sotto lock. Per un reconcile, se il lock è occupato segna il run come dirty
+    ed esce: l'istanza attiva farà un reconcile (--atomic) in più prima di uscire. Un comando
+    esplicito attende invece il rilascio del lock e poi viene eseguito.
+    Ritorna l'exit code del comando richiesto, non quello dei reconcile aggiuntivi.
+    """
+    reconcile = _is_reconcile(argv)
+    if reconcile:
+        # prima il flag, poi il lock: chi rilascia il lock ricontrolla il flag dopo il rilascio,
+        # quindi nessun trigger può andare perso tra i due passi
+        mark_dirty()
+        if not acquire_lock():
+            print("Run in corso in un'altra istanza: trigger accodato (dirty). Esco.")
+            return 0
+    elif not acquire_lock():
+        print("Run in corso in un'altra istanza: attendo il rilascio del lock.", file=sys.stderr)
+        acquire_lock(block=True)
+
+    status = None
+    while True:
+        if status is None:
+            if reconcile:
+                # il run stesso è un reconcile: assorbe i trigger già accodati
+                consume_dirty()
+            status = _run_once(argv)
+        else:
+            consume_dirty()
+            if _run_once(_reconcile_argv(argv)) != 0:
+                logger.warning("reconcile aggiuntivo fallito")
+        if consume_dirty():
+            logger.info("trigger ricevuto durante il run: eseguo un reconcile aggiuntivo")
+            continue
+        release_lock()
+        # un trigger arrivato tra il controllo e il rilascio: riprova a prendere il lock,
+        # se un'altra istanza lo ha già preso sarà lei a gestirlo
+        if not os.path.exists(DIRTYFILE) or not acquire_lock():
+            break
+    return status
 
 # --- Logging resiliente ---
 DEFAULT_LOG_DIR = os.environ.get("FIREWALL_AI_LOG_DIR", "/home/roberto/docker-stacks/firewall_ai/log")
@@ -102,9 +178,10 @@ except Exception:
     sh.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
     logger.addHandler(sh)
 
-# --- Acquisizione lock all'avvio ---
-acquire_lock()
-
 if __name__ == "__main__":
-    run_cli()
+    # plan/dry-run sono in sola lettura: nessun lock, nessun accodamento
+    if is_read_only(build_parser().parse_args()):
+        run_cli()
+    else:
+        sys.exit(run_coalesced())
 
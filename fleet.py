@@ -0,0 +1,240 @@
+"""
+fleet.py
+
+Applicazione parallela dello stesso config/services.yaml su più host.
+
+- Il ruleset di ogni host viene generato localmente con rules_generator, partendo da
+  DEFAULT_RULES + `defaults` + `overrides` dell'host, e inviato come transazione di
+  sostituzione (atomic.build_replace_transaction): flush di table e set e poi il contenuto,
+  così ogni run lascia lo stesso stato invece di accodare regole duplicate.
+- L'invio/applicazione passa da un Transport (SSHTransport in produzione,
+  LocalTransport per i test o per la macchina locale).
+- Gli host vengono processati da un pool di worker limitato; con il rollout canary
+  si applica prima ai canary e si prosegue con gli altri solo se tutti hanno successo.
+
+Esempio config/fleet.yaml:
+```yaml
+defaults:
+  policy: drop
+hosts:
+  - name: node1
+    address: root@10.0.0.11
+    canary: true
+  - name: node2
+    address: root@10.0.0.12
+    overrides:
+      lan_cidr: 10.0.0.0/24
+      extra_services:
+        - name: node-exporter
+          port: 9100
+          protocol: tcp
+```
+"""
+
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import nft_exec
+from config import load_address_lists
+from grants import load_active_services
+from atomic import build_replace_transaction
+from rules_generator import DEFAULT_RULES, build_tables_from_services, rules_config
+
+try:
+    import yaml
+except Exception:
+    yaml = None
+
+DEFAULT_FLEET_PATH = "config/fleet.yaml"
+
+
+class Transport(ABC):
+    """
+    Interfaccia di trasporto: apply() riceve il contenuto nft e lo applica sull'host.
+    Ritorna (ok, output). `outcome` descrive nel riepilogo cosa è successo agli host riusciti.
+    """
+
+    outcome = "applicati"
+
+    @abstractmethod
+    def apply(self, host: Dict, content: str, timeout: float = 60):
+        """Applica `content` su `host`; ritorna (ok, output)."""
+
+
+class SSHTransport(Transport):
+    """Invia il ruleset via stdin a `nft -f -` sull'host remoto (ssh in batch mode)."""
+
+    def __init__(self, ssh_cmd: Optional[List[str]] = None, nft_cmd: Optional[List[str]] = None):
+        self.ssh_cmd = ssh_cmd or ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10"]
+        self.nft_cmd = nft_cmd or ["nft", "-f", "-"]
+
+    def apply(self, host: Dict, content: str, timeout: float = 60):
+        cmd = self.ssh_cmd + [host.get("address") or host["name"]] + self.nft_cmd
+        p = subprocess.run(cmd, input=content, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           text=True, timeout=timeout)
+        return p.returncode == 0, (p.stdout or "").strip() or f"exit {p.returncode}"
+
+
+class LocalTransport(Transport):
+    """
+    Esegue un comando locale passando il ruleset su stdin.
+    Default `nft -c -f -` (solo validazione, via nft_exec); utile nei test e per la macchina locale.
+    """
+
+    def __init__(self, cmd: Optional[List[str]] = None):
+        self.cmd = cmd
+        if cmd is None:
+            # `nft -c` non modifica il kernel
+            self.outcome = "validati (nft -c, nessuna modifica applicata)"
+
+    def apply(self, host: Dict, content: str, timeout: float = 60):
+        if self.cmd is None:
+            try:
+                p = nft_exec.run(["-c", "-f", "-"], input=content, timeout=timeout, retries=0, check=False)
+            except nft_exec.NftTimeout:
+                return False, f"timeout dopo {timeout}s"
+            return p.returncode == 0, (p.stdout + p.stderr).strip() or f"exit {p.returncode}"
+        p = subprocess.run(self.cmd, input=content, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           text=True, timeout=timeout)
+        return p.returncode == 0, (p.stdout or "").strip() or f"exit {p.returncode}"
+
+
+TRANSPORTS = {"ssh": SSHTransport, "local": LocalTransport}
+
+
+def load_fleet(base_dir: str, fleet_path: str = DEFAULT_FLEET_PATH) -> Dict:
+    """
+    Legge config/fleet.yaml. Ritorna {"defaults": {...}, "hosts": [{...}, ...]}.
+    In caso di errore ritorna un inventario vuoto e stampa un avviso.
+    """
+    empty = {"defaults": {}, "hosts": []}
+    fleet_file = Path(base_dir).expanduser().resolve() / fleet_path
+    if not fleet_file.exists():
+        print(f"WARN: fleet file non trovato: {fleet_file}", file=sys.stderr)
+        return empty
+    if yaml is None:
+        print("ERR: PyYAML non installato. Installa con: sudo apt install python3-yaml OR pip3 install pyyaml", file=sys.stderr)
+        return empty
+    try:
+        raw = yaml.safe_load(fleet_file.read_text(encoding="utf-8")) or {}
+    except Exception as e:
+        print(f"ERR: parsing {fleet_file}: {e}", file=sys.stderr)
+        return empty
+
+    hosts = []
+    for item in raw.get("hosts") or []:
+        if not isinstance(item, dict) or not item.get("name"):
+            print(f"WARN: salto host malformato in fleet.yaml: {item}", file=sys.stderr)
+            continue
+        hosts.append(item)
+    return {"defaults": raw.get("defaults") or {}, "hosts": hosts}
+
+
+def render_host_rules(host: Dict, services: List[Dict], defaults: Optional[Dict] = None,
+                      addresses: Optional[Dict] = None, base_cfg: Optional[Dict] = None) -> str:
+    """
+    Genera la transazione nft dell'host: base_cfg (DEFAULT_RULES + `rules:` di services.yaml)
+    <- defaults di fleet.yaml <- overrides dell'host.
+    """
+    cfg = dict(base_cfg or DEFAULT_RULES)
+    cfg.update(defaults or {})
+    overrides = host.get("overrides") or {}
+    cfg.update({k: v for k, v in overrides.items() if k != "extra_services"})
+
+    all_services = list(services)
+    for extra in overrides.get("extra_services") or []:
+        try:
+            proto = (extra.get("protocol") or "tcp").lower()
+            all_services.append({"name": extra.get("name", "unknown"), "port": int(extra["port"]),
+                                 "protocol": proto if proto in ("tcp", "udp") else "tcp"})
+        except Exception:
+            print(f"WARN: salto extra_service malformato per {host['name']}: {extra}", file=sys.stderr)
+
+    # interfacce (flowtable, ingress) dalla cfg dell'host, non da quelle di questa macchina
+    return build_replace_transaction(*build_tables_from_services(all_services, cfg, addresses, local=False))
+
+
+def _apply_host(host: Dict, content: str, transport: Transport, timeout: float) -> Dict:
+    start = time.monotonic()
+    try:
+        ok, output = transport.apply(host, content, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        ok, output = False, f"timeout dopo {timeout}s"
+    except Exception as e:
+        ok, output = False, str(e)
+    return {"host": host["name"], "ok": ok, "seconds": time.monotonic() - start, "output": output}
+
+
+def _apply_batch(hosts: List[Dict], rendered: Dict[str, str], transport: Transport,
+                 workers: int, timeout: float) -> List[Dict]:
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(hosts)))) as pool:
+        futures = [pool.submit(_apply_host, h, rendered[h["name"]], transport, timeout) for h in hosts]
+        return [f.result() for f in futures]
+
+
+def apply_fleet(hosts: List[Dict], services: List[Dict], transport: Transport, defaults: Optional[Dict] = None,
+                workers: int = 8, canary: int = 0, timeout: float = 60,
+                addresses: Optional[Dict] = None, base_cfg: Optional[Dict] = None) -> List[Dict]:
+    """
+    Applica il ruleset su tutti gli host. I canary sono gli host con `canary: true`
+    oppure, se nessuno è marcato, i primi `canary` host. Se un canary fallisce
+    gli host restanti vengono saltati (ok=False, skipped=True).
+    """
+    rendered = {h["name"]: render_host_rules(h, services, defaults, addresses, base_cfg) for h in hosts}
+
+    canaries = [h for h in hosts if h.get("canary")]
+    if not canaries and canary > 0:
+        canaries = hosts[:canary]
+    canary_names = {h["name"] for h in canaries}
+    rest = [h for h in hosts if h["name"] not in canary_names]
+
+    results = _apply_batch(canaries, rendered, transport, workers, timeout)
+    if any(not r["ok"] for r in results):
+        for h in rest:
+            results.append({"host": h["name"], "ok": False, "skipped": True, "seconds": 0.0,
+                            "output": "saltato: canary fallito"})
+        return results
+
+    results += _apply_batch(rest, rendered, transport, workers, timeout)
+    return results
+
+
+def format_results(results: List[Dict], elapsed: Optional[float] = None, outcome: str = Transport.outcome) -> str:
+    lines = []
+    width = max([len(r["host"]) for r in results] + [4])
+    for r in results:
+        status = "SKIP" if r.get("skipped") else ("OK" if r["ok"] else "FAIL")
+        detail = "" if r["ok"] else f"  {r['output'].splitlines()[0] if r['output'] else ''}"
+        lines.append(f"{r['host']:<{width}}  {status:<4}  {r['seconds']:6.2f}s{detail}")
+    ok = sum(1 for r in results if r["ok"])
+    summary = f"Fleet: {ok}/{len(results)} host {outcome}"
+    if elapsed is not None:
+        summary += f" in {elapsed:.2f}s"
+    lines.append(summary)
+    return "\n".join(lines) + "\n"
+
+
+def run_fleet(base_dir: str, transport_name: str = "ssh", workers: int = 8, canary: int = 0,
+              timeout: float = 60, fleet_path: str = DEFAULT_FLEET_PATH) -> int:
+    """Entrypoint CLI: ritorna 0 se tutti gli host sono stati applicati, 1 altrimenti."""
+    fleet = load_fleet(base_dir, fleet_path)
+    if not fleet["hosts"]:
+        print("ERR: nessun host nel fleet", file=sys.stderr)
+        return 2
+    # fleet non prende il lock: nessuna scrittura di data/grants.json
+    services = load_active_services(base_dir, persist=False)
+    transport = TRANSPORTS[transport_name]()
+
+    start = time.monotonic()
+    results = apply_fleet(fleet["hosts"], services, transport, defaults=fleet["defaults"],
+                          workers=workers, canary=canary, timeout=timeout,
+                          addresses=load_address_lists(base_dir), base_cfg=rules_config(base_dir))
+    sys.stdout.write(format_results(results, time.monotonic() - start, transport.outcome))
+    return 0 if all(r["ok"] for r in results) else 1
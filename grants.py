@@ -0,0 +1,94 @@
+"""
+grants.py
+
+Accessi temporanei (servizi con `ttl` o `expires` in services.yaml).
+
+La scadenza è gestita dal kernel: i set sono creati con `flags interval, timeout` e gli
+elementi temporanei vengono aggiunti con `timeout <secondi>s`. Python non fa sweep
+periodici: calcola solo il TTL residuo al momento dell'applicazione.
+
+Per i servizi con `ttl` l'istante di concessione viene salvato in data/grants.json,
+così un riavvio ricalcola il residuo invece di concedere di nuovo l'intera durata.
+La chiave include nome, porta, protocollo e ttl: modificare il ttl in YAML equivale
+a una nuova concessione.
+"""
+
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import load_services
+
+GRANTS_FILE = "data/grants.json"
+
+
+def _grant_key(svc: Dict) -> str:
+    return f"{svc['name']}:{svc['port']}/{svc['protocol']}:{svc['ttl']}"
+
+
+def _load_state(path: Path) -> Dict[str, float]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+        return {k: float(v) for k, v in data.items()}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"WARN: {path} illeggibile, le concessioni ttl ripartono da ora: {e}", file=sys.stderr)
+        return {}
+
+
+def _save_state(path: Path, state: Dict[str, float]) -> None:
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, indent=2, sort_keys=True), encoding="utf-8")
+        tmp.replace(path)
+    except Exception as e:
+        print(f"WARN: impossibile salvare {path}: {e}", file=sys.stderr)
+
+
+def resolve_grants(services: List[Dict], base_dir: Optional[str] = None, now: Optional[float] = None,
+                   persist: bool = True) -> List[Dict]:
+    """
+    Ritorna i servizi attivi: quelli permanenti invariati, quelli temporanei con la chiave
+    "timeout" (secondi residui, intero >= 1). I servizi scaduti vengono esclusi.
+    Con ttl ed expires insieme vale la scadenza più vicina.
+    Con persist=False (plan) data/grants.json non viene modificato.
+    """
+    now = time.time() if now is None else now
+    base = Path(base_dir).expanduser().resolve() if base_dir else Path(__file__).parent.resolve()
+    path = base / GRANTS_FILE
+    state = _load_state(path)
+    new_state = {}
+
+    active = []
+    for svc in services:
+        if "ttl" not in svc and "expires" not in svc:
+            active.append(svc)
+            continue
+
+        deadlines = []
+        if "ttl" in svc:
+            key = _grant_key(svc)
+            granted_at = state.get(key, now)
+            new_state[key] = granted_at
+            deadlines.append(granted_at + svc["ttl"])
+        if "expires" in svc:
+            deadlines.append(svc["expires"])
+
+        remaining = int(min(deadlines) - now)
+        if remaining <= 0:
+            continue
+        active.append(dict(svc, timeout=remaining))
+
+    # le concessioni di servizi rimossi da services.yaml vengono dimenticate
+    if persist and new_state != state:
+        _save_state(path, new_state)
+    return active
+
+
+def load_active_services(base_dir: Optional[str] = None, persist: bool = True) -> List[Dict]:
+    """load_services() + resolve_grants(): i servizi da applicare adesso."""
+    return resolve_grants(load_services(base_dir), base_dir, persist=persist)
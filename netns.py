@@ -0,0 +1,158 @@
+"""
+netns.py
+
+Applicazione del ruleset generato in più network namespace in parallelo.
+
+- discover_netns(): namespace nominati in /run/netns + quelli dei processi (/proc/*/ns/net),
+  deduplicati per inode (più processi condividono lo stesso namespace)
+- resolve_netns(): converte nomi (`ip netns`), path o `pid:<n>` in path del namespace
+- apply_to_netns(): un process pool in cui ogni task entra nel namespace con setns()
+  e applica il ruleset con `nft -f -`; il tempo totale è quello del namespace più lento.
+  Il contenuto è una transazione di sostituzione (atomic.build_replace_transaction, costruita
+  da cli.py): ripetere il run non duplica le regole nei namespace.
+
+I worker sono processi (non thread) perché setns() cambia il namespace dell'intero
+thread chiamante e i processi figli (nft) lo ereditano.
+"""
+
+import ctypes
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import nft_exec
+
+NETNS_RUN_DIR = "/run/netns"
+CLONE_NEWNET = 0x40000000
+
+
+def _ns_key(path: str):
+    st = os.stat(path)
+    return (st.st_dev, st.st_ino)
+
+
+def discover_netns() -> List[Dict]:
+    """
+    Ritorna [{"name": ..., "path": ...}] per ogni namespace di rete distinto.
+    I namespace nominati hanno la precedenza sui path /proc/<pid>/ns/net.
+    """
+    seen = {}
+    run_dir = Path(NETNS_RUN_DIR)
+    if run_dir.is_dir():
+        for p in sorted(run_dir.iterdir()):
+            try:
+                seen.setdefault(_ns_key(str(p)), {"name": p.name, "path": str(p)})
+            except OSError:
+                continue
+
+    try:
+        host_key = _ns_key("/proc/1/ns/net")
+    except OSError:
+        host_key = None
+
+    for p in Path("/proc").glob("[0-9]*/ns/net"):
+        try:
+            key = _ns_key(str(p))
+        except OSError:
+            # processo terminato o permessi insufficienti
+            continue
+        if key in seen:
+            continue
+        pid = p.parent.parent.name
+        name = "host" if key == host_key else f"pid:{pid}"
+        seen[key] = {"name": name, "path": str(p)}
+
+    return sorted(seen.values(), key=lambda n: (n["name"] != "host", n["name"]))
+
+
+def resolve_netns(names: List[str]) -> List[Dict]:
+    """
+    Accetta nomi di `ip netns` (/run/netns/<nome>), path assoluti o `pid:<n>`.
+    I namespace non esistenti vengono segnalati e saltati.
+    """
+    out = []
+    for n in names:
+        if n.startswith("pid:"):
+            path = f"/proc/{n[4:]}/ns/net"
+        elif n.startswith("/"):
+            path = n
+        else:
+            path = os.path.join(NETNS_RUN_DIR, n)
+        if not os.path.exists(path):
+            print(f"WARN: namespace di rete non trovato: {n} ({path})", file=sys.stderr)
+            continue
+        out.append({"name": n, "path": path})
+    return out
+
+
+def _setns(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, "setns"):
+            os.setns(fd, CLONE_NEWNET)
+            return
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.setns(fd, CLONE_NEWNET) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+    finally:
+        os.close(fd)
+
+
+def _apply_in_netns(ns: Dict, content: str, timeout: float) -> Dict:
+    """Eseguito nel worker: entra nel namespace e applica il ruleset."""
+    start = time.monotonic()
+    try:
+        _setns(ns["path"])
+        p = nft_exec.run(["-f", "-"], input=content, timeout=timeout, retries=0, check=False)
+        ok, output = p.returncode == 0, (p.stdout + p.stderr).strip() or f"exit {p.returncode}"
+    except nft_exec.NftTimeout:
+        ok, output = False, f"timeout dopo {timeout}s"
+    except Exception as e:
+        ok, output = False, str(e)
+    return {"netns": ns["name"], "ok": ok, "seconds": time.monotonic() - start, "output": output}
+
+
+def apply_to_netns(namespaces: List[Dict], content: str, workers: Optional[int] = None,
+                   timeout: float = 60) -> List[Dict]:
+    """Applica `content` a ogni namespace con un process pool; ritorna i risultati nell'ordine dato."""
+    if not namespaces:
+        return []
+    workers = workers or min(len(namespaces), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(namespaces)))) as pool:
+        futures = [pool.submit(_apply_in_netns, ns, content, timeout) for ns in namespaces]
+        return [f.result() for f in futures]
+
+
+def format_results(results: List[Dict], elapsed: Optional[float] = None) -> str:
+    lines = []
+    width = max([len(r["netns"]) for r in results] + [5])
+    for r in results:
+        status = "OK" if r["ok"] else "FAIL"
+        detail = "" if r["ok"] else f"  {r['output'].splitlines()[0]}"
+        lines.append(f"{r['netns']:<{width}}  {status:<4}  {r['seconds']:6.2f}s{detail}")
+    ok = sum(1 for r in results if r["ok"])
+    summary = f"Netns: {ok}/{len(results)} namespace applicati"
+    if elapsed is not None:
+        summary += f" in {elapsed:.2f}s"
+    lines.append(summary)
+    return "\n".join(lines) + "\n"
+
+
+def run_netns(content: str, names: Optional[List[str]] = None, workers: Optional[int] = None,
+              timeout: float = 60) -> int:
+    """
+    Entrypoint CLI: names vuoto/None → discovery automatica.
+    Ritorna 0 se tutti i namespace sono stati applicati, 1 altrimenti.
+    """
+    namespaces = resolve_netns(names) if names else discover_netns()
+    if not namespaces:
+        print("ERR: nessun namespace di rete da aggiornare", file=sys.stderr)
+        return 2
+    start = time.monotonic()
+    results = apply_to_netns(namespaces, content, workers=workers, timeout=timeout)
+    sys.stdout.write(format_results(results, time.monotonic() - start))
+    return 0 if all(r["ok"] for r in results) else 1
@@ -0,0 +1,202 @@
+"""
+nft_exec.py
+
+Esecutore unico dei comandi `nft`: ogni chiamata a nft del progetto passa da run().
+
+- deadline: ogni comando ha un timeout (DEFAULT_TIMEOUT); allo scadere il processo viene
+  terminato e si solleva NftTimeout, invece di bloccare per sempre il chiamante
+  (es. nft fermo sul lock del kernel);
+- retry limitati con backoff esponenziale e jitter, solo per gli errori transitori
+  (EBUSY, EAGAIN, ENOBUFS, EINTR) e per i timeout dei comandi di sola lettura: un timeout
+  durante una scrittura ha esito ignoto e non viene ripetuto;
+- limite di concorrenza: al più MAX_CONCURRENT processi nft alla volta per processo Python;
+- circuit breaker: dopo BREAKER_THRESHOLD fallimenti consecutivi (timeout, errori transitori,
+  nft non eseguibile) le chiamate falliscono subito con CircuitOpenError per BREAKER_RESET
+  secondi; poi una sola chiamata di prova decide se richiudere il circuito.
+  Un errore "normale" di nft (es. table inesistente) significa che nft risponde: non conta;
+- metriche per comando (chiamate, errori, timeout, retry, tempi), salvabili in
+  data/nft_metrics.json con save_metrics().
+
+Gli errori restano quelli di subprocess: con check=True un exit code diverso da zero solleva
+subprocess.CalledProcessError (con stdout/stderr), come prima di questo modulo.
+"""
+
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+NFT = "nft"
+DEFAULT_TIMEOUT = 30        # secondi; le transazioni grandi (feed, apply) passano un timeout proprio
+DEFAULT_RETRIES = 2
+BACKOFF_BASE = 0.2          # secondi, raddoppia a ogni tentativo (con jitter pieno)
+BACKOFF_MAX = 5.0
+MAX_CONCURRENT = 4
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30.0
+METRICS_FILE = "data/nft_metrics.json"
+
+# messaggi di nft/kernel per cui ripetere il comando ha senso
+_TRANSIENT = ("Device or resource busy", "Resource temporarily unavailable",
+              "No buffer space available", "Interrupted system call")
+
+
+class NftTimeout(RuntimeError):
+    """Il comando nft ha superato la deadline (anche dopo gli eventuali retry)."""
+
+
+class CircuitOpenError(RuntimeError):
+    """Troppi fallimenti consecutivi: nft non viene eseguito fino alla riapertura del circuito."""
+
+
+class CircuitBreaker:
+    """Circuit breaker a tre stati: closed -> open (dopo threshold fallimenti) -> half-open (una prova)."""
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, reset: float = BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset else "open"
+
+    def before(self) -> None:
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._probe):
+                remaining = self.reset - (time.monotonic() - self.opened_at)
+                raise CircuitOpenError(f"nft sospeso dopo {self.failures} errori consecutivi "
+                                       f"(nuovo tentativo tra {max(0.0, remaining):.0f}s)")
+            if state == "half-open":
+                self._probe = True
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker()
+_slots = threading.BoundedSemaphore(MAX_CONCURRENT)
+_metrics: Dict[str, Dict] = {}
+_metrics_lock = threading.Lock()
+
+
+def command_key(args: List[str]) -> str:
+    """Chiave delle metriche: il verbo senza le opzioni e senza i nomi (es. "list table", "-f")."""
+    words = [a for a in args if not a.startswith("-")]
+    if "-f" in args:
+        return "-c -f" if "-c" in args else "-f"
+    return " ".join(words[:2]) or " ".join(args)
+
+
+def _record(key: str, seconds: float, ok: bool, timeout: bool = False, retries: int = 0) -> None:
+    with _metrics_lock:
+        m = _metrics.setdefault(key, {"calls": 0, "errors": 0, "timeouts": 0, "retries": 0,
+                                      "seconds": 0.0, "max_seconds": 0.0})
+        m["calls"] += 1
+        m["errors"] += 0 if ok else 1
+        m["timeouts"] += 1 if timeout else 0
+        m["retries"] += retries
+        m["seconds"] += seconds
+        m["max_seconds"] = max(m["max_seconds"], seconds)
+
+
+def metrics() -> Dict[str, Dict]:
+    """Copia delle metriche del processo: {comando: {calls, errors, timeouts, retries, seconds, max_seconds}}."""
+    with _metrics_lock:
+        return {k: dict(v) for k, v in _metrics.items()}
+
+
+def save_metrics(base_dir: str) -> None:
+    """Somma le metriche del processo a quelle in data/nft_metrics.json e azzera quelle in memoria."""
+    path = Path(base_dir).expanduser().resolve() / METRICS_FILE
+    with _metrics_lock:
+        current = {k: dict(v) for k, v in _metrics.items()}
+        _metrics.clear()
+    if not current:
+        return
+    try:
+        saved = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        saved = {}
+    for key, m in current.items():
+        s = saved.setdefault(key, dict.fromkeys(m, 0))
+        for field, value in m.items():
+            s[field] = max(s.get(field, 0), value) if field == "max_seconds" else s.get(field, 0) + value
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(saved, indent=1, sort_keys=True), encoding="utf-8")
+        tmp.replace(path)
+    except OSError as e:
+        print(f"WARN: metriche nft non salvate: {e}", file=sys.stderr)
+
+
+def _is_read_only(args: List[str]) -> bool:
+    return "list" in args or "-c" in args or "--version" in args
+
+
+def _backoff(attempt: int) -> float:
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def run(args: List[str], input: Optional[str] = None, timeout: float = DEFAULT_TIMEOUT,
+        retries: int = DEFAULT_RETRIES, check: bool = True) -> subprocess.CompletedProcess:
+    """
+    Esegue `nft <args>` (stdout/stderr catturati come testo) con deadline, retry e circuit breaker.
+    Solleva subprocess.CalledProcessError (check=True), NftTimeout o CircuitOpenError.
+    """
+    cmd = [NFT, *args]
+    key = command_key(args)
+    attempt = 0
+    while True:
+        breaker.before()
+        start = time.monotonic()
+        try:
+            with _slots:
+                p = subprocess.run(cmd, input=input, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            breaker.failure()
+            can_retry = attempt < retries and _is_read_only(args)
+            _record(key, time.monotonic() - start, False, timeout=True, retries=int(can_retry))
+            if not can_retry:
+                raise NftTimeout(f"`nft {' '.join(args)}` oltre {timeout}s")
+        except OSError:
+            # nft assente o non eseguibile: nessun retry
+            breaker.failure()
+            _record(key, time.monotonic() - start, False)
+            raise
+        else:
+            transient = p.returncode != 0 and any(t in (p.stderr or "") for t in _TRANSIENT)
+            can_retry = transient and attempt < retries
+            _record(key, time.monotonic() - start, p.returncode == 0, retries=int(can_retry))
+            if transient:
+                breaker.failure()
+            else:
+                breaker.success()
+            if not can_retry:
+                if check and p.returncode != 0:
+                    raise subprocess.CalledProcessError(p.returncode, cmd, p.stdout, p.stderr)
+                return p
+        time.sleep(_backoff(attempt))
+        attempt += 1
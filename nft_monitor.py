@@ -0,0 +1,335 @@
+"""
+nft_monitor.py
+
+Flusso in tempo reale delle modifiche al ruleset tramite un solo `nft -j monitor` a lunga vita.
+
+- Mirror: copia in memoria della table gestita (ruleset.Table), letta UNA volta all'avvio
+  (`nft -a -j list table`) e poi aggiornata solo dagli eventi: lo stato è sempre noto
+  senza rileggere il ruleset.
+- Event: evento tipizzato (element_added, element_removed, rule_added, rule_removed,
+  chain_flushed, set_flushed, chain_added, ...). Le rimozioni che svuotano una chain o un
+  set nello stesso batch diventano un solo chain_flushed / set_flushed.
+- Monitor.subscribe(callback): i subscriber ricevono gli eventi a batch (una transazione
+  arriva come una raffica di righe; il batch si chiude dopo BATCH_IDLE secondi di silenzio).
+
+Le modifiche fatte da firewall_ai stesso aggiornano il mirror ma non vengono pubblicate:
+un evento è "proprio" se arriva mentre un run di firewall_ai tiene il lock (flock, vedi
+/proc/locks) o entro ECHO_GRACE secondi dal suo rilascio (mtime del lockfile).
+Subscriber forniti: audit_subscriber (data/audit.jsonl) e notify_subscriber (Telegram).
+"""
+
+import json
+import os
+import select
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from config import default_lock_path
+from nft_utils import load_live_table
+from ruleset import Chain, Rule, Set, Table, element_key, expr_to_text
+
+AUDIT_FILE = "data/audit.jsonl"
+BATCH_IDLE = 0.2             # secondi senza righe che chiudono un batch
+READ_SIZE = 65536            # byte letti per chiamata dallo stdout di `nft monitor`
+ECHO_GRACE = 2.0             # eventi entro questi secondi dal rilascio del lock sono di firewall_ai
+
+_PAST = {"add": "added", "delete": "removed", "replace": "replaced", "flush": "flushed"}
+_OBJECTS = ("element", "rule", "set", "map", "chain", "table", "counter")
+
+
+@dataclass(slots=True)
+class Event:
+    kind: str                 # es. "element_added", "rule_removed", "chain_flushed"
+    family: str
+    table: str
+    target: str               # set/map/chain/counter interessato (per la table: il suo nome)
+    detail: str = ""          # chiave dell'elemento o testo della regola
+    ts: float = 0.0
+    own: bool = False         # modifica fatta da firewall_ai
+
+
+class Mirror:
+    """Table gestita tenuta aggiornata dagli eventi; gli elementi dei set sono indicizzati per chiave."""
+
+    def __init__(self, table: Table):
+        self._table = table
+        self._elements = {name: {element_key(e): e for e in s.elements} for name, s in table.sets.items()}
+
+    @property
+    def table(self) -> Table:
+        for name, s in self._table.sets.items():
+            s.elements = list(self._elements.get(name, {}).values())
+        return self._table
+
+    def element_count(self, name: str) -> int:
+        return len(self._elements.get(name, ()))
+
+    def rule_count(self, chain: str) -> int:
+        c = self._table.chains.get(chain)
+        return len(c.rules) if c else 0
+
+    def apply(self, verb: str, obj: str, o: Dict) -> List[str]:
+        """Applica un evento al mirror; ritorna i dettagli (chiavi elemento / testo regola)."""
+        t = self._table
+        name = o.get("name") or o.get("chain") or ""
+        if obj == "element":
+            index = self._elements.setdefault(name, {})
+            elems = o.get("elem")
+            elems = elems.get("set", []) if isinstance(elems, dict) else elems or []
+            keys = []
+            for e in elems:
+                key = element_key(e)
+                keys.append(key)
+                if verb == "add":
+                    index[key] = e
+                else:
+                    index.pop(key, None)
+            return keys
+        if obj == "rule":
+            chain = t.chains.setdefault(o.get("chain"), Chain(o.get("chain")))
+            handle = o.get("handle")
+            if verb == "delete":
+                gone = [r for r in chain.rules if r.handle == handle]
+                chain.rules = [r for r in chain.rules if r.handle != handle]
+                for r in gone:
+                    t.handles.pop((chain.name, r.comment), None)
+                return [expr_to_text(r.expr) for r in gone] or [f"handle {handle}"]
+            rule = Rule(expr=o.get("expr") or [], comment=o.get("comment"), handle=handle)
+            chain.rules = [r for r in chain.rules if r.handle != handle] + [rule]
+            if rule.tagged and handle is not None:
+                t.handles[(chain.name, rule.comment)] = handle
+            return [expr_to_text(rule.expr)]
+        if obj in ("set", "map"):
+            if verb == "delete":
+                t.sets.pop(name, None)
+                self._elements.pop(name, None)
+            elif verb == "flush":
+                self._elements[name] = {}
+            else:
+                type_ = o.get("type")
+                t.sets[name] = Set(name, " . ".join(type_) if isinstance(type_, list) else str(type_),
+                                   tuple(o.get("flags") or ()), data=o.get("map"))
+                self._elements.setdefault(name, {})
+            return []
+        if obj == "chain":
+            if verb == "delete":
+                t.chains.pop(name, None)
+                t.handles = {k: h for k, h in t.handles.items() if k[0] != name}
+            elif verb == "flush":
+                t.chains.setdefault(name, Chain(name)).rules = []
+                t.handles = {k: h for k, h in t.handles.items() if k[0] != name}
+            else:
+                chain = t.chains.setdefault(name, Chain(name))
+                chain.type, chain.hook, chain.prio, chain.policy = (o.get("type"), o.get("hook"),
+                                                                    o.get("prio"), o.get("policy"))
+            return []
+        if obj == "counter":
+            if verb == "delete":
+                t.counters = [c for c in t.counters if c != name]
+            elif name not in t.counters:
+                t.counters.append(name)
+            return []
+        if obj == "table":
+            if verb == "delete":
+                fresh = Table(t.family, t.name, exists=False)
+                self._table, self._elements = fresh, {}
+            elif verb == "flush":
+                for chain in t.chains.values():
+                    chain.rules = []
+                t.handles = {}
+            else:
+                t.exists = True
+        return []
+
+
+def lock_holder(lockfile: str) -> Optional[int]:
+    """PID che tiene il flock su lockfile (da /proc/locks, senza toccare il lock); None se libero."""
+    try:
+        st = os.stat(lockfile)
+        with open("/proc/locks", encoding="ascii") as fh:
+            lines = fh.read().splitlines()
+    except OSError:
+        return None
+    inode = f":{st.st_ino} "
+    for line in lines:
+        # "1: FLOCK  ADVISORY  WRITE 1234 08:01:5678 0 EOF"
+        parts = line.split()
+        if len(parts) >= 6 and parts[1] == "FLOCK" and f"{parts[5]} ".endswith(inode):
+            try:
+                return int(parts[4])
+            except ValueError:
+                return None
+    return None
+
+
+class Monitor:
+    """Un processo `nft -j monitor` e i subscriber degli eventi della table gestita."""
+
+    def __init__(self, family: str = "inet", table: str = "filter", lockfile: Optional[str] = None):
+        self.family, self.table_name = family, table
+        self.lockfile = lockfile or default_lock_path()
+        self.subscribers: List[Callable[[List[Event]], None]] = []
+        self.mirror: Optional[Mirror] = None
+        self._proc = None
+        self._emptied = set()    # (kind, target) svuotati da rimozioni nel batch corrente
+
+    def subscribe(self, callback: Callable[[List[Event]], None]) -> None:
+        self.subscribers.append(callback)
+
+    def _is_own(self) -> bool:
+        if lock_holder(self.lockfile) is not None:
+            return True
+        try:
+            return time.time() - os.stat(self.lockfile).st_mtime < ECHO_GRACE
+        except OSError:
+            return False
+
+    def parse_line(self, line: str) -> List[Event]:
+        """Una riga JSON del monitor -> eventi (mirror aggiornato). Le righe non pertinenti sono ignorate."""
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return []
+        if not isinstance(msg, dict):
+            return []
+        verb = next((v for v in _PAST if v in msg), None)
+        if verb is None or not isinstance(msg[verb], dict):
+            return []
+        obj = next((k for k in _OBJECTS if k in msg[verb]), None)
+        if obj is None:
+            return []
+        o = msg[verb][obj]
+        if obj == "table":
+            family, table = o.get("family"), o.get("name")
+        else:
+            family, table = o.get("family"), o.get("table")
+        if (family, table) != (self.family, self.table_name):
+            return []
+        details = self.mirror.apply(verb, obj, o)
+        target = o.get("name") if obj != "rule" else o.get("chain")
+        if verb == "delete" and obj == "rule" and self.mirror.rule_count(target) == 0:
+            self._emptied.add(("rule_removed", target))
+        elif verb == "delete" and obj == "element" and self.mirror.element_count(target) == 0:
+            self._emptied.add(("element_removed", target))
+        kind = f"{'set' if obj == 'map' else obj}_{_PAST[verb]}"
+        now = time.time()
+        return [Event(kind, family, table, target or "", d, now) for d in details] or \
+               [Event(kind, family, table, target or "", "", now)]
+
+    def _coalesce(self, events: List[Event]) -> List[Event]:
+        """Rimozioni che hanno svuotato una chain / un set nel batch -> un solo *_flushed."""
+        emptied, self._emptied = self._emptied, set()
+        out, flushed = [], set()
+        for e in events:
+            if (e.kind, e.target) not in emptied:
+                out.append(e)
+                continue
+            kind = "chain_flushed" if e.kind == "rule_removed" else "set_flushed"
+            if (kind, e.target) not in flushed:
+                flushed.add((kind, e.target))
+                out.append(Event(kind, e.family, e.table, e.target, "", e.ts, e.own))
+        return out
+
+    def publish(self, events: List[Event]) -> None:
+        if not events:
+            return
+        own = self._is_own()
+        events = self._coalesce(events)
+        for e in events:
+            e.own = own
+        if own:
+            return
+        for callback in self.subscribers:
+            try:
+                callback(events)
+            except Exception as e:
+                print(f"WARN: subscriber {getattr(callback, '__name__', callback)} fallito: {e}", file=sys.stderr)
+
+    def run(self) -> int:
+        """Ciclo principale: mirror iniziale, poi solo eventi. Ritorna l'exit code di nft."""
+        # il monitor parte prima della lettura iniziale: nessuna modifica può cadere nel mezzo
+        # (al più un evento già incluso nella lettura viene riapplicato, in modo idempotente)
+        self._proc = subprocess.Popen(["nft", "-a", "-j", "monitor", "ruleset"], stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+        self.mirror = Mirror(load_live_table(self.family, self.table_name))
+        fd = self._proc.stdout.fileno()
+        batch: List[Event] = []
+        pending = b""
+        try:
+            while True:
+                ready, _, _ = select.select([fd], [], [], BATCH_IDLE if batch else None)
+                if not ready:
+                    self.publish(batch)
+                    batch = []
+                    continue
+                # lettura diretta dal fd: un buffer di file trattiene le righe di una raffica
+                # e select() non segnalerebbe più il fd come leggibile
+                chunk = os.read(fd, READ_SIZE)
+                if not chunk:
+                    break
+                *lines, pending = (pending + chunk).split(b"\n")
+                for line in lines:
+                    batch += self.parse_line(line.decode("utf-8", "replace"))
+        finally:
+            if pending.strip():
+                batch += self.parse_line(pending.decode("utf-8", "replace"))
+            self.publish(batch)
+            self.stop()
+        return self._proc.wait()
+
+    def stop(self) -> None:
+        if self._proc and self._proc.poll() is None:
+            self._proc.terminate()
+
+
+def audit_subscriber(base_dir: str):
+    """Subscriber che accoda gli eventi (JSON per riga) in data/audit.jsonl."""
+    path = Path(base_dir).expanduser().resolve() / AUDIT_FILE
+
+    def audit(events: List[Event]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a", encoding="utf-8") as fh:
+            for e in events:
+                fh.write(json.dumps(asdict(e)) + "\n")
+    return audit
+
+
+def notify_subscriber(max_lines: int = 10):
+    """Subscriber che invia un riepilogo per batch su Telegram (se configurato)."""
+    try:
+        import telegram_utils
+    except Exception:
+        return None
+
+    def notify(events: List[Event]) -> None:
+        lines = [f"{e.kind} {e.target} {e.detail}".rstrip() for e in events[:max_lines]]
+        if len(events) > max_lines:
+            lines.append(f"... e altri {len(events) - max_lines} eventi")
+        telegram_utils.log_and_notify("Modifica al ruleset fuori da firewall_ai:\n" + "\n".join(lines),
+                                      level="WARNING", mode="raw")
+    return notify
+
+
+def run_monitor(base_dir: str, notify: bool = True) -> int:
+    """Entrypoint CLI: stampa gli eventi esterni, li scrive nell'audit log e (opzionale) li notifica."""
+    def show(events: List[Event]) -> None:
+        for e in events:
+            print(f"{e.kind:<16} {e.target:<16} {e.detail}")
+
+    monitor = Monitor()
+    monitor.subscribe(show)
+    monitor.subscribe(audit_subscriber(base_dir))
+    if notify and (callback := notify_subscriber()) is not None:
+        monitor.subscribe(callback)
+    try:
+        return monitor.run()
+    except KeyboardInterrupt:
+        monitor.stop()
+        return 0
+    except FileNotFoundError:
+        print("ERR: comando 'nft' non trovato", file=sys.stderr)
+        return 2
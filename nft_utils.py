@@ -6,24 +6,41 @@ Utility per lavorare con nftables in modo idempotente e sicuro.
 Funzioni principali:
 - check_nft_available(): verifica che il comando `nft` sia presente
 - check_net_admin(): verifica permessi di esecuzione su nft
-- ensure_table_chains_sets(): crea table/chain/sets e le regole che usano i set (se mancanti)
-- ensure_set(): crea un set usando un file temporaneo e `nft -f`
+- ensure_table_chains_sets(): crea table/chain/sets e le regole che usano i set (se mancanti),
+  confrontando il modello (ruleset.Table) con lo stato live letto una volta in JSON;
+  le regole di lookup di un service_set_mode precedente sono sostituite per handle
+- load_live_table() / load_live_object(): stato della table (o di un set/chain) da `nft -a -j list`,
+  con l'indice tag -> handle delle regole generate
+- apply_json(): applica un ruleset JSON con `nft -j -f -`
+- table_fingerprint(): hash economico della struttura della table (per il watchdog)
+- service_table(): table minima gestita da apply (chain, set/map dei servizi, regole di lookup)
+- ensure_set(): crea un set (flags interval, timeout) usando un file temporaneo e `nft -f`
+- set_supports_timeout(): verifica che un set esistente accetti elementi con timeout
+- service_lookup_rules(): regole di lookup dei servizi per ciascun service_set_mode
 - ensure_chain(): crea una chain usando un file temporaneo e `nft -f`
 - rule_exists(): controllo non fallibile per regole singole
 - flush_rules(): flush dell'intero ruleset
 
 Note:
+- Tutti i comandi passano da nft_exec.run() (timeout, retry, circuit breaker, metriche).
 - Per definizioni complesse (graffe, punti e virgola) usiamo file temporanei e `nft -f`
   per evitare problemi di escaping/quoting tra shell/versioni.
 - Le funzioni sono idempotenti: possono essere chiamate ripetutamente senza effetti collaterali.
 """
 
+import hashlib
+import json
 import subprocess
 import tempfile
 from pathlib import Path
-import time
 from typing import Optional
 
+import nft_exec
+from ruleset import Chain, Rule, Set, Table, sync_rules
+
+
+APPLY_TIMEOUT = 120         # transazioni (`nft -f`, JSON): possono contenere molti elementi
+
 
 def check_nft_available() -> None:
     """
@@ -31,7 +48,7 @@ def check_nft_available() -> None:
     Solleva RuntimeError in caso di problemi.
     """
     try:
-        subprocess.run(["nft", "--version"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        nft_exec.run(["--version"], retries=0)
     except FileNotFoundError:
         raise RuntimeError("Comando 'nft' non trovato. Assicurati che nftables sia installato.")
     except subprocess.CalledProcessError:
@@ -44,7 +61,7 @@ def check_net_admin() -> None:
     Solleva RuntimeError se la chiamata fallisce.
     """
     try:
-        subprocess.run(["nft", "list", "tables"], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        nft_exec.run(["list", "tables"])
     except subprocess.CalledProcessError:
         raise RuntimeError("Il processo non ha permessi NET_ADMIN o nft non risponde correttamente.")
 
@@ -59,7 +76,7 @@ def _write_and_apply_nft(content: str) -> None:
         with tempfile.NamedTemporaryFile("w", delete=False, prefix="nft_tmp_", suffix=".nft") as fh:
             tmp_path = Path(fh.name)
             fh.write(content)
-        subprocess.run(["nft", "-f", str(tmp_path)], check=True)
+        nft_exec.run(["-f", str(tmp_path)], timeout=APPLY_TIMEOUT)
     finally:
         if tmp_path and tmp_path.exists():
             try:
@@ -67,27 +84,94 @@ def _write_and_apply_nft(content: str) -> None:
             except Exception:
                 pass
 
-def ensure_set(set_name: str, elements: list = None) -> None:
+def load_live_table(family: str = "inet", table: str = "filter") -> Table:
+    """Stato live della table con una sola chiamata `nft -a -j list table`; exists=False se manca."""
+    try:
+        out = nft_exec.run(["-a", "-j", "list", "table", family, table])
+    except subprocess.CalledProcessError:
+        return Table(family, table, exists=False)
+    return Table.from_json(json.loads(out.stdout or '{"nftables": []}'), family, table)
+
+
+def load_live_object(kind: str, name: str) -> Table:
+    """Come load_live_table ma per un solo set/map/chain (`nft -a -j list <kind> inet filter <name>`)."""
+    try:
+        out = nft_exec.run(["-a", "-j", "list", kind, "inet", "filter", name])
+    except subprocess.CalledProcessError:
+        return Table(exists=False)
+    return Table.from_json(json.loads(out.stdout or '{"nftables": []}'))
+
+
+# campi che cambiano senza modifiche al ruleset: contatori, scadenze residue, handle
+_VOLATILE_KEYS = ("handle", "packets", "bytes", "expires")
+
+
+def _normalize(obj):
+    if isinstance(obj, dict):
+        return {k: _normalize(v) for k, v in obj.items() if k not in _VOLATILE_KEYS}
+    if isinstance(obj, list):
+        return [_normalize(v) for v in obj]
+    return obj
+
+
+def table_fingerprint(family: str = "inet", table: str = "filter", skip_sets=()) -> Optional[str]:
+    """
+    sha256 dello stato della table senza i campi volatili; None se la table non esiste.
+    La struttura è letta in forma terse (`nft -t -j list table`, senza elementi); gli
+    elementi sono letti solo per i set non in skip_sets (es. i grandi set dei feed) e non dinamici.
+    """
+    def listing(*args):
+        out = nft_exec.run(["-j", *args])
+        return json.loads(out.stdout or '{"nftables": []}').get("nftables", [])
+
+    try:
+        objs = listing("-t", "list", "table", family, table)
+    except subprocess.CalledProcessError:
+        return None
+    for obj in list(objs):
+        kind = next((k for k in ("set", "map") if k in obj), None)
+        # gli elementi dei set dinamici (meter) li scrive il kernel: non sono drift
+        if kind and obj[kind].get("name") not in skip_sets and "dynamic" not in (obj[kind].get("flags") or ()):
+            try:
+                objs += listing("list", kind, family, table, obj[kind]["name"])
+            except subprocess.CalledProcessError:
+                pass    # set rimosso tra le due letture: il fingerprint cambierà comunque
+    payload = json.dumps(_normalize([o for o in objs if "metainfo" not in o]), sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def apply_json(payload: dict) -> None:
+    """Applica un ruleset JSON (libnftables) in una sola transazione, senza il parser testuale."""
+    nft_exec.run(["-j", "-f", "-"], input=json.dumps(payload), timeout=APPLY_TIMEOUT)
+
+
+def ensure_set(set_name: str, elements: list = None, set_type: str = "inet_service",
+               flags: str = "interval, timeout") -> bool:
     """
     Crea il set `set_name` in table inet filter se non esiste.
     Se elements è None o vuoto, crea il set senza la riga `elements = { }`
     (alcune versioni di nft non accettano elementi vuoti).
+    Di default il set è di porte con `flags interval, timeout`: gli elementi aggiunti
+    con `timeout` scadono nel kernel. set_type/flags permettono set di indirizzi.
+    Ritorna True se il set è stato creato, False se esisteva già.
     """
     try:
-        subprocess.run(["nft", "list", "set", "inet", "filter", set_name],
-                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return
+        nft_exec.run(["list", "set", "inet", "filter", set_name])
+        return False
     except subprocess.CalledProcessError:
         pass
 
     elems = elements or []
     if elems:
-        elems_str = ", ".join(str(int(e)) for e in elems)
+        if set_type == "inet_service":
+            elems_str = ", ".join(str(int(e)) for e in elems)
+        else:
+            elems_str = ", ".join(str(e) for e in elems)
         content = (
             "table inet filter {\n"
             f"  set {set_name} {{\n"
-            "    type inet_service;\n"
-            "    flags interval;\n"
+            f"    type {set_type};\n"
+            f"    flags {flags};\n"
             f"    elements = {{ {elems_str} }}\n"
             "  }\n"
             "}\n"
@@ -97,13 +181,68 @@ def ensure_set(set_name: str, elements: list = None) -> None:
         content = (
             "table inet filter {\n"
             f"  set {set_name} {{\n"
-            "    type inet_service;\n"
-            "    flags interval;\n"
+            f"    type {set_type};\n"
+            f"    flags {flags};\n"
             "  }\n"
             "}\n"
         )
 
     _write_and_apply_nft(content)
+    return True
+
+# service_set_mode -> (set/map da creare, regole di lookup nella chain input)
+SERVICE_LOOKUPS = {
+    "split": (
+        [("set", "tcp_services", "inet_service", "interval, timeout"),
+         ("set", "udp_services", "inet_service", "interval, timeout")],
+        ["tcp dport @tcp_services accept", "udp dport @udp_services accept"],
+    ),
+    "concat": (
+        [("set", "services", "inet_proto . inet_service", "timeout")],
+        ["meta l4proto . th dport @services accept"],
+    ),
+    "vmap": (
+        [("map", "service_verdicts", "inet_proto . inet_service : verdict", "timeout")],
+        ["meta l4proto . th dport vmap @service_verdicts"],
+    ),
+}
+
+
+def service_lookup_rules(set_mode: str = "split") -> list:
+    return list(SERVICE_LOOKUPS[set_mode][1])
+
+
+def service_lookup_tags() -> set:
+    """Tag delle regole di lookup di tutti i service_set_mode: le sole che apply può sostituire."""
+    return {Rule.parse(r).comment for _, rules in SERVICE_LOOKUPS.values() for r in rules}
+
+
+def service_table(policy: str = "drop", set_mode: str = "split") -> Table:
+    """Stato minimo gestito da apply: le tre chain, i set/map dei servizi e le regole di lookup."""
+    containers, rules = SERVICE_LOOKUPS[set_mode]
+    table = Table()
+    for kind, name, type_, flags in containers:
+        data = None
+        if kind == "map":
+            type_, data = type_.split(" : ")
+        table.sets[name] = Set(name, type_, tuple(f.strip() for f in flags.split(",")), data=data)
+    table.chains = {
+        "input": Chain("input", "filter", "input", 0, policy, [Rule.parse(r) for r in rules]),
+        "forward": Chain("forward", "filter", "forward", 0, "accept"),
+        "output": Chain("output", "filter", "output", 0, "accept"),
+    }
+    return table
+
+
+def set_supports_timeout(set_name: str, kind: str = "set", live: Optional[Table] = None) -> bool:
+    """
+    True se il set (o la map, con kind="map") esiste ed è stato creato con il flag timeout.
+    I set creati da versioni precedenti non lo hanno e i flag non si possono modificare
+    senza ricreare il set (es. con --flush). Con `live` non viene interrogato nft.
+    """
+    live = live or load_live_object(kind, set_name)
+    s = live.sets.get(set_name)
+    return s is not None and "timeout" in s.flags
 
 def ensure_chain(name: str, definition_body: str) -> None:
     """
@@ -113,8 +252,7 @@ def ensure_chain(name: str, definition_body: str) -> None:
     La funzione costruisce un file .nft con la definizione completa e lo applica.
     """
     try:
-        subprocess.run(["nft", "list", "chain", "inet", "filter", name],
-                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        nft_exec.run(["list", "chain", "inet", "filter", name])
         return
     except subprocess.CalledProcessError:
         pass
@@ -128,80 +266,47 @@ def ensure_chain(name: str, definition_body: str) -> None:
     _write_and_apply_nft(content)
 
 
-def ensure_table_chains_sets(policy: str = "drop") -> None:
+def ensure_table_chains_sets(policy: str = "drop", set_mode: str = "split") -> Table:
     """
     Assicura che esistano:
       - table inet filter
       - chain input/forward/output con hook e policy
-      - set tcp_services e udp_services
-      - regole che usano i set (@tcp_services, @udp_services) nella chain input
+      - set tcp_services e udp_services (set_mode "split"), oppure il set unico
+        @services ("concat") o la verdict map @service_verdicts ("vmap")
+      - regole che usano i set nella chain input
 
+    Lo stato live è letto una sola volta (`nft -a -j list table`) e confrontato
+    strutturalmente con service_table(); gli oggetti mancanti sono creati in una sola
+    transazione JSON. Le regole di lookup generate per un altro service_set_mode
+    (riconosciute dal tag) sono sostituite o rimosse per handle nella stessa transazione;
+    gli altri oggetti esistenti, e le regole senza tag, non vengono modificati.
+    Ritorna lo stato live aggiornato, riusabile per i controlli sugli elementi.
     La funzione è idempotente e può essere chiamata più volte.
     """
-    # 1) table
-    try:
-        subprocess.run(["nft", "list", "table", "inet", "filter"],
-                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        subprocess.run(["nft", "add", "table", "inet", "filter"], check=True)
-
-    # 2) chains (usiamo file temporanei per definizioni complesse)
-    ensure_chain("input", f"type filter hook input priority 0; policy {policy};")
-    ensure_chain("forward", "type filter hook forward priority 0; policy accept;")
-    ensure_chain("output", "type filter hook output priority 0; policy accept;")
-
-    # 3) sets
-    ensure_set("tcp_services")
-    ensure_set("udp_services")
-
-    # 4) regole che usano i set (aggiungile solo se mancano)
-    try:
-        out = subprocess.run(["nft", "list", "chain", "inet", "filter", "input"],
-                             check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-        stdout = out.stdout or ""
-        if "tcp dport @tcp_services accept" not in stdout:
-            subprocess.run(["nft", "add", "rule", "inet", "filter", "input", "tcp", "dport", "@tcp_services", "accept"], check=True)
-        if "udp dport @udp_services accept" not in stdout:
-            subprocess.run(["nft", "add", "rule", "inet", "filter", "input", "udp", "dport", "@udp_services", "accept"], check=True)
-    except subprocess.CalledProcessError:
-        # se list chain fallisce, ignoriamo: le chain dovrebbero essere state create sopra
-        pass
+    live = load_live_table()
+    desired = service_table(policy, set_mode)
+    missing = desired.missing_from(live, rules=False)
+    commands = sync_rules(live, desired, service_lookup_tags())
+    if missing.is_empty() and not commands:
+        return live
+    payload = missing.to_json()
+    payload["nftables"] += commands
+    apply_json(payload)
+    return load_live_table()
 
 
-def rule_exists(proto: str, port: int) -> bool:
+def rule_exists(proto: str, port: int, live: Optional[Table] = None) -> bool:
     """
     Controlla se esiste una regola esplicita 'proto dport port accept' nella chain input.
     Non solleva eccezioni se la chain/table non esistono; ritorna False in quel caso.
     """
-    try:
-        p = subprocess.run(["nft", "list", "chain", "inet", "filter", "input"],
-                           check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-        needle = f"{proto} dport {port} accept"
-        return needle in (p.stdout or "")
-    except subprocess.CalledProcessError:
-        return False
+    live = live or load_live_object("chain", "input")
+    return live.has_rule("input", Rule.parse(f"{proto} dport {port} accept"))
 
 
 def flush_rules() -> None:
     """
     Flush dell'intero ruleset. Operazione distruttiva: usala con cautela.
     """
-    subprocess.run(["nft", "flush", "ruleset"], check=True)
+    nft_exec.run(["flush", "ruleset"])
 
-
-def _retry_cmd(cmd, retries=3, delay=1, shell=False):
-    """
-    Esegue un comando con retry semplice. cmd può essere lista (shell=False) o stringa (shell=True).
-    Restituisce l'oggetto CompletedProcess dell'ultima esecuzione o solleva l'eccezione finale.
-    """
-    last_exc: Optional[Exception] = None
-    for attempt in range(retries):
-        try:
-            if shell:
-                return subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            else:
-                return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        except Exception as e:
-            last_exc = e
-            time.sleep(delay)
-    raise last_exc
@@ -0,0 +1,123 @@
+"""
+optimizer.py
+
+Ordinamento delle regole della chain input guidato dai contatori.
+
+Con `rules: rule_counters: true` ogni regola generata da rules_generator ha un
+`counter`. L'optimizer:
+1. legge i contatori con `nft -j list chain inet filter input` all'inizio e alla
+   fine di una finestra di campionamento (il delta elimina i pacchetti storici);
+2. riconosce le regole generate confrontando il testo (ruleset.expr_to_text) con quelle
+   rese da rules_generator per la configurazione corrente;
+3. salva in data/rule_order.json l'ordine per hit decrescenti e rigenera rules/firewall.rules.
+
+Il riordino è una permutazione sicura (rules_generator.order_rules): si spostano solo le
+accept consecutive, le regole di drop/reject e le verdict map restano al loro posto,
+quindi il verdetto di ogni pacchetto non cambia, cambia solo quante regole attraversa.
+"""
+
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import nft_exec
+from ruleset import expr_to_text
+
+DEFAULT_WINDOW = 60
+
+
+def sample_counters(family: str = "inet", table: str = "filter", chain: str = "input") -> Dict[str, int]:
+    """Ritorna {testo regola: pacchetti} per le regole della chain che hanno un counter."""
+    try:
+        out = nft_exec.run(["-j", "list", "chain", family, table, chain])
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"nft -j list chain {family} {table} {chain} fallito: {(e.stderr or '').strip()}")
+    counters = {}
+    for obj in json.loads(out.stdout or '{"nftables": []}').get("nftables", []):
+        rule = obj.get("rule")
+        if not rule:
+            continue
+        packets = next((s["counter"].get("packets", 0) for s in rule.get("expr", [])
+                        if isinstance(s, dict) and "packets" in (s.get("counter") or {})), None)
+        if packets is not None:
+            text = expr_to_text(rule.get("expr"))
+            counters[text] = counters.get(text, 0) + packets
+    return counters
+
+
+def collect_hits(window: float = DEFAULT_WINDOW) -> Dict[str, int]:
+    """Pacchetti per regola nella finestra di `window` secondi."""
+    before = sample_counters()
+    time.sleep(window)
+    after = sample_counters()
+    # un contatore più basso a fine finestra indica una regola ricaricata: conta da zero
+    return {text: (n - before.get(text, 0)) if n >= before.get(text, 0) else n
+            for text, n in after.items()}
+
+
+def compute_order(keyed_rules: List, hits: Dict[str, int]) -> List[str]:
+    """Chiavi ordinate per hit decrescenti (a parità resta l'ordine corrente)."""
+    ranked = sorted(enumerate(keyed_rules), key=lambda item: (-hits.get(item[1][1], 0), item[0]))
+    return [key for _, (key, _) in ranked]
+
+
+def save_rule_order(base: Path, order: List[str], hits: Dict[str, int], window: float) -> None:
+    from rules_generator import RULE_ORDER_FILE
+    path = base / RULE_ORDER_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"order": order, "hits": hits, "window": window,
+                               "updated": int(time.time())}, indent=2), encoding="utf-8")
+    tmp.replace(path)
+
+
+def run_optimize(base_dir: str, window: float = DEFAULT_WINDOW, dry_run: bool = False) -> int:
+    """
+    Entrypoint CLI. Ritorna 0 se l'ordine è stato calcolato, 2 se i contatori non sono
+    disponibili (rule_counters disattivato o ruleset non caricato).
+    """
+    from config import load_address_lists
+    from grants import load_active_services
+    from rules_generator import (ensure_rules_file_from_services, input_chain_rules, order_rules,
+                                 rules_config)
+
+    base = Path(base_dir).expanduser().resolve()
+    cfg = rules_config(str(base))
+    if not cfg.get("rule_counters"):
+        print("ERR: imposta `rules: rule_counters: true` e ricarica il ruleset prima di ottimizzare",
+              file=sys.stderr)
+        return 2
+
+    # regole nell'ordine predefinito: le chiavi restano stabili anche dopo un riordino
+    keyed = input_chain_rules(load_active_services(str(base), persist=False), dict(cfg, rule_order=None),
+                              load_address_lists(str(base)))
+    try:
+        hits = collect_hits(window)
+    except Exception as e:
+        print(f"ERR: lettura contatori fallita: {e}", file=sys.stderr)
+        return 2
+    by_key = {key: hits[rule] for key, rule in keyed if rule in hits}
+    if not by_key:
+        print("ERR: nessuna regola generata con counter nella chain input", file=sys.stderr)
+        return 2
+
+    order = compute_order(keyed, hits)
+    before = [key for key, _ in order_rules(keyed, cfg.get("rule_order") or [])]
+    after = [key for key, _ in order_rules(keyed, order)]
+    for key in after:
+        print(f"{key:<20} {by_key.get(key, 0):>12} pkt / {window:g}s")
+    if after == before:
+        print("Ordine invariato")
+        return 0
+    print(f"Ordine: {' > '.join(before)}  ->  {' > '.join(after)}")
+    if dry_run:
+        return 0
+
+    save_rule_order(base, order, by_key, window)
+    if not ensure_rules_file_from_services(str(base), dict(cfg, rule_order=order)):
+        return 1
+    print("rules/firewall.rules rigenerato: applica il nuovo ordine con `firewall_ai.py apply --atomic`")
+    return 0
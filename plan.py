@@ -0,0 +1,160 @@
+"""
+plan.py
+
+Calcolo offline del changeset tra config/services.yaml e lo stato di nftables.
+
+Lo stato attuale viene letto UNA sola volta, dal ruleset live (`nft -j list ruleset`)
+oppure da uno snapshot JSON salvato in precedenza con:
+    nft -j list ruleset > snapshot.json
+
+Nessuna funzione di questo modulo modifica il kernel: il piano può essere calcolato
+su una build box senza nftables né permessi NET_ADMIN.
+
+Funzioni principali:
+- load_ruleset_json(): legge lo stato (snapshot o live) come dict JSON
+- compute_plan(): confronta lo stato (ruleset.Table.from_json) con le table generate da
+  rules_generator, con ruleset.diff: lista ordinata di modifiche (+ aggiungi, ~ modifica, - rimuovi)
+  su set/map ed elementi, counter, flowtable, chain e regole, table di ingress compresa.
+  I set dei feed (@blocklist_v4/v6) restano fuori: li gestisce feeds.py
+- plan_services(): compute_plan a partire dai servizi, come apply
+- format_plan(): rendering stile Terraform
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import nft_exec
+from feeds import FEED_SETS
+from rules_generator import INGRESS_TABLE, build_tables_from_services
+from ruleset import Table, diff
+
+# ANSI colori (solo se l'output è un terminale)
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+RESET = "\033[0m"
+
+_ACTION_COLORS = {"+": GREEN, "-": RED, "~": YELLOW}
+
+
+def load_ruleset_json(snapshot_path: Optional[str] = None) -> Dict:
+    """
+    Ritorna il ruleset in formato JSON (come `nft -j list ruleset`).
+    Se snapshot_path è indicato legge il file, altrimenti interroga nft una volta sola.
+    Solleva RuntimeError se la sorgente non è leggibile.
+    """
+    if snapshot_path:
+        path = Path(snapshot_path).expanduser()
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except Exception as e:
+            raise RuntimeError(f"snapshot non leggibile {path}: {e}")
+
+    try:
+        out = nft_exec.run(["-j", "list", "ruleset"])
+    except FileNotFoundError:
+        raise RuntimeError("Comando 'nft' non trovato. Usa --snapshot per pianificare offline.")
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"nft -j list ruleset fallito: {(e.stderr or '').strip()}")
+    return json.loads(out.stdout or '{"nftables": []}')
+
+
+def _without_feed_sets(table: Table) -> Table:
+    """I set dei feed e le loro regole di drop sono gestiti da feeds.py: fuori dal piano."""
+    feed_rules = {f"{family} saddr @{name} drop" for name, _, family in FEED_SETS.values()}
+    for name, _, _ in FEED_SETS.values():
+        table.sets.pop(name, None)
+    for chain in table.chains.values():
+        chain.rules = [r for r in chain.rules if r.key not in feed_rules]
+    return table
+
+
+def compute_plan(data: Dict, desired: Table, ingress: Optional[Table] = None) -> List[Dict]:
+    """
+    Changeset tra lo stato JSON (`nft -j list ruleset`) e il ruleset desiderato, come
+    ritornato da rules_generator.build_tables_from_services: table inet (set, map, counter,
+    flowtable, chain e regole) e table netdev di ingress (assente se `ingress` è None).
+    Ogni modifica è un dict di ruleset.diff.
+    """
+    current = _without_feed_sets(Table.from_json(data, desired.family, desired.name))
+    changes = diff(current, desired)
+    ingress = ingress or Table("netdev", INGRESS_TABLE, exists=False)
+    changes += diff(Table.from_json(data, ingress.family, ingress.name), ingress)
+    return changes
+
+
+def plan_services(data: Dict, services: List[Dict], cfg: Dict, addresses: Optional[Dict] = None,
+                  local: bool = True) -> List[Dict]:
+    """compute_plan con lo stato desiderato generato dai servizi (stessi argomenti di apply)."""
+    return compute_plan(data, *build_tables_from_services(services, cfg, addresses, local=local))
+
+
+def summarize(changes: List[Dict]) -> Dict[str, int]:
+    counts = {"+": 0, "~": 0, "-": 0}
+    for c in changes:
+        counts[c["action"]] += 1
+    return counts
+
+
+def format_plan(changes: List[Dict], source: str = "ruleset live", color: Optional[bool] = None) -> str:
+    """
+    Rendering testuale stile Terraform. Gli elementi dei set sono raggruppati sotto il set.
+    """
+    if color is None:
+        color = sys.stdout.isatty()
+
+    def paint(action, text):
+        if not color:
+            return text
+        return f"{_ACTION_COLORS.get(action, '')}{text}{RESET}"
+
+    lines = [f"firewall_ai plan (sorgente: {source})", ""]
+    if not changes:
+        lines.append("Nessuna modifica. Il ruleset corrisponde a services.yaml.")
+        return "\n".join(lines) + "\n"
+
+    set_changes = {}
+    for c in changes:
+        if c["kind"] in ("set", "element"):
+            set_changes.setdefault((c["table"], c["target"]), []).append(c)
+
+    printed_sets = set()
+    for c in changes:
+        kind, where = c["kind"], c["table"]
+        if kind == "table":
+            lines.append(paint(c["action"], f"  {c['action']} table {where}"))
+        elif kind == "chain":
+            body = f" {{ {c['value']} }}" if c["value"] else ""
+            lines.append(paint(c["action"], f"  {c['action']} chain {where} {c['target']}{body}"))
+        elif kind in ("set", "element"):
+            if (where, c["target"]) in printed_sets:
+                continue
+            printed_sets.add((where, c["target"]))
+            group = set_changes[(where, c["target"])]
+            header = next((g for g in group if g["kind"] == "set"), None)
+            if header and header["action"] in ("+", "-"):
+                lines.append(paint(header["action"], f"  {header['action']} set {where} {c['target']} {{ {header['value']} }}"))
+            elif header:
+                lines.append(paint("~", f"  ~ set {where} {c['target']} {{ {header['value']} }}  # {header['note']}"))
+            else:
+                lines.append(paint("~", f"  ~ set {where} {c['target']}"))
+            for g in group:
+                if g["kind"] != "element":
+                    continue
+                note = f"  # {g['note']}" if g["note"] else ""
+                lines.append(paint(g["action"], f"      {g['action']} {g['value']}{note}"))
+        elif kind == "rule":
+            lines.append(paint(c["action"], f"  {c['action']} rule {where} {c['target']}: {c['value']}"))
+        elif kind == "counter":
+            lines.append(paint(c["action"], f"  {c['action']} counter {where} {c['target']}"))
+        elif kind == "flowtable":
+            body = f" {{ {c['value']} }}" if c["value"] else ""
+            lines.append(paint(c["action"], f"  {c['action']} flowtable {where} {c['target']}{body}"))
+
+    counts = summarize(changes)
+    lines.append("")
+    lines.append(f"Plan: {counts['+']} da aggiungere, {counts['~']} da modificare, {counts['-']} da rimuovere.")
+    return "\n".join(lines) + "\n"
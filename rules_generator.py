@@ -1,84 +1,511 @@
 """
 Generazione atomica del file rules/firewall.rules.
-- Legge config/services.yaml (tramite config.load_services)
+- Legge config/services.yaml (tramite grants.load_active_services: esclude gli accessi scaduti)
 - Deduplica e ordina le porte
-- Scrive il file in modo atomico (tmp -> replace)
+- Costruisce il modello tipizzato (ruleset.Table) e lo scrive in modo atomico (tmp -> replace)
+  in rules/firewall.rules; lo stesso modello è lo stato desiderato di plan.py
 - Il file generato usa set @tcp_services e @udp_services e una regola che li usa
+  (service_set_mode "concat": un solo set @services `meta l4proto . th dport`;
+  "vmap": verdict map @service_verdicts quando i servizi hanno `action` diverse)
+- Liste allow/deny di indirizzi (e lan_cidr) aggregate in set interval @allow_v4/@allow_v6/@deny_v4/@deny_v6
+- Ordine delle accept della chain input da data/rule_order.json (scritto da optimizer.py)
+- Con `service_counters` un counter nominato per servizio (svc_<nome>), letto da traffic.py
+- Servizi con `limit`/`burst`: set dinamici @meter_<proto>_<porta>_v4/_v6 (timeout
+  `meter_timeout`) e una regola per famiglia che scarta le nuove connessioni oltre il limite
+  per sorgente, contandole nel counter lim_<nome> (digest, vedi traffic.py)
+- Servizi `stateless`: chain raw_prerouting/raw_output (priority raw) con `notrack` per la porta
+  e accept espliciti `ct state untracked` in input/output: nessuna voce di conntrack per pacchetto
+- Con `flowtable` una flowtable @ft sulle interfacce configurate (o rilevate da /sys/class/net)
+  e una regola nella chain forward: i flussi inoltrati established passano al fast path
+- Con `ingress_devices` una seconda table `netdev fwai_ingress` (build_ingress_table) con una chain
+  hook ingress per interfaccia: deny, bogon e flag TCP invalidi scartati prima di routing e conntrack
+- Con `drop_log` un campione a rate limitato dei pacchetti scartati dalla policy della chain input
+  va al gruppo NFLOG `drop_log_group` (letto e aggregato da drops.py)
 """
 from pathlib import Path
-import stat, sys
-from config import load_services, DEFAULT_BASE_DIR
+import json, re, stat, sys
+from addresses import aggregate, format_interval
+from config import DEFAULT_BASE_DIR, _resolve_base, load_address_lists, load_rules_config, parse_limit
+from grants import load_active_services
+from nft_utils import service_lookup_rules
+from ruleset import Chain, Flowtable, Rule, Set, Table, rule_tag
 
 DEFAULT_RULES = {
     "lan_cidr": "192.168.1.0/24",
     "policy": "drop",
-    "allow_icmp": True
+    "allow_icmp": True,
+    "service_set_mode": "split",
+    "rule_counters": False,
+    "service_counters": False,
+    "generations": 5,
+    "meter_timeout": 60,
+    "flowtable": False,
+    "flowtable_devices": [],
+    "ingress_devices": [],
+    "ingress_bogons": True,
+    "drop_log": False,
+    "drop_log_group": 5,
+    "drop_log_rate": "10/second"
 }
 
-def render_nft_rules(lan_cidr, tcp_ports, udp_ports, policy="drop", allow_icmp=True):
+SERVICE_SET_MODES = ("split", "concat", "vmap")
+RULE_ORDER_FILE = "data/rule_order.json"
+DEFAULT_BURST = 5           # il burst predefinito di nft: esplicito per confrontare le regole live
+METER_SIZE = 65535
+RAW_PRIORITY = -300         # priority raw: prima di conntrack (-200)
+FLOWTABLE_NAME = "ft"
+SYS_CLASS_NET = "/sys/class/net"
+# interfacce mai usate per la flowtable: loopback, ifb (solo shaping) e lati container delle veth
+# (i flussi dei container si vedono sul bridge, es. docker0 / br-*)
+_FLOWTABLE_SKIP = ("lo", "veth", "ifb")
+# header IPv6 (40 byte) + porte L4: al consumer NFLOG (drops.py) non serve altro del pacchetto
+DROP_LOG_SNAPLEN = 64
+INGRESS_TABLE = "fwai_ingress"
+INGRESS_PRIORITY = -500
+# sorgenti mai valide su un'interfaccia esterna (le reti private no: la LAN può essere sulla stessa)
+BOGONS = {
+    4: ["0.0.0.0/8", "127.0.0.0/8", "224.0.0.0/4", "240.0.0.0/4"],
+    6: ["::1/128", "ff00::/8"],
+}
+# DHCP DISCOVER/REQUEST partono da 0.0.0.0: accettati in ingress prima del drop dei bogon
+DHCP_FROM_UNSPECIFIED = "ip saddr 0.0.0.0 udp sport 68 udp dport 67 accept"
+_TCP_FLAGS = ("fin", "syn", "rst", "psh", "ack", "urg")
+# (maschera, valore) delle combinazioni di flag TCP che nessuno stack legittimo invia
+_BAD_TCP_FLAGS = [
+    (("fin", "syn"), ("fin", "syn")),
+    (("syn", "rst"), ("syn", "rst")),
+    (_TCP_FLAGS, ()),                          # null scan
+    (_TCP_FLAGS, ("fin", "psh", "urg")),       # xmas scan
+]
+
+def _element(key, timeout=None):
+    """Elemento JSON, con timeout (secondi) per gli accessi temporanei."""
+    return {"elem": {"val": key, "timeout": int(timeout)}} if timeout else key
+
+def _service_key(proto, port, set_mode):
+    return port if set_mode == "split" else {"concat": [proto, port]}
+
+def _address_element(start, end, version):
+    text = format_interval(start, end, version)
+    if "/" in text:
+        addr, length = text.split("/")
+        return {"prefix": {"addr": addr, "len": int(length)}}
+    if "-" in text:
+        return {"range": text.split("-", 1)}
+    return text
+
+def effective_set_mode(mode, actions=None):
     """
-    Restituisce il contenuto testuale del file nftables basato sui parametri.
-    Usa doppie graffe {{ }} nelle f-string per produrre parentesi graffe letterali.
+    Se qualche servizio ha un'azione diversa da accept si usa sempre la verdict map:
+    un set può solo dire "presente", la map associa un verdetto a ogni servizio.
     """
-    tcp_set = sorted({int(p) for p in tcp_ports})
-    udp_set = sorted({int(p) for p in udp_ports})
+    if mode not in SERVICE_SET_MODES:
+        print(f"WARN: service_set_mode sconosciuto {mode!r}, uso split", file=sys.stderr)
+        mode = "split"
+    if any(a != "accept" for a in (actions or {}).values()):
+        return "vmap"
+    return mode
 
-    tcp_elements = ", ".join(str(p) for p in tcp_set)
-    udp_elements = ", ".join(str(p) for p in udp_set)
+def _service_sets(tcp_set, udp_set, timeouts, set_mode, actions):
+    """Set/map dei servizi: @tcp_services e @udp_services, @services oppure la verdict map."""
+    if set_mode == "split":
+        return [Set(f"{proto}_services", "inet_service", ("interval", "timeout"),
+                    [_element(p, timeouts.get((proto, p))) for p in ports])
+                for proto, ports in (("tcp", tcp_set), ("udp", udp_set))]
+    keys = [("tcp", p) for p in tcp_set] + [("udp", p) for p in udp_set]
+    elements = [_element(_service_key(pr, p, set_mode), timeouts.get((pr, p))) for pr, p in keys]
+    if set_mode == "vmap":
+        elements = [[e, {(actions or {}).get(k, "accept"): None}] for e, k in zip(elements, keys)]
+        return [Set("service_verdicts", "inet_proto . inet_service", ("timeout",), elements, data="verdict")]
+    return [Set("services", "inet_proto . inet_service", ("timeout",), elements)]
 
-    # se non ci sono elementi, scriviamo un set vuoto senza spazi inutili
-    tcp_elements_field = tcp_elements if tcp_elements else ""
-    udp_elements_field = udp_elements if udp_elements else ""
+def service_counter_name(name) -> str:
+    """Nome dell'oggetto counter nft di un servizio: svc_ seguito dal nome ripulito."""
+    return "svc_" + re.sub(r"[^A-Za-z0-9_]", "_", str(name))[:48]
 
-    content = "#!/usr/sbin/nft -f\n"
-    content += "table inet filter {\n"
+def service_counter_names(services) -> dict:
+    """{(proto, porta): nome counter}; a parità di porta vince il primo servizio (come service_actions)."""
+    names = {}
+    for s in services:
+        names.setdefault((s["protocol"], s["port"]), service_counter_name(s["name"]))
+    return names
 
-    # tcp set
-    if tcp_elements_field:
-        content += "  set tcp_services {\n"
-        content += "    type inet_service\n"
-        content += "    flags interval\n"
-        content += f"    elements = {{ {tcp_elements_field} }}\n"
-        content += "  }\n\n"
-    else:
-        # crea comunque il set vuoto (utile per idempotenza)
-        content += "  set tcp_services {\n"
-        content += "    type inet_service\n"
-        content += "    flags interval\n"
-        content += "    elements = { }\n"
-        content += "  }\n\n"
-
-    # udp set
-    if udp_elements_field:
-        content += "  set udp_services {\n"
-        content += "    type inet_service\n"
-        content += "    flags interval\n"
-        content += f"    elements = {{ {udp_elements_field} }}\n"
-        content += "  }\n\n"
+def service_limits(services) -> dict:
+    """{(proto, porta): (limit, burst, nome counter)} dei servizi con `limit`; a parità di porta vince il primo."""
+    limits = {}
+    for s in services:
+        if s.get("limit"):
+            name = "lim_" + re.sub(r"[^A-Za-z0-9_]", "_", str(s["name"]))[:48]
+            limits.setdefault((s["protocol"], s["port"]), (s["limit"], s.get("burst", DEFAULT_BURST), name))
+    return limits
+
+def _meter_sets(limits, meter_timeout):
+    """Set dinamici (uno per servizio e famiglia): un elemento per sorgente, con il proprio limit."""
+    sets = []
+    for proto, port in sorted(limits):
+        for suffix, addr_type in (("v4", "ipv4_addr"), ("v6", "ipv6_addr")):
+            sets.append(Set(f"meter_{proto}_{port}_{suffix}", addr_type, ("dynamic", "timeout"),
+                            timeout=meter_timeout, size=METER_SIZE))
+    return sets
+
+def _limit_rules(limits):
+    """Regole [(chiave, testo)]: oltre il limite la nuova connessione viene scartata e contata."""
+    rules = []
+    for (proto, port), (rate, burst, counter) in sorted(limits.items()):
+        for suffix, family in (("v4", "ip"), ("v6", "ip6")):
+            rules.append((f"limit_{proto}_{port}_{suffix}",
+                          f"{proto} dport {port} ct state new add @meter_{proto}_{port}_{suffix} "
+                          f"{{ {family} saddr limit rate over {rate} burst {burst} packets }} "
+                          f"counter name {counter} drop"))
+    return rules
+
+def present_devices(configured, sys_class_net=SYS_CLASS_NET) -> list:
+    """Le interfacce configurate che esistono; le altre con un WARN (nft rifiuterebbe l'intera transazione)."""
+    root = Path(sys_class_net)
+    present = {p.name for p in root.iterdir() if p.is_dir()} if root.is_dir() else set()
+    missing = [d for d in configured if d not in present]
+    if missing:
+        print(f"WARN: interfacce assenti, ignorate: {', '.join(missing)}", file=sys.stderr)
+    return [d for d in configured if d in present]
+
+def flowtable_devices(configured=None, sys_class_net=SYS_CLASS_NET) -> list:
+    """
+    Interfacce della flowtable: quelle configurate che esistono oppure, se non configurate,
+    tutte quelle in /sys/class/net tranne loopback, veth e ifb.
+    """
+    if configured:
+        return present_devices(configured, sys_class_net)
+    root = Path(sys_class_net)
+    present = sorted(p.name for p in root.iterdir() if p.is_dir()) if root.is_dir() else []
+    return [d for d in present if not d.startswith(_FLOWTABLE_SKIP)]
+
+def stateless_services(services) -> list:
+    """[(proto, porta)] ordinate dei servizi con `stateless: true`."""
+    return sorted({(s["protocol"], s["port"]) for s in services if s.get("stateless")})
+
+def _stateless_chains(stateless):
+    """
+    Chain a priority raw: le query in ingresso e le risposte in uscita del servizio non
+    passano da conntrack (con notrack solo in ingresso la risposta creerebbe una voce nuova).
+    Solo traffico che termina sull'host (fib ... type local): in prerouting passa anche il
+    traffico inoltrato ai container, che senza conntrack perderebbe DNAT e masquerade.
+    """
+    pre = [Rule.parse(f"fib daddr type local {proto} dport {port} notrack") for proto, port in stateless]
+    out = [Rule.parse(f"fib saddr type local {proto} sport {port} notrack") for proto, port in stateless]
+    return {
+        "raw_prerouting": Chain("raw_prerouting", "filter", "prerouting", RAW_PRIORITY, "accept", pre),
+        "raw_output": Chain("raw_output", "filter", "output", RAW_PRIORITY, "accept", out),
+    }
+
+def _service_counters_map(counter_names):
+    """Map (proto . porta) -> counter nominato, usata da una sola regola di conteggio."""
+    elements = [[{"concat": [proto, port]}, name] for (proto, port), name in sorted(counter_names.items())]
+    return Set("service_counters", "inet_proto . inet_service", (), elements, data="counter")
+
+def drop_log_rule(group, rate):
+    """
+    Ultima regola della chain input: un campione (al più `rate`) dei pacchetti che stanno per
+    finire nella policy drop va al gruppo NFLOG `group`. Nessun verdetto: decide la policy.
+    """
+    return Rule.parse(f"limit rate {rate} burst {DEFAULT_BURST} packets log group {group} snaplen {DROP_LOG_SNAPLEN}")
+
+def _address_sets(lan_cidr, allow_addresses, deny_addresses):
+    """[(nome, tipo, famiglia, intervalli, verdetto)] in ordine di valutazione: prima i deny, poi gli allow."""
+    allow = aggregate(([lan_cidr] if lan_cidr else []) + list(allow_addresses or []))
+    deny = aggregate(deny_addresses or [])
+    return [
+        ("deny_v4", "ipv4_addr", "ip", deny[4], "drop"),
+        ("deny_v6", "ipv6_addr", "ip6", deny[6], "drop"),
+        ("allow_v4", "ipv4_addr", "ip", allow[4], "accept"),
+        ("allow_v6", "ipv6_addr", "ip6", allow[6], "accept"),
+    ]
+
+def _input_rules(address_sets, set_mode, allow_icmp, service_counters=False, limits=None, stateless=()):
+    """Regole della chain input [(chiave, testo)] nell'ordine predefinito."""
+    rules = []
+    if service_counters:
+        # in testa e senza verdetto: conta tutto il traffico verso i servizi, anche quello established
+        rules.append(("service_counters", "counter name meta l4proto . th dport map @service_counters"))
+    rules += [("established", "ct state established,related accept"), ("lo", 'iif "lo" accept')]
+    for name, _, family, intervals, verdict in address_sets:
+        if intervals:
+            rules.append((name, f"{family} saddr @{name} {verdict}"))
+    # i limiti precedono le accept dei servizi (la LAN e gli allow sono già stati accettati)
+    rules += _limit_rules(limits or {})
+    # i pacchetti senza conntrack non sono mai established: accept esplicito per porta
+    rules += [(f"stateless_{proto}_{port}", f"{proto} dport {port} ct state untracked accept")
+              for proto, port in stateless]
+    if set_mode == "split":
+        rules.append(("tcp_services", "tcp dport @tcp_services accept"))
+        rules.append(("udp_services", "udp dport @udp_services accept"))
     else:
-        content += "  set udp_services {\n"
-        content += "    type inet_service\n"
-        content += "    flags interval\n"
-        content += "    elements = { }\n"
-        content += "  }\n\n"
-
-    # chain input
-    content += f"  chain input {{\n    type filter hook input priority 0; policy {policy};\n"
-    content += "    ct state established,related accept\n"
-    content += '    iif "lo" accept\n'
-    content += f"    ip saddr {lan_cidr} accept\n\n"
-    content += "    tcp dport @tcp_services accept\n"
-    content += "    udp dport @udp_services accept\n"
+        name = "service_verdicts" if set_mode == "vmap" else "services"
+        rules += [(name, rule) for rule in service_lookup_rules(set_mode)]
     if allow_icmp:
-        content += "    icmp type echo-request accept\n"
-    content += "  }\n\n"
-    content += "  chain forward { type filter hook forward priority 0; policy accept; }\n"
-    content += "  chain output  { type filter hook output priority 0; policy accept; }\n"
-    content += "}\n"
-    return content
+        rules.append(("icmp", "icmp type echo-request accept"))
+    return rules
 
-def ensure_rules_file_from_services(base_dir: str = DEFAULT_BASE_DIR, cfg: dict = None, services_cfg_path: str = "config/services.yaml", extra_dirs=None) -> bool:
+def with_counter(rule):
+    """
+    Inserisce `counter` prima del verdetto di una regola; in una vmap va in testa:
+    tra la chiave e `vmap` nft non accetta altri statement.
+    """
+    if rule.startswith("counter ") or " counter " in rule:
+        # regola di solo conteggio (service_counters) o che ha già il suo counter (limiti)
+        return rule
+    if " vmap " in rule:
+        return f"counter {rule}"
+    match, verdict = rule.rsplit(" ", 1)
+    return f"{match} counter {verdict}"
+
+def is_commutable(rule):
+    """Le regole che terminano con accept commutano tra loro: l'esito è accept in ogni ordine."""
+    return rule.endswith(" accept") and " vmap " not in rule
+
+def order_rules(rules, order):
+    """
+    Riordina le regole [(chiave, testo)] secondo `order` (lista di chiavi, più frequenti prima)
+    come permutazione sicura: solo le accept consecutive vengono riordinate tra loro,
+    ogni regola non commutabile (drop, vmap) resta nella sua posizione.
+    """
+    rank = {key: i for i, key in enumerate(order)}
+    out = []
+    segment = []
+    for idx, (key, rule) in enumerate(rules):
+        if is_commutable(rule):
+            segment.append((rank.get(key, len(rank) + idx), key, rule))
+            continue
+        out.extend((k, r) for _, k, r in sorted(segment))
+        segment = []
+        out.append((key, rule))
+    out.extend((k, r) for _, k, r in sorted(segment))
+    return out
+
+def build_ruleset(lan_cidr, tcp_ports, udp_ports, policy="drop", allow_icmp=True, timeouts=None,
+                  allow_addresses=None, deny_addresses=None, set_mode="split", actions=None,
+                  counters=False, rule_order=None, counter_names=None, limits=None,
+                  meter_timeout=DEFAULT_RULES["meter_timeout"], flowtable=None, stateless=None,
+                  drop_log=None) -> Table:
+    """
+    Costruisce il modello (ruleset.Table) del ruleset a partire dai parametri.
+    timeouts: dict opzionale {(proto, porta): secondi} per gli accessi temporanei;
+    i set hanno `flags interval, timeout` e il kernel rimuove da solo gli elementi scaduti.
+    allow_addresses/deny_addresses: CIDR IPv4/IPv6 (lan_cidr è aggiunto agli allow);
+    vengono fusi nel minimo numero di intervalli e verificati con un solo lookup per famiglia.
+    set_mode: "split" (due set e due regole), "concat" (un set, una regola) o "vmap";
+    actions: dict opzionale {(proto, porta): verdetto} usato dalla verdict map.
+    counters: aggiunge `counter` a ogni regola della chain input (usato da optimizer.py);
+    rule_order: ordine delle regole della chain input per chiave (vedi order_rules);
+    counter_names: dict opzionale {(proto, porta): nome} dei counter nominati per servizio;
+    limits: dict opzionale {(proto, porta): (limit, burst, counter)} (vedi service_limits):
+    per ogni servizio due set dinamici (IPv4/IPv6) in cui il kernel tiene un limit per sorgente;
+    gli elementi inattivi scadono dopo meter_timeout secondi;
+    flowtable: lista opzionale di interfacce della flowtable @ft (vedi flowtable_devices);
+    stateless: lista opzionale [(proto, porta)] dei servizi esclusi da conntrack (notrack);
+    drop_log: (gruppo NFLOG, rate) opzionale per campionare i pacchetti scartati dalla policy
+    (vedi drop_log_rule e drops.py); ignorato con policy accept.
+    """
+    timeouts = timeouts or {}
+    set_mode = effective_set_mode(set_mode, actions)
+    address_sets = _address_sets(lan_cidr, allow_addresses, deny_addresses)
+    tcp_set = sorted({int(p) for p in tcp_ports})
+    udp_set = sorted({int(p) for p in udp_ports})
+
+    table = Table()
+    sets = _service_sets(tcp_set, udp_set, timeouts, set_mode, actions)
+    limits = limits or {}
+    if counter_names:
+        sets.append(_service_counters_map(counter_names))
+    table.counters = sorted(set((counter_names or {}).values()) | {c for _, _, c in limits.values()})
+    sets += _meter_sets(limits, meter_timeout)
+    # set di indirizzi (solo quelli non vuoti)
+    for name, addr_type, family, intervals, _ in address_sets:
+        if intervals:
+            version = 4 if family == "ip" else 6
+            sets.append(Set(name, addr_type, ("interval",), [_address_element(s, e, version) for s, e in intervals]))
+    table.sets = {s.name: s for s in sets}
+
+    stateless = stateless or []
+    input_rules = _input_rules(address_sets, set_mode, allow_icmp, bool(counter_names), limits, stateless)
+    if rule_order:
+        input_rules = order_rules(input_rules, rule_order)
+    forward_rules = []
+    if flowtable:
+        # il primo pacchetto (ct state new) segue il percorso normale; dal secondo in poi il
+        # flusso è nella flowtable e salta forward/postrouting. Il kernel accetta solo tcp/udp.
+        table.flowtables = {FLOWTABLE_NAME: Flowtable(FLOWTABLE_NAME, list(flowtable))}
+        forward_rules.append(Rule.parse(f"ct state established flow add @{FLOWTABLE_NAME}"))
+    input_chain = [Rule.parse(with_counter(rule) if counters else rule) for _, rule in input_rules]
+    if drop_log and policy == "drop":
+        # fuori da input_rules: senza verdetto, non va né riordinata né contata da optimizer.py
+        input_chain.append(drop_log_rule(*drop_log))
+    table.chains = {
+        "input": Chain("input", "filter", "input", 0, policy, input_chain),
+        "forward": Chain("forward", "filter", "forward", 0, "accept", forward_rules),
+        "output": Chain("output", "filter", "output", 0, "accept",
+                        [Rule.parse(f"{proto} sport {port} ct state untracked accept") for proto, port in stateless]),
+    }
+    if stateless:
+        table.chains.update(_stateless_chains(stateless))
+    return table
+
+def _tcp_flags_rule(mask, value):
+    """`tcp flags & (mask) == value drop`: espressione costruita qui, fuori dalla grammatica di Rule.parse."""
+    left = {"&": [{"payload": {"protocol": "tcp", "field": "flags"}}, {"|": list(mask)}]}
+    right = {"|": list(value)} if len(value) > 1 else (value[0] if value else 0)
+    expr = [{"match": {"op": "==", "left": left, "right": right}}, {"drop": None}]
+    text = f"tcp flags & ({'|'.join(mask)}) == {'|'.join(value) or '0x0'} drop"
+    return Rule(expr=expr, text=text, comment=rule_tag(expr))
+
+def build_ingress_table(devices, deny_addresses=None, bogons=True):
+    """
+    Table `netdev fwai_ingress` con una chain hook ingress per interfaccia (priority -500):
+    sorgenti in deny_addresses, bogon (BOGONS) e flag TCP invalidi vengono scartati
+    appena il pacchetto arriva dal driver, prima di routing, conntrack e chain input.
+    Con i bogon attivi le richieste DHCP da 0.0.0.0 passano: decide poi la chain input.
+    None se non ci sono interfacce. I set sono copie di quelli della table inet: una table
+    non può usare i set di un'altra.
+    """
+    if not devices:
+        return None
+    deny = aggregate(list(deny_addresses or []) + (BOGONS[4] + BOGONS[6] if bogons else []))
+    table = Table(family="netdev", name=INGRESS_TABLE)
+    rules = [DHCP_FROM_UNSPECIFIED] if bogons else []
+    for name, addr_type, family, version in (("deny_v4", "ipv4_addr", "ip", 4), ("deny_v6", "ipv6_addr", "ip6", 6)):
+        if deny[version]:
+            table.sets[name] = Set(name, addr_type, ("interval",),
+                                   [_address_element(s, e, version) for s, e in deny[version]])
+            rules.append(f"{family} saddr @{name} drop")
+    for device in devices:
+        chain = "ingress_" + re.sub(r"[^A-Za-z0-9_]", "_", device)
+        table.chains[chain] = Chain(chain, "filter", "ingress", INGRESS_PRIORITY, "accept",
+                                    [Rule.parse(r) for r in rules] +
+                                    [_tcp_flags_rule(m, v) for m, v in _BAD_TCP_FLAGS],
+                                    device=device)
+    return table
+
+def _build_tables(*args, ingress_devices=None, ingress_bogons=True, **kwargs):
+    """(table inet filter, table netdev di ingress o None) con i parametri di build_ruleset."""
+    ingress = build_ingress_table(ingress_devices, kwargs.get("deny_addresses"), ingress_bogons)
+    return build_ruleset(*args, **kwargs), ingress
+
+def render_nft_rules(*args, **kwargs) -> str:
+    """
+    Contenuto testuale del file nftables (`nft -f`); stessi parametri di build_ruleset,
+    più ingress_devices/ingress_bogons per la table netdev (accodata alla table inet).
+    """
+    table, ingress = _build_tables(*args, **kwargs)
+    return table.to_text() + ("\n" + ingress.to_text(header=False) if ingress else "")
+
+def rules_config(base_dir=None) -> dict:
+    """DEFAULT_RULES con gli override della sezione `rules:` di services.yaml."""
+    cfg = dict(DEFAULT_RULES)
+    cfg.update(load_rules_config(base_dir))
+    cfg["rule_order"] = load_rule_order(base_dir)
+    return cfg
+
+def load_rule_order(base_dir=None) -> list:
+    """Ordine delle regole salvato da optimizer.py ([] se assente o illeggibile)."""
+    path = _resolve_base(base_dir) / RULE_ORDER_FILE
+    try:
+        return list(json.loads(path.read_text(encoding="utf-8")).get("order", []))
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"WARN: {path} illeggibile, uso l'ordine predefinito: {e}", file=sys.stderr)
+        return []
+
+def service_actions(services) -> dict:
+    """Verdetto per servizio {(proto, porta): azione}; a parità di porta vince il primo."""
+    actions = {}
+    for s in services:
+        actions.setdefault((s["protocol"], s["port"]), s.get("action", "accept"))
+    return actions
+
+def render_rules_from_services(services, cfg: dict = None, addresses: dict = None, local: bool = True) -> str:
+    """
+    Rendering del ruleset a partire dalla lista servizi (come ritornata da load_services)
+    e da una cfg con le chiavi di DEFAULT_RULES (quelle mancanti usano il default).
+    addresses: {"allow": [...], "deny": [...]} come ritornato da config.load_address_lists.
+    local=False per un ruleset destinato a un altro host o namespace: le interfacce
+    (flowtable, ingress) sono quelle configurate, senza rilevamento né verifica su questo host.
+    """
+    return render_nft_rules(**_render_args(services, cfg, addresses, local))
+
+def build_tables_from_services(services, cfg: dict = None, addresses: dict = None, local: bool = True):
+    """Come render_rules_from_services, ma ritorna i modelli (table inet, table netdev di ingress o None)."""
+    return _build_tables(**_render_args(services, cfg, addresses, local))
+
+def input_chain_rules(services, cfg: dict = None, addresses: dict = None) -> list:
+    """
+    Regole della chain input [(chiave, testo senza counter)] come le renderebbe
+    render_rules_from_services con la stessa cfg (rule_order compreso).
+    """
+    args = _render_args(services, cfg, addresses)
+    set_mode = effective_set_mode(args["set_mode"], args["actions"])
+    rules = _input_rules(_address_sets(args["lan_cidr"], args["allow_addresses"], args["deny_addresses"]),
+                         set_mode, args["allow_icmp"], bool(args["counter_names"]), args["limits"],
+                         args["stateless"])
+    return order_rules(rules, args["rule_order"]) if args["rule_order"] else rules
+
+def _render_args(services, cfg: dict = None, addresses: dict = None, local: bool = True) -> dict:
+    """Argomenti di render_nft_rules ricavati da servizi, cfg e liste di indirizzi."""
+    addresses = addresses or {}
     cfg = cfg or DEFAULT_RULES
+    flowtable = ingress = None
+    if cfg.get("flowtable"):
+        flowtable = flowtable_devices(cfg.get("flowtable_devices")) if local else cfg.get("flowtable_devices")
+    if cfg.get("ingress_devices"):
+        ingress = present_devices(cfg["ingress_devices"]) if local else cfg["ingress_devices"]
+    tcp_ports = {s["port"] for s in services if s["protocol"] == "tcp"}
+    udp_ports = {s["port"] for s in services if s["protocol"] == "udp"}
+
+    # accessi temporanei: se la stessa porta è anche permanente vince la voce permanente
+    permanent = {(s["protocol"], s["port"]) for s in services if not s.get("timeout")}
+    timeouts = {}
+    for s in services:
+        key = (s["protocol"], s["port"])
+        if s.get("timeout") and key not in permanent:
+            timeouts[key] = max(timeouts.get(key, 0), s["timeout"])
+
+    return dict(
+        lan_cidr=cfg.get("lan_cidr", DEFAULT_RULES["lan_cidr"]),
+        tcp_ports=tcp_ports,
+        udp_ports=udp_ports,
+        policy=cfg.get("policy", DEFAULT_RULES["policy"]),
+        allow_icmp=cfg.get("allow_icmp", DEFAULT_RULES["allow_icmp"]),
+        timeouts=timeouts,
+        allow_addresses=addresses.get("allow"),
+        deny_addresses=addresses.get("deny"),
+        set_mode=cfg.get("service_set_mode", DEFAULT_RULES["service_set_mode"]),
+        actions=service_actions(services),
+        counters=cfg.get("rule_counters", DEFAULT_RULES["rule_counters"]),
+        rule_order=cfg.get("rule_order"),
+        counter_names=service_counter_names(services) if cfg.get("service_counters") else None,
+        limits=service_limits(services),
+        meter_timeout=cfg.get("meter_timeout", DEFAULT_RULES["meter_timeout"]),
+        flowtable=flowtable,
+        stateless=stateless_services(services),
+        ingress_devices=ingress,
+        ingress_bogons=cfg.get("ingress_bogons", DEFAULT_RULES["ingress_bogons"]),
+        drop_log=_drop_log_args(cfg)
+    )
+
+def _drop_log_args(cfg: dict):
+    """(gruppo, rate) di drop_log_rule se `drop_log` è attivo, altrimenti None."""
+    if not cfg.get("drop_log"):
+        return None
+    try:
+        group = int(cfg.get("drop_log_group", DEFAULT_RULES["drop_log_group"]))
+        if not 0 <= group <= 65535:
+            raise ValueError(f"gruppo NFLOG fuori intervallo: {group}")
+        return group, parse_limit(cfg.get("drop_log_rate", DEFAULT_RULES["drop_log_rate"]))
+    except ValueError as e:
+        print(f"WARN: drop_log ignorato: {e}", file=sys.stderr)
+        return None
+
+def ensure_rules_file_from_services(base_dir: str = DEFAULT_BASE_DIR, cfg: dict = None, services_cfg_path: str = "config/services.yaml", extra_dirs=None) -> bool:
+    cfg = cfg or rules_config(base_dir)
     base = Path(base_dir).expanduser().resolve()
     try:
         dirs = ["rules", "logs", "data"]
@@ -90,23 +517,14 @@ def ensure_rules_file_from_services(base_dir: str = DEFAULT_BASE_DIR, cfg: dict
         print(f"ERROR: cannot create directories under {base}: {e}", file=sys.stderr)
         return False
 
-    services = load_services(base_dir)
-    tcp_ports = {s["port"] for s in services if s["protocol"] == "tcp"}
-    udp_ports = {s["port"] for s in services if s["protocol"] == "udp"}
-
-    content = render_nft_rules(
-        lan_cidr=cfg.get("lan_cidr", DEFAULT_RULES["lan_cidr"]),
-        tcp_ports=tcp_ports,
-        udp_ports=udp_ports,
-        policy=cfg.get("policy", DEFAULT_RULES["policy"]),
-        allow_icmp=cfg.get("allow_icmp", DEFAULT_RULES["allow_icmp"])
-    )
+    services = load_active_services(base_dir)
+    args = _render_args(services, cfg, load_address_lists(base_dir))
 
     rules_file = base / "rules" / "firewall.rules"
     try:
         tmp = rules_file.with_suffix(".tmp")
         with open(tmp, "w", encoding="utf-8") as f:
-            f.write(content)
+            f.write(render_nft_rules(**args))
         tmp.chmod(0o644)
         tmp.replace(rules_file)
         rules_file.chmod(rules_file.stat().st_mode | stat.S_IXUSR)
@@ -0,0 +1,676 @@
+"""
+ruleset.py
+
+Modello tipizzato del ruleset gestito (table inet filter).
+
+- Table, Chain, Set, Flowtable, Rule: dataclass con __slots__; un Set con data ("verdict",
+  "counter") è una map. Gli elementi dei set sono conservati nella forma JSON di
+  libnftables (22, {"concat": ["tcp", 22]}, {"prefix": {...}}, [chiave, dato], ...).
+- Table.to_text(): il formato testuale di rules/firewall.rules (`nft -f`);
+  Table.to_json(): lo stesso ruleset per `nft -j -f`, senza passare dal parser testuale.
+- Table.from_json(): stato live letto da `nft -j list table|ruleset`.
+- Rule.parse(): costruisce l'espressione JSON a partire dal testo delle regole generate
+  (la grammatica limitata usata da rules_generator, nft_utils e feeds), compresi gli
+  statement sui set dinamici (`add @meter { ip saddr limit rate over 10/second burst 20 packets }`)
+  i counter nominati (`counter name lim_ssh`) e il log verso NFLOG (`log group 5 snaplen 64`).
+- diff() / Table.missing_from(): confronto strutturale tra stato desiderato e live,
+  per chiave normalizzata (expr_to_text / element_key) invece di cercare sottostringhe
+  nell'output di `nft list`.
+- tag: ogni regola generata porta `comment "fwai:<hash>"`, hash stabile del contenuto
+  (rule_tag). Table.from_json() costruisce l'indice {(chain, tag): handle} (Table.handles)
+  e sync_rules() produce `replace`/`delete` per handle: le regole senza tag (create a mano
+  o da altri strumenti) non vengono mai toccate.
+"""
+
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+VERDICTS = ("accept", "drop", "reject", "return", "continue")
+TAG_PREFIX = "fwai:"
+_LOG_OPTIONS = ("group", "snaplen")     # nell'ordine in cui nft li stampa
+
+# selettori della grammatica delle regole generate -> operando JSON
+_SELECTORS = {
+    "ct state": {"ct": {"key": "state"}},
+    "iif": {"meta": {"key": "iif"}},
+    "iifname": {"meta": {"key": "iifname"}},
+    "meta l4proto": {"meta": {"key": "l4proto"}},
+    "th dport": {"payload": {"protocol": "th", "field": "dport"}},
+    "tcp dport": {"payload": {"protocol": "tcp", "field": "dport"}},
+    "udp dport": {"payload": {"protocol": "udp", "field": "dport"}},
+    "tcp sport": {"payload": {"protocol": "tcp", "field": "sport"}},
+    "udp sport": {"payload": {"protocol": "udp", "field": "sport"}},
+    "ip saddr": {"payload": {"protocol": "ip", "field": "saddr"}},
+    "ip6 saddr": {"payload": {"protocol": "ip6", "field": "saddr"}},
+    "icmp type": {"payload": {"protocol": "icmp", "field": "type"}},
+    "fib daddr type": {"fib": {"result": "type", "flags": ["daddr"]}},
+    "fib saddr type": {"fib": {"result": "type", "flags": ["saddr"]}},
+}
+
+
+def operand_to_text(left) -> str:
+    if isinstance(left, dict) and "payload" in left:
+        return f"{left['payload'].get('protocol', '')} {left['payload'].get('field', '')}"
+    if isinstance(left, dict) and "meta" in left:
+        key = left["meta"].get("key", "")
+        # nft stampa "meta" esplicito solo per le chiavi non abbreviabili
+        return key if key in ("iif", "iifname", "oif", "oifname") else f"meta {key}"
+    if isinstance(left, dict) and "ct" in left:
+        return f"ct {left['ct'].get('key', '')}"
+    if isinstance(left, dict) and "fib" in left:
+        flags = left["fib"].get("flags", [])
+        flags = [flags] if isinstance(flags, str) else flags
+        return f"fib {' . '.join(flags)} {left['fib'].get('result', '')}"
+    if isinstance(left, dict) and "concat" in left:
+        return " . ".join(operand_to_text(x) for x in left["concat"])
+    if isinstance(left, dict) and "&" in left:
+        return " & ".join(operand_to_text(x) for x in left["&"])
+    if isinstance(left, dict) and "|" in left:
+        return "(" + "|".join(str(x) for x in left["|"]) + ")"
+    return json.dumps(left, sort_keys=True)
+
+
+def expr_to_text(expr: List) -> str:
+    """
+    Converte (in modo approssimato) l'espressione JSON di una regola nella sintassi testuale
+    di nft, sufficiente per riconoscere le regole generate da firewall_ai.
+    I counter anonimi sono ignorati: non cambiano la semantica della regola.
+    """
+    parts = []
+    for stmt in expr or []:
+        if not isinstance(stmt, dict):
+            continue
+        if "counter" in stmt:
+            ref = stmt["counter"]
+            if isinstance(ref, dict) and "map" in ref:
+                parts.append(f"counter name {operand_to_text(ref['map'].get('key'))} map {ref['map'].get('data')}")
+            elif isinstance(ref, str):
+                parts.append(f"counter name {ref}")
+            continue
+        if "limit" in stmt:
+            parts.append(limit_to_text(stmt["limit"]))
+        elif "set" in stmt:
+            # statement su set dinamico: add/update @set { chiave [statement] }
+            st = stmt["set"]
+            inner = [operand_to_text(st.get("elem"))] + [expr_to_text([x]) for x in st.get("stmt") or []]
+            parts.append(f"{st.get('op')} {st.get('set')} {{ {' '.join(inner)} }}")
+        elif "notrack" in stmt:
+            parts.append("notrack")
+        elif "log" in stmt:
+            parts.append(log_to_text(stmt["log"]))
+        elif "flow" in stmt:
+            parts.append(f"flow {stmt['flow'].get('op', 'add')} {stmt['flow'].get('flowtable')}")
+        elif "vmap" in stmt:
+            parts.append(f"{operand_to_text(stmt['vmap'].get('key'))} vmap {stmt['vmap'].get('data')}")
+        elif "match" in stmt:
+            m = stmt["match"]
+            left = m.get("left", {})
+            right = m.get("right")
+            lhs = operand_to_text(left)
+            if isinstance(right, dict) and "prefix" in right:
+                rhs = f"{right['prefix'].get('addr')}/{right['prefix'].get('len')}"
+            elif isinstance(right, dict) and "|" in right:
+                rhs = "|".join(str(r) for r in right["|"])
+            elif isinstance(right, dict) and "set" in right:
+                rhs = ",".join(str(r) for r in right["set"])
+            elif isinstance(right, list):
+                rhs = ",".join(str(r) for r in right)
+            elif isinstance(right, str) and not right.startswith("@") and lhs in ("iif", "iifname", "oif", "oifname"):
+                rhs = f'"{right}"'
+            else:
+                rhs = str(right)
+            parts.append(f"{lhs} {rhs}")
+        else:
+            for verdict in VERDICTS:
+                if verdict in stmt:
+                    parts.append(verdict)
+                    break
+            else:
+                parts.append(json.dumps(stmt, sort_keys=True))
+    return " ".join(parts)
+
+
+def limit_to_text(limit: Dict) -> str:
+    """Statement limit in pacchetti: 'limit rate [over] 10/second burst 20 packets'."""
+    text = f"limit rate {'over ' if limit.get('inv') else ''}{limit.get('rate')}/{limit.get('per', 'second')}"
+    if limit.get("burst"):
+        text += f" burst {limit['burst']} packets"
+    return text
+
+
+def log_to_text(log: Optional[Dict]) -> str:
+    """Statement log verso un gruppo NFLOG: 'log group 5 snaplen 64'."""
+    return " ".join(["log"] + [f"{k} {log[k]}" for k in _LOG_OPTIONS if k in (log or {})])
+
+
+def _parse_log(tokens: List[str], i: int):
+    """'log [group N] [snaplen N]' a partire da tokens[i] ("log")."""
+    log = {}
+    i += 1
+    while i + 1 < len(tokens) and tokens[i] in _LOG_OPTIONS:
+        log[tokens[i]] = int(tokens[i + 1])
+        i += 2
+    return {"log": log or None}, i
+
+
+def _parse_limit(tokens: List[str], i: int):
+    """'limit rate [over] N/unità [burst M packets]' a partire da tokens[i] ("limit")."""
+    if tokens[i + 1] != "rate":
+        raise ValueError(f"limit non supportato: {' '.join(tokens[i:])!r}")
+    i += 2
+    inv = tokens[i] == "over"
+    i += inv
+    rate, _, per = tokens[i].partition("/")
+    limit = {"rate": int(rate), "per": per or "second"}
+    if inv:
+        limit["inv"] = True
+    i += 1
+    if i < len(tokens) and tokens[i] == "burst":
+        limit["burst"] = int(tokens[i + 1])
+        i += 3 if i + 2 < len(tokens) and tokens[i + 2] == "packets" else 2
+    return {"limit": limit}, i
+
+
+def rule_tag(expr: List) -> str:
+    """Tag di una regola generata: hash del contenuto (espressione JSON, counter compresi)."""
+    digest = hashlib.sha256(json.dumps(expr, sort_keys=True).encode()).hexdigest()
+    return TAG_PREFIX + digest[:12]
+
+
+def strip_comment(text: str) -> str:
+    """Testo di una regola senza il `comment "..."` finale (come stampato da `nft list`)."""
+    return text.split(' comment "', 1)[0]
+
+
+def _parse_key(tokens: List[str], i: int):
+    """Selettore (anche concatenato con ' . ') a partire da tokens[i]; ritorna (operando, indice)."""
+    operands = []
+    while True:
+        pair = " ".join(tokens[i:i + 2])
+        triple = " ".join(tokens[i:i + 3])
+        if triple in _SELECTORS:
+            operands.append(_SELECTORS[triple])
+            i += 3
+        elif pair in _SELECTORS:
+            operands.append(_SELECTORS[pair])
+            i += 2
+        elif tokens[i] in _SELECTORS:
+            operands.append(_SELECTORS[tokens[i]])
+            i += 1
+        else:
+            raise ValueError(f"selettore non supportato: {' '.join(tokens[i:])!r}")
+        if i < len(tokens) and tokens[i] == ".":
+            i += 1
+            continue
+        break
+    return (operands[0] if len(operands) == 1 else {"concat": operands}), i
+
+
+def _is_selector(tokens: List[str], i: int) -> bool:
+    return i < len(tokens) and any(" ".join(tokens[i:i + n]) in _SELECTORS for n in (1, 2, 3))
+
+
+def _parse_value(token: str):
+    if "," in token:
+        return [_parse_value(t) for t in token.split(",")]
+    token = token.strip('"')
+    return int(token) if token.isdigit() else token
+
+
+def element_key(e) -> str:
+    """Chiave testuale normalizzata di un elemento JSON (senza timeout/scadenza)."""
+    if isinstance(e, list) and len(e) == 2:
+        data = e[1]
+        if isinstance(data, dict):
+            data = next(iter(data), "?")
+        return f"{element_key(e[0])} : {data}"
+    if isinstance(e, dict):
+        if "elem" in e:
+            return element_key(e["elem"].get("val"))
+        if "concat" in e:
+            return " . ".join(element_key(x) for x in e["concat"])
+        if "prefix" in e:
+            return f"{e['prefix'].get('addr')}/{e['prefix'].get('len')}"
+        if "range" in e:
+            lo, hi = e["range"]
+            return f"{element_key(lo)}-{element_key(hi)}"
+    return str(e)
+
+
+def element_text(e) -> str:
+    """Elemento nella sintassi di `nft -f` (con timeout e dato della map)."""
+    if isinstance(e, list) and len(e) == 2:
+        data = e[1]
+        data = next(iter(data), "?") if isinstance(data, dict) else f'"{data}"'
+        return f"{element_text(e[0])} : {data}"
+    if isinstance(e, dict) and "elem" in e:
+        text = element_key(e["elem"].get("val"))
+        if e["elem"].get("timeout"):
+            text += f" timeout {int(e['elem']['timeout'])}s"
+        return text
+    return element_key(e)
+
+
+@dataclass(slots=True)
+class Rule:
+    expr: List
+    text: str = ""
+    comment: Optional[str] = None
+    handle: Optional[int] = None    # solo per le regole lette dal kernel
+
+    @classmethod
+    def parse(cls, text: str) -> "Rule":
+        """
+        Regola generata (es. 'tcp dport @tcp_services counter accept') -> espressione JSON.
+        Il commento è il tag del contenuto, salvo un `comment "..."` esplicito nel testo.
+        """
+        text, _, comment = text.partition(' comment "')
+        comment = comment.rstrip().rstrip('"') or None
+        tokens = text.split()
+        expr = []
+        i = 0
+        while i < len(tokens):
+            tok = tokens[i]
+            if tok == "counter":
+                if tokens[i + 1:i + 2] == ["name"] and not _is_selector(tokens, i + 2):
+                    # counter nominato (oggetto `counter <nome>` della table)
+                    expr.append({"counter": tokens[i + 2]})
+                    i += 3
+                elif i + 1 < len(tokens) and tokens[i + 1] == "name":
+                    key, i = _parse_key(tokens, i + 2)
+                    if tokens[i] != "map":
+                        raise ValueError(f"counter name senza map: {text!r}")
+                    expr.append({"counter": {"map": {"key": key, "data": tokens[i + 1]}}})
+                    i += 2
+                else:
+                    expr.append({"counter": None})
+                    i += 1
+            elif tok in VERDICTS or tok == "notrack":
+                expr.append({tok: None})
+                i += 1
+            elif tok == "limit":
+                stmt, i = _parse_limit(tokens, i)
+                expr.append(stmt)
+            elif tok == "log":
+                stmt, i = _parse_log(tokens, i)
+                expr.append(stmt)
+            elif tok == "flow" and tokens[i + 1:i + 2] == ["add"]:
+                # flow add @ft: il flusso passa al fast path della flowtable
+                expr.append({"flow": {"op": "add", "flowtable": tokens[i + 2]}})
+                i += 3
+            elif tok in ("add", "update") and tokens[i + 1].startswith("@"):
+                # add @set { chiave [limit ...] }: aggiorna un set dinamico dal percorso dei pacchetti
+                name = tokens[i + 1]
+                if tokens[i + 2] != "{":
+                    raise ValueError(f"attesa '{{' dopo {name}: {text!r}")
+                key, i = _parse_key(tokens, i + 3)
+                stmts = []
+                while tokens[i] != "}":
+                    if tokens[i] != "limit":
+                        raise ValueError(f"statement non supportato in {name}: {text!r}")
+                    stmt, i = _parse_limit(tokens, i)
+                    stmts.append(stmt)
+                st = {"op": tok, "elem": key, "set": name}
+                if stmts:
+                    st["stmt"] = stmts
+                expr.append({"set": st})
+                i += 1
+            else:
+                key, i = _parse_key(tokens, i)
+                if tokens[i] == "vmap":
+                    expr.append({"vmap": {"key": key, "data": tokens[i + 1]}})
+                    i += 2
+                else:
+                    value = _parse_value(tokens[i])
+                    op = "in" if isinstance(value, list) else "=="
+                    expr.append({"match": {"op": op, "left": key, "right": value}})
+                    i += 1
+        return cls(expr=expr, text=text, comment=comment or rule_tag(expr))
+
+    @property
+    def key(self) -> str:
+        return expr_to_text(self.expr)
+
+    @property
+    def tagged(self) -> bool:
+        return bool(self.comment and self.comment.startswith(TAG_PREFIX))
+
+    def to_text(self) -> str:
+        text = self.text or self.key
+        return f'{text} comment "{self.comment}"' if self.comment else text
+
+    def to_json(self, family: str, table: str, chain: str) -> Dict:
+        obj = {"family": family, "table": table, "chain": chain, "expr": self.expr}
+        if self.comment:
+            obj["comment"] = self.comment
+        return obj
+
+
+@dataclass(slots=True)
+class Set:
+    name: str
+    type: str
+    flags: tuple = ()
+    elements: List = field(default_factory=list)
+    data: Optional[str] = None      # "verdict" / "counter": il set è una map
+    timeout: Optional[int] = None   # timeout predefinito (secondi) degli elementi, es. set dinamici
+    size: Optional[int] = None
+
+    @property
+    def kind(self) -> str:
+        return "map" if self.data else "set"
+
+    def element_keys(self) -> set:
+        # per le map conta solo la chiave: il dato non identifica l'elemento
+        return {element_key(e).split(" : ")[0] for e in self.elements}
+
+    @property
+    def definition(self) -> str:
+        """Definizione su una riga, senza elementi: 'type ipv4_addr; flags interval;'."""
+        type_ = f"{self.type} : {self.data}" if self.data else self.type
+        parts = [f"type {type_};"]
+        if self.flags:
+            parts.append(f"flags {', '.join(self.flags)};")
+        if self.timeout:
+            parts.append(f"timeout {int(self.timeout)}s;")
+        if self.size:
+            parts.append(f"size {int(self.size)};")
+        return " ".join(parts)
+
+    def to_text(self) -> str:
+        type_ = f"{self.type} : {self.data}" if self.data else self.type
+        text = f"  {self.kind} {self.name} {{\n    type {type_}\n"
+        if self.flags:
+            text += f"    flags {', '.join(self.flags)}\n"
+        if self.timeout:
+            text += f"    timeout {int(self.timeout)}s\n"
+        if self.size:
+            text += f"    size {int(self.size)}\n"
+        if self.elements:
+            text += f"    elements = {{ {', '.join(element_text(e) for e in self.elements)} }}\n"
+        return text + "  }\n\n"
+
+    def to_json(self, family: str, table: str) -> Dict:
+        parts = self.type.split(" . ")
+        obj = {"family": family, "table": table, "name": self.name,
+               "type": parts[0] if len(parts) == 1 else parts}
+        if self.data:
+            obj["map"] = self.data
+        if self.flags:
+            obj["flags"] = list(self.flags)
+        if self.timeout:
+            obj["timeout"] = int(self.timeout)
+        if self.size:
+            obj["size"] = int(self.size)
+        if self.elements:
+            obj["elem"] = list(self.elements)
+        return {self.kind: obj}
+
+
+@dataclass(slots=True)
+class Flowtable:
+    name: str
+    devices: List[str] = field(default_factory=list)
+    hook: str = "ingress"
+    prio: int = 0
+
+    def to_text(self) -> str:
+        text = f"  flowtable {self.name} {{\n    hook {self.hook} priority {self.prio}\n"
+        if self.devices:
+            text += f"    devices = {{ {', '.join(self.devices)} }}\n"
+        return text + "  }\n\n"
+
+    def to_json(self, family: str, table: str) -> Dict:
+        obj = {"family": family, "table": table, "name": self.name, "hook": self.hook, "prio": self.prio}
+        if self.devices:
+            obj["dev"] = list(self.devices)
+        return {"flowtable": obj}
+
+
+@dataclass(slots=True)
+class Chain:
+    name: str
+    type: Optional[str] = None
+    hook: Optional[str] = None
+    prio: Optional[int] = None
+    policy: Optional[str] = None
+    rules: List[Rule] = field(default_factory=list)
+    device: Optional[str] = None    # solo per le chain netdev (hook ingress)
+
+    @property
+    def definition(self) -> str:
+        hook = f'{self.hook} device "{self.device}"' if self.device else self.hook
+        return f"type {self.type} hook {hook} priority {self.prio}; policy {self.policy};"
+
+    def to_text(self) -> str:
+        if not self.rules:
+            return f"  chain {self.name} {{ {self.definition} }}\n"
+        text = f"  chain {self.name} {{\n    {self.definition}\n"
+        for rule in self.rules:
+            text += f"    {rule.to_text()}\n"
+        return text + "  }\n\n"
+
+
+@dataclass(slots=True)
+class Table:
+    family: str = "inet"
+    name: str = "filter"
+    exists: bool = True
+    counters: List[str] = field(default_factory=list)
+    sets: Dict[str, Set] = field(default_factory=dict)
+    chains: Dict[str, Chain] = field(default_factory=dict)
+    flowtables: Dict[str, Flowtable] = field(default_factory=dict)
+    # indice delle regole con tag: (chain, tag) -> handle, costruito da from_json
+    handles: Dict[Tuple[str, str], int] = field(default_factory=dict)
+
+    def to_text(self, header: bool = True) -> str:
+        """Blocco `table ... { }`; header=False omette lo shebang (table accodata a un altro file)."""
+        text = f"#!/usr/sbin/nft -f\n" if header else ""
+        text += f"table {self.family} {self.name} {{\n"
+        for name in self.counters:
+            text += f"  counter {name} {{\n  }}\n\n"
+        for s in self.sets.values():
+            text += s.to_text()
+        for ft in self.flowtables.values():
+            text += ft.to_text()
+        for chain in self.chains.values():
+            text += chain.to_text()
+        return text + "}\n"
+
+    def to_json(self) -> Dict:
+        """Ruleset per `nft -j -f`: oggetti in ordine di dipendenza (table, counter, set, flowtable, chain, regole)."""
+        fam, tab = self.family, self.name
+        # `add table` su una table esistente non ha effetti: la table è sempre inclusa
+        objs = [{"metainfo": {"json_schema_version": 1}}, {"table": {"family": fam, "name": tab}}]
+        objs += [{"counter": {"family": fam, "table": tab, "name": n}} for n in self.counters]
+        objs += [s.to_json(fam, tab) for s in self.sets.values()]
+        objs += [ft.to_json(fam, tab) for ft in self.flowtables.values()]
+        for chain in self.chains.values():
+            if chain.type:
+                obj = {"family": fam, "table": tab, "name": chain.name, "type": chain.type,
+                       "hook": chain.hook, "prio": chain.prio, "policy": chain.policy}
+                if chain.device:
+                    obj["dev"] = chain.device
+                objs.append({"chain": obj})
+        for chain in self.chains.values():
+            objs += [{"rule": r.to_json(fam, tab, chain.name)} for r in chain.rules]
+        return {"nftables": objs}
+
+    @classmethod
+    def from_json(cls, data: Dict, family: str = "inet", name: str = "filter") -> "Table":
+        """Table dallo stato JSON di nft; exists=False se la table non c'è."""
+        table = cls(family=family, name=name, exists=False)
+        for obj in (data or {}).get("nftables", []):
+            kind = next((k for k in ("table", "chain", "set", "map", "counter", "flowtable", "rule") if k in obj), None)
+            if kind is None:
+                continue
+            o = obj[kind]
+            if kind == "table":
+                if o.get("family") == family and o.get("name") == name:
+                    table.exists = True
+                continue
+            if o.get("family") != family or o.get("table") != name:
+                continue
+            if kind == "chain":
+                table.chains[o["name"]] = Chain(o["name"], o.get("type"), o.get("hook"), o.get("prio"), o.get("policy"),
+                                                device=o.get("dev"))
+            elif kind in ("set", "map"):
+                type_ = o.get("type")
+                table.sets[o["name"]] = Set(
+                    name=o["name"],
+                    type=" . ".join(type_) if isinstance(type_, list) else str(type_),
+                    flags=tuple(o.get("flags") or ()),
+                    elements=list(o.get("elem") or []),
+                    data=o.get("map"),
+                    timeout=o.get("timeout"),
+                    size=o.get("size"),
+                )
+            elif kind == "counter":
+                table.counters.append(o["name"])
+            elif kind == "flowtable":
+                dev = o.get("dev") or []
+                table.flowtables[o["name"]] = Flowtable(o["name"], [dev] if isinstance(dev, str) else list(dev),
+                                                        o.get("hook", "ingress"), o.get("prio", 0))
+            else:
+                chain = table.chains.setdefault(o.get("chain"), Chain(o.get("chain")))
+                rule = Rule(expr=o.get("expr") or [], comment=o.get("comment"), handle=o.get("handle"))
+                chain.rules.append(rule)
+                if rule.tagged and rule.handle is not None:
+                    table.handles[(chain.name, rule.comment)] = rule.handle
+        return table
+
+    def has_element(self, set_name: str, key) -> bool:
+        s = self.sets.get(set_name)
+        return s is not None and str(key) in s.element_keys()
+
+    def has_rule(self, chain: str, rule: Rule) -> bool:
+        """Presenza per tag (O(1) sull'indice dei handle) o, in mancanza, per chiave normalizzata."""
+        if rule.tagged and (chain, rule.comment) in self.handles:
+            return True
+        c = self.chains.get(chain)
+        return c is not None and rule.key in {r.key for r in c.rules}
+
+    def missing_from(self, live: "Table", rules: bool = True) -> "Table":
+        """
+        Gli oggetti di questa table (stato desiderato) assenti in `live`: table, counter,
+        set/map (con i loro elementi), chain e, con rules=True, regole. Gli oggetti esistenti
+        non vengono modificati; applicarne il JSON equivale a una serie di `nft add` idempotenti.
+        """
+        out = Table(self.family, self.name, exists=not live.exists)
+        out.counters = [n for n in self.counters if n not in live.counters]
+        out.sets = {n: s for n, s in self.sets.items() if n not in live.sets}
+        out.flowtables = {n: ft for n, ft in self.flowtables.items() if n not in live.flowtables}
+        for name, chain in self.chains.items():
+            have = live.chains.get(name)
+            missing = [r for r in chain.rules if rules and not live.has_rule(name, r)]
+            if have is None or not have.type:
+                out.chains[name] = Chain(name, chain.type, chain.hook, chain.prio, chain.policy, missing, chain.device)
+            elif missing:
+                out.chains[name] = Chain(name, rules=missing)
+        return out
+
+    def is_empty(self) -> bool:
+        return not (self.exists or self.counters or self.sets or self.flowtables or any(
+            c.type or c.rules for c in self.chains.values()))
+
+
+def diff(current: Table, desired: Table) -> List[Dict]:
+    """
+    Differenze strutturali tra lo stato attuale e quello desiderato, nel formato di plan.format_plan:
+      {"action": "+"|"-"|"~", "kind", "table", "target", "value", "note"}
+    Gli oggetti presenti solo in `current` sono rimozioni. Gli elementi dei set dinamici
+    (meter dei limiti) sono stato del kernel e non vengono confrontati.
+    """
+    changes = []
+    where = f"{desired.family} {desired.name}"
+
+    def add(action, kind, target, value=None, note=""):
+        changes.append({"action": action, "kind": kind, "table": where, "target": target, "value": value,
+                        "note": note})
+
+    if not desired.exists:
+        if current.exists:
+            add("-", "table", where)
+        return changes
+    if not current.exists:
+        add("+", "table", where)
+    for name in desired.counters:
+        if name not in current.counters:
+            add("+", "counter", name)
+    for name in current.counters:
+        if name not in desired.counters:
+            add("-", "counter", name)
+    for name, want in desired.sets.items():
+        have = current.sets.get(name)
+        if have is None:
+            add("+", "set", name, want.definition)
+        elif (have.type, have.data) != (want.type, want.data) or set(have.flags) != set(want.flags):
+            add("~", "set", name, want.definition, "richiede la ricreazione del set (--flush)")
+        if "dynamic" in want.flags:
+            continue
+        have_keys = {element_key(e) for e in (have.elements if have else [])}
+        want_keys = [element_key(e) for e in want.elements]
+        for key in want_keys:
+            if key not in have_keys:
+                add("+", "element", name, key)
+        for key in sorted(have_keys - set(want_keys)):
+            add("-", "element", name, key)
+    for name, have in current.sets.items():
+        if name not in desired.sets:
+            add("-", "set", name, have.definition)
+    for name, want in desired.flowtables.items():
+        have = current.flowtables.get(name)
+        if have is None:
+            add("+", "flowtable", name, f"devices = {{ {', '.join(want.devices)} }}")
+        elif set(have.devices) != set(want.devices):
+            add("~", "flowtable", name, f"devices = {{ {', '.join(want.devices)} }}")
+    for name in current.flowtables:
+        if name not in desired.flowtables:
+            add("-", "flowtable", name)
+    for name, want in desired.chains.items():
+        have = current.chains.get(name)
+        if have is None or not have.type:
+            add("+", "chain", name, want.definition)
+        elif have.policy != want.policy:
+            add("~", "chain", name, f"policy {have.policy} -> {want.policy}")
+        have_rules = [r.key for r in (have.rules if have else [])]
+        want_rules = [r.key for r in want.rules]
+        for key in want_rules:
+            if key not in have_rules:
+                add("+", "rule", name, key)
+        for key in have_rules:
+            if key not in want_rules:
+                add("-", "rule", name, key)
+    for name, have in current.chains.items():
+        if name not in desired.chains:
+            add("-", "chain", name, have.definition if have.type else None)
+    return changes
+
+
+def sync_rules(live: Table, desired: Table, managed: set) -> List[Dict]:
+    """
+    Comandi JSON (`nft -j -f`) che allineano le regole di `live` a quelle di `desired`,
+    indirizzando le regole esistenti per handle (indice Table.handles, nessuna riscrittura della chain):
+    - le regole desiderate già presenti (Table.has_rule) non generano comandi;
+    - le regole con un tag in `managed` la cui chiave non è più desiderata vengono
+      sostituite per handle con una regola nuova della stessa chain (`replace`, la posizione
+      resta invariata) oppure rimosse (`delete`);
+    - le regole nuove rimanenti sono aggiunte in coda alla chain (`add`).
+    Le regole senza tag, o con tag non in `managed`, non vengono mai modificate.
+    """
+    fam, tab = live.family, live.name
+    commands = []
+    for name, chain in desired.chains.items():
+        wanted = {r.key for r in chain.rules}
+        stale = [r.handle for r in (live.chains[name].rules if name in live.chains else [])
+                 if r.comment in managed and r.handle is not None and r.key not in wanted]
+        for rule in (r for r in chain.rules if not live.has_rule(name, r)):
+            if stale:
+                commands.append({"replace": {"rule": dict(rule.to_json(fam, tab, name), handle=stale.pop(0))}})
+            else:
+                commands.append({"add": {"rule": rule.to_json(fam, tab, name)}})
+        commands += [{"delete": {"rule": {"family": fam, "table": tab, "chain": name, "handle": h}}}
+                     for h in stale]
+    return commands
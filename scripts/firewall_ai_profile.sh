@@ -27,11 +27,13 @@ fw-rm-udp() {
   sudo nft list set inet filter udp_services
 }
 fw-regenerate-and-apply() {
-  echo "Genero rules/firewall.rules e applico"
-  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" || { echo "Errore generazione"; return 1; }
-  sudo nft -f "$FIREWALL_AI_RULES" || { echo "Errore applicazione"; return 1; }
+  echo "Genero rules/firewall.rules e applico in una transazione"
+  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" --atomic || { echo "Errore applicazione, ruleset invariato"; return 1; }
   echo "Fatto"
 }
+fw-rollback() {
+  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" rollback || { echo "Errore rollback"; return 1; }
+}
 fw-readme() {
   local repo_url="https://github.com/robertozz/firewall_ai"
   if command -v xdg-open >/dev/null 2>&1; then
@@ -113,11 +113,13 @@ fw-rm-udp() {
   sudo nft list set inet filter udp_services
 }
 fw-regenerate-and-apply() {
-  echo "Genero rules/firewall.rules e applico"
-  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" || { echo "Errore generazione"; return 1; }
-  sudo nft -f "$FIREWALL_AI_RULES" || { echo "Errore applicazione"; return 1; }
+  echo "Genero rules/firewall.rules e applico in una transazione"
+  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" --atomic || { echo "Errore applicazione, ruleset invariato"; return 1; }
   echo "Fatto"
 }
+fw-rollback() {
+  sudo python3 "$FIREWALL_AI_DIR/firewall_ai.py" rollback || { echo "Errore rollback"; return 1; }
+}
 fw-readme() {
   local repo_url="https://github.com/robertozz/firewall_ai"
   if command -v xdg-open >/dev/null 2>&1; then
@@ -169,6 +171,7 @@ echo "fw-add-tcp N  → Aggiunge porta TCP N"
 echo "fw-rm-tcp N   → Rimuove porta TCP N"
 echo "fw-add-udp N  → Aggiunge porta UDP N"
 echo "fw-rm-udp N   → Rimuove porta UDP N"
+echo "fw-rollback   → Ripristina il ruleset precedente all'ultimo apply"
 echo "fw-readme     → Apri il README del progetto"
 echo ""
 EOF
@@ -231,8 +234,33 @@ install_systemd_unit() {
   mv /tmp/firewall-ai.service "$unit_dst"
   chown root:root "$unit_dst"
   chmod 644 "$unit_dst"
+  # watchdog: riallinea il ruleset se la table viene modificata da fuori
+  local watchdog_src="$PROJECT_DIR/systemd/firewall-ai-watchdog.service"
+  if [ -f "$watchdog_src" ]; then
+    sed "s|/home/%i/docker-stacks/firewall_ai|$PROJECT_DIR|g" "$watchdog_src" > /tmp/firewall-ai-watchdog.service
+    mv /tmp/firewall-ai-watchdog.service /etc/systemd/system/firewall-ai-watchdog.service
+    chown root:root /etc/systemd/system/firewall-ai-watchdog.service
+    chmod 644 /etc/systemd/system/firewall-ai-watchdog.service
+  fi
+  # control plane: installato ma non abilitato (systemctl enable --now firewall-ai-api.service)
+  local api_src="$PROJECT_DIR/systemd/firewall-ai-api.service"
+  if [ -f "$api_src" ]; then
+    sed "s|/home/%i/docker-stacks/firewall_ai|$PROJECT_DIR|g" "$api_src" > /tmp/firewall-ai-api.service
+    mv /tmp/firewall-ai-api.service /etc/systemd/system/firewall-ai-api.service
+    chown root:root /etc/systemd/system/firewall-ai-api.service
+    chmod 644 /etc/systemd/system/firewall-ai-api.service
+  fi
+  # campionamento dei drop (rules: drop_log): installato ma non abilitato
+  local drops_src="$PROJECT_DIR/systemd/firewall-ai-drops.service"
+  if [ -f "$drops_src" ]; then
+    sed "s|/home/%i/docker-stacks/firewall_ai|$PROJECT_DIR|g" "$drops_src" > /tmp/firewall-ai-drops.service
+    mv /tmp/firewall-ai-drops.service /etc/systemd/system/firewall-ai-drops.service
+    chown root:root /etc/systemd/system/firewall-ai-drops.service
+    chmod 644 /etc/systemd/system/firewall-ai-drops.service
+  fi
   systemctl daemon-reload
   systemctl enable --now firewall-ai.service || true
+  [ -f "$watchdog_src" ] && { systemctl enable --now firewall-ai-watchdog.service || true; }
   echo "Unit systemd installata e avviata (se possibile)."
 }
 
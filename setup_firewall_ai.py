@@ -27,18 +27,16 @@ write_file("config/services.yaml", """allowed_services:
 """)
 
 # nft.py
-write_file("utils/nft.py", """import subprocess
+write_file("utils/nft.py", """import nft_exec
 
 def apply_rule(port, protocol, action="accept"):
-    cmd = f"nft add rule inet filter input {protocol} dport {port} {action}"
-    subprocess.run(cmd, shell=True)
+    nft_exec.run(["add", "rule", "inet", "filter", "input", protocol, "dport", str(port), action], retries=0, check=False)
 
 def drop_rule(port, protocol):
-    cmd = f"nft add rule inet filter input {protocol} dport {port} drop"
-    subprocess.run(cmd, shell=True)
+    nft_exec.run(["add", "rule", "inet", "filter", "input", protocol, "dport", str(port), "drop"], retries=0, check=False)
 
 def flush_rules():
-    subprocess.run("nft flush ruleset", shell=True)
+    nft_exec.run(["flush", "ruleset"], check=False)
 """)
 
 # monitor.py
@@ -64,8 +62,9 @@ def notify(message):
 """)
 
 # health.py
-write_file("utils/health.py", """import subprocess
-import socket
+write_file("utils/health.py", """import socket
+
+import nft_exec
 
 def check_adguard(port=3000):
     try:
@@ -76,8 +75,10 @@ def check_adguard(port=3000):
         return False
 
 def check_nftables_rule(port, protocol):
-    cmd = f"nft list ruleset"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    try:
+        result = nft_exec.run(["list", "ruleset"], check=False)
+    except Exception:
+        return False
     return f"{protocol} dport {port}" in result.stdout
 
 def check_dns(domain="example.com"):
@@ -196,9 +196,80 @@ def build_html_digest_from_log(path=LOG_FILE, period="day", max_lines=None, titl
     records = _read_log_records(path, since=since, max_lines=max_lines)
     return build_html_digest(records, title=ttl)
 
+# === Tabelle HTML dei digest (traffico, limiti, drop) ===
+_TABLE_TH_STYLE = "text-align:left;padding:6px;border-bottom:1px solid #ccc;font-family:monospace;font-size:12px;"
+_TABLE_TD_STYLE = "padding:6px;border-bottom:1px solid #eee;font-family:monospace;font-size:12px;"
+
+def _html_table(headers, rows):
+    # headers e celle di rows sono già testo HTML (l'escape è a carico del chiamante)
+    parts = ["<table style=\"border-collapse:collapse;width:100%;\"><tr>"]
+    parts.extend(f"<th style=\"{_TABLE_TH_STYLE}\">{h}</th>" for h in headers)
+    parts.append("</tr>")
+    for row in rows:
+        parts.append("<tr>")
+        parts.extend(f"<td style=\"{_TABLE_TD_STYLE}\">{cell}</td>" for cell in row)
+        parts.append("</tr>")
+    parts.append("</table>")
+    return "".join(parts)
+
+# === Tabella top-N traffico per servizio (da data/traffic, vedi traffic.py) ===
+def build_html_traffic_table(period="day", top_n=5, base_dir=BASE_DIR):
+    # Solo lettura dei ring buffer: nessuna chiamata a nft
+    try:
+        from traffic import format_bytes, period_since, top_services
+        rows = top_services(base_dir, top_n, period_since(period))
+    except Exception as e:
+        logger.warning(f"Tabella traffico non disponibile: {e}")
+        return ""
+    if not rows:
+        return ""
+    body = [(html.escape(r["service"]), format_bytes(r["bytes"]), r["packets"], f"{r['bps'] / 1e6:.3f} Mbit/s")
+            for r in rows]
+    return (f"<br><br><b>📊 Top {len(rows)} servizi per traffico</b><br><br>"
+            + _html_table(("Servizio", "Traffico", "Pacchetti", "Media"), body))
+
+# === Tabella dei limiti per servizio (counter lim_*, vedi rules_generator.service_limits) ===
+def build_html_limit_table(period="day", top_n=5, base_dir=BASE_DIR):
+    try:
+        from traffic import LIMIT_PREFIX, period_since, top_services
+        rows = top_services(base_dir, top_n, period_since(period), prefix=LIMIT_PREFIX)
+    except Exception as e:
+        logger.warning(f"Tabella limiti non disponibile: {e}")
+        return ""
+    rows = [r for r in rows if r["packets"]]
+    if not rows:
+        return ""
+    body = [(html.escape(r["service"]), r["packets"], f"{r['pps']:.2f} pkt/s") for r in rows]
+    return ("<br><br><b>🛡️ Connessioni scartate dai limiti</b><br><br>"
+            + _html_table(("Servizio", "Scartate", "Media"), body))
+
+# === Tabella dei drop campionati via NFLOG (data/drops, vedi drops.py) ===
+def build_html_drops_table(period="day", top_n=5, base_dir=BASE_DIR):
+    try:
+        from drops import top_drops
+        summary = top_drops(base_dir, top_n, period)
+    except Exception as e:
+        logger.warning(f"Tabella drop non disponibile: {e}")
+        return ""
+    if not summary:
+        return ""
+    parts = [f"<br><br><b>🚫 Pacchetti scartati (campione di {summary['total']})</b><br><br>"]
+    for title, key in (("Sorgente", "sources"), ("Porta", "ports"), ("Protocollo", "protocols")):
+        if not summary[key]:
+            continue
+        # errore dello sketch Space-Saving: il conteggio è una sovrastima di al più `error`
+        body = [(html.escape(item), f"{count} (±{error})" if error else count)
+                for item, count, error in summary[key]]
+        parts.append(_html_table((title, "Campioni"), body) + "<br>")
+    return "".join(parts)
+
 # === Invio digest HTML ===
-def send_log_digest_html(period="day", max_lines=None, conf_file=CONFIG_FILE):
+def send_log_digest_html(period="day", max_lines=None, conf_file=CONFIG_FILE, top_n=5):
     html_msg = build_html_digest_from_log(LOG_FILE, period=period, max_lines=max_lines)
+    if top_n:
+        html_msg += build_html_traffic_table(period=period, top_n=top_n)
+        html_msg += build_html_limit_table(period=period, top_n=top_n)
+        html_msg += build_html_drops_table(period=period, top_n=top_n)
     token, chat_id = read_config(conf_file)
     send_telegram_message(token, chat_id, html_msg, mode="HTML")
 
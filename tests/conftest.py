@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# i moduli del progetto sono al livello della root, non in un package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,29 @@
+"""Test dell'aggregazione degli indirizzi per i set interval."""
+
+import ipaddress
+
+from addresses import aggregate, format_interval
+
+
+def _ip(text):
+    return int(ipaddress.ip_address(text))
+
+
+def test_aggregate_merges_overlapping_and_adjacent():
+    out = aggregate(["10.0.0.0/25", "10.0.0.128/25", "10.0.0.5", "192.168.1.0/24", "192.168.1.77",
+                     "2001:db8::/33", "2001:db8:8000::/33", "bogus", "# commento", ""])
+    assert out[4] == [(_ip("10.0.0.0"), _ip("10.0.0.255")), (_ip("192.168.1.0"), _ip("192.168.1.255"))]
+    assert out[6] == [(_ip("2001:db8::"), _ip("2001:db8:ffff:ffff:ffff:ffff:ffff:ffff"))]
+
+
+def test_aggregate_keeps_gaps_and_ignores_host_bits():
+    out = aggregate(["10.0.0.1/24", "10.0.2.0/24"])
+    assert out[4] == [(_ip("10.0.0.0"), _ip("10.0.0.255")), (_ip("10.0.2.0"), _ip("10.0.2.255"))]
+    assert aggregate([]) == {4: [], 6: []}
+
+
+def test_format_interval():
+    assert format_interval(_ip("10.0.0.0"), _ip("10.0.0.255"), 4) == "10.0.0.0/24"
+    assert format_interval(_ip("10.0.0.5"), _ip("10.0.0.5"), 4) == "10.0.0.5"
+    assert format_interval(_ip("10.0.0.5"), _ip("10.0.0.9"), 4) == "10.0.0.5-10.0.0.9"
+    assert format_interval(_ip("2001:db8::"), _ip("2001:db8::ffff"), 6) == "2001:db8::/112"
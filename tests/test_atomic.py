@@ -0,0 +1,61 @@
+"""Test di generazioni e rollback di atomic.py (nft sostituito da un registratore)."""
+
+import pytest
+
+import atomic
+from ruleset import Table
+
+RULES = "#!/usr/sbin/nft -f\ntable inet filter {\n  chain input {\n    type filter hook input priority 0; policy drop;\n  }\n}\n"
+
+
+@pytest.fixture
+def nft(monkeypatch):
+    """Script passati a `nft -f` (le validazioni -c sono ignorate); nessuna table live."""
+    applied = []
+    monkeypatch.setattr(atomic, "load_live_table", lambda family="inet", table="filter": Table(family, table, exists=False))
+    monkeypatch.setattr(atomic, "_run_nft_file", lambda script, check_only=False: None if check_only else applied.append(script))
+    return applied
+
+
+def test_rollback_of_absent_table_deletes_it(tmp_path, monkeypatch, nft):
+    monkeypatch.setattr(atomic, "snapshot_table", lambda family="inet", table="filter": None)
+    rules = tmp_path / "firewall.rules"
+    rules.write_text(RULES)
+
+    generation = atomic.apply_atomic(str(tmp_path), str(rules))
+    assert generation.read_text().startswith(atomic.ABSENT_MARK)
+    assert "flush table inet filter" in nft[0]
+
+    assert atomic.rollback(str(tmp_path)) == generation
+    script = nft[1]
+    assert "delete table inet filter" in script
+    assert "flush table" not in script and "policy drop" not in script
+    assert atomic.list_generations(tmp_path) == []
+
+
+def test_rollback_of_absent_table_keeps_saved_ingress(tmp_path, monkeypatch, nft):
+    ingress = "table netdev fwai_ingress {\n  chain ingress_eth0 {\n  }\n}\n"
+    monkeypatch.setattr(atomic, "snapshot_table",
+                        lambda family="inet", table="filter": ingress if family == "netdev" else None)
+    rules = tmp_path / "firewall.rules"
+    rules.write_text(RULES)
+    atomic.apply_atomic(str(tmp_path), str(rules))
+    atomic.rollback(str(tmp_path))
+    assert nft[1].splitlines()[1:] == ["add table inet filter", "delete table inet filter",
+                                       "add table netdev fwai_ingress", "delete table netdev fwai_ingress",
+                                       *ingress.strip().splitlines()]
+
+
+def test_legacy_empty_generation_is_treated_as_absent(tmp_path, nft):
+    atomic.save_generation(tmp_path, "table inet filter {\n}\n")
+    atomic.rollback(str(tmp_path))
+    assert "delete table inet filter" in nft[0] and "flush table" not in nft[0]
+
+
+def test_existing_table_is_restored_with_flush(tmp_path, monkeypatch, nft):
+    monkeypatch.setattr(atomic, "snapshot_table", lambda family="inet", table="filter": None if family == "netdev" else RULES)
+    rules = tmp_path / "firewall.rules"
+    rules.write_text(RULES)
+    atomic.apply_atomic(str(tmp_path), str(rules))
+    atomic.rollback(str(tmp_path))
+    assert "flush table inet filter" in nft[1] and "delete table inet filter" not in nft[1]
@@ -0,0 +1,63 @@
+"""Test del lock coalescente di firewall_ai.run_coalesced (run_cli sostituito da un registratore)."""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+# il modulo crea la directory dei log all'import
+os.environ.setdefault("FIREWALL_AI_LOG_DIR", tempfile.mkdtemp(prefix="fwai_log_"))
+
+import firewall_ai
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    monkeypatch.setattr(firewall_ai, "LOCKFILE", str(tmp_path / "fw.lock"))
+    monkeypatch.setattr(firewall_ai, "DIRTYFILE", str(tmp_path / "fw.lock.dirty"))
+    calls = []
+    monkeypatch.setattr(firewall_ai, "_run_once", lambda argv=None: calls.append(argv) or 0)
+    return calls
+
+
+def _hold_lock(path):
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+
+def test_is_reconcile():
+    assert firewall_ai._is_reconcile(["apply"])
+    assert firewall_ai._is_reconcile(["--atomic", "--base-dir", "/x"])
+    for argv in (["rollback"], ["ingest", "--full"], ["--netns", "ns1"], ["--all-netns"], ["--flush"]):
+        assert not firewall_ai._is_reconcile(argv)
+
+
+def test_reconcile_is_queued_while_locked(runs):
+    fd = _hold_lock(firewall_ai.LOCKFILE)
+    try:
+        assert firewall_ai.run_coalesced(["--atomic"]) == 0
+    finally:
+        os.close(fd)
+    assert runs == [] and os.path.exists(firewall_ai.DIRTYFILE)
+
+
+def test_explicit_command_waits_for_the_lock(runs):
+    fd = _hold_lock(firewall_ai.LOCKFILE)
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(status=firewall_ai.run_coalesced(["rollback"])))
+    worker.start()
+    time.sleep(0.2)
+    assert runs == [] and worker.is_alive()
+    os.close(fd)
+    worker.join(5)
+    assert result == {"status": 0} and runs == [["rollback"]]
+
+
+def test_pending_trigger_runs_atomic_after_explicit_command(runs):
+    firewall_ai.mark_dirty()
+    assert firewall_ai.run_coalesced(["ingest", "--base-dir", "/b"]) == 0
+    assert runs == [["ingest", "--base-dir", "/b"], ["apply", "--atomic", "--base-dir", "/b"]]
@@ -0,0 +1,130 @@
+"""Test di docker_discovery contro un finto Docker Engine su socket unix."""
+
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+yaml = pytest.importorskip("yaml")
+
+from docker_discovery import DockerDiscovery, entries_from_inspect, entries_from_summary
+
+WEB = {"Id": "web1", "Names": ["/web"], "Labels": {"com.docker.compose.service": "web"},
+       "Ports": [{"IP": "0.0.0.0", "PrivatePort": 80, "PublicPort": 8080, "Type": "tcp"},
+                 {"IP": "::", "PrivatePort": 80, "PublicPort": 8080, "Type": "tcp"}]}
+LOCAL = {"Id": "db1", "Names": ["/db"], "Labels": {},
+         "Ports": [{"IP": "127.0.0.1", "PrivatePort": 5432, "PublicPort": 5432, "Type": "tcp"}]}
+HIDDEN = {"Id": "hidden1", "Names": ["/hidden"], "Labels": {"firewall_ai.expose": "false"},
+          "Ports": [{"IP": "0.0.0.0", "PrivatePort": 53, "PublicPort": 53, "Type": "udp"}]}
+DNS_INSPECT = {"Id": "dns1", "Name": "/dns", "Config": {"Labels": {"firewall_ai.name": "resolver"}},
+               "NetworkSettings": {"Ports": {"53/udp": [{"HostIp": "0.0.0.0", "HostPort": "5353"}],
+                                             "53/tcp": [{"HostIp": "127.0.0.1", "HostPort": "5353"}],
+                                             "8053/tcp": None}}}
+EVENTS = [
+    {"Type": "container", "Action": "start", "Actor": {"ID": "dns1"}},
+    {"Type": "container", "Action": "die", "Actor": {"ID": "web1"}},
+    {"Type": "container", "Action": "destroy", "Actor": {"ID": "web1"}},
+]
+
+
+class FakeDocker(BaseHTTPRequestHandler):
+    """Risponde a /containers/json, /containers/<id>/json e /events (chunked, una riga JSON per evento)."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/containers/json":
+            return self._json([WEB, LOCAL, HIDDEN])
+        if path == "/containers/dns1/json":
+            return self._json(DNS_INSPECT)
+        if path == "/events":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for event in EVENTS:
+                data = json.dumps(event).encode() + b"\n"
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.write(b"0\r\n\r\n")
+            return
+        self._json({"message": "not found"}, status=404)
+
+    def _json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def docker_socket(tmp_path):
+    path = str(tmp_path / "docker.sock")
+    server = socketserver.ThreadingUnixStreamServer(path, FakeDocker)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def _shard(discovery):
+    return yaml.safe_load(discovery.shard_path.read_text(encoding="utf-8"))["allowed_services"]
+
+
+def test_entries_skip_loopback_and_expose_false():
+    assert entries_from_summary(WEB) == [{"name": "web", "port": 8080, "protocol": "tcp"}]
+    assert entries_from_summary(LOCAL) == []
+    assert entries_from_summary(HIDDEN) == []
+    assert entries_from_inspect(DNS_INSPECT) == [{"name": "resolver", "port": 5353, "protocol": "udp"}]
+
+
+def test_resync_and_write_shard(tmp_path, docker_socket):
+    d = DockerDiscovery(str(tmp_path), socket_path=docker_socket, apply=False)
+    d.resync()
+    assert set(d.containers) == {"web1", "db1", "hidden1"}
+    assert d.write_shard() is True
+    assert _shard(d) == [{"name": "web", "port": 8080, "protocol": "tcp"}]
+    # contenuto invariato: il file non viene riscritto
+    assert d.write_shard() is False
+
+
+def test_event_stream_start_die_destroy(tmp_path, docker_socket):
+    d = DockerDiscovery(str(tmp_path), socket_path=docker_socket, apply=False)
+    d.resync()
+    d.write_shard()
+
+    start, die, destroy = list(d.events(since=0))
+    assert start["Action"] == "start" and die["Action"] == "die" and destroy["Action"] == "destroy"
+
+    # start: inspect del container, solo la porta non loopback
+    assert d.handle_event(start) is True
+    assert d.write_shard() is True
+    assert _shard(d) == [{"name": "web", "port": 8080, "protocol": "tcp"},
+                         {"name": "resolver", "port": 5353, "protocol": "udp"}]
+
+    # die rimuove le porte; il destroy successivo non cambia più nulla
+    assert d.handle_event(die) is True
+    assert d.handle_event(destroy) is False
+    assert d.write_shard() is True
+    assert _shard(d) == [{"name": "resolver", "port": 5353, "protocol": "udp"}]
+
+
+def test_ignored_events(tmp_path, docker_socket):
+    d = DockerDiscovery(str(tmp_path), socket_path=docker_socket, apply=False)
+    assert d.handle_event({"Type": "network", "Action": "connect", "Actor": {"ID": "x"}}) is False
+    assert d.handle_event({"Type": "container", "Action": "kill", "Actor": {"ID": "web1"}}) is False
+    # inspect fallito (container sconosciuto: HTTP 404): nessuna modifica
+    assert d.handle_event({"Type": "container", "Action": "start", "Actor": {"ID": "gone"}}) is False
+    assert d.containers == {}
@@ -0,0 +1,87 @@
+"""Test dello sketch Space-Saving e del parsing degli header dei pacchetti scartati."""
+
+import ipaddress
+import struct
+
+from drops import DropStats, SpaceSaving, parse_packet
+
+
+def _ipv4(src, proto, dport=None, frag_offset=0, ihl=5):
+    header = struct.pack("!BBHHHBBH4s4s", 0x40 | ihl, 0, 0, 0, frag_offset, 64, proto, 0,
+                         ipaddress.IPv4Address(src).packed, ipaddress.IPv4Address("192.0.2.1").packed)
+    header += b"\0" * (4 * ihl - 20)
+    l4 = struct.pack("!HH", 40000, dport) if dport is not None else b""
+    return header + l4
+
+
+def _ipv6(src, proto, dport=None):
+    header = struct.pack("!IHBB16s16s", 6 << 28, 0, proto, 64, ipaddress.IPv6Address(src).packed,
+                         ipaddress.IPv6Address("2001:db8::1").packed)
+    return header + (struct.pack("!HH", 40000, dport) if dport is not None else b"")
+
+
+def test_parse_ipv4_tcp_udp_and_icmp():
+    assert parse_packet(_ipv4("198.51.100.7", 6, 22)) == ("198.51.100.7", "tcp", 22)
+    assert parse_packet(_ipv4("198.51.100.7", 17, 53)) == ("198.51.100.7", "udp", 53)
+    assert parse_packet(_ipv4("198.51.100.7", 1)) == ("198.51.100.7", "icmp", None)
+    # header con opzioni: le porte seguono l'IHL
+    assert parse_packet(_ipv4("198.51.100.7", 6, 443, ihl=6)) == ("198.51.100.7", "tcp", 443)
+
+
+def test_parse_ipv4_fragments():
+    # primo frammento (offset 0, MF): l'header L4 c'è
+    assert parse_packet(_ipv4("203.0.113.9", 17, 500, frag_offset=0x2000)) == ("203.0.113.9", "udp", 500)
+    # frammenti successivi: nessuna porta, anche se i byte ci sono
+    assert parse_packet(_ipv4("203.0.113.9", 17, 500, frag_offset=0x2000 | 185)) == ("203.0.113.9", "udp", None)
+
+
+def test_parse_ipv6_and_garbage():
+    assert parse_packet(_ipv6("2001:db8::7", 6, 8080)) == ("2001:db8::7", "tcp", 8080)
+    assert parse_packet(_ipv6("2001:db8::7", 58)) == ("2001:db8::7", "icmpv6", None)
+    # extension header (hop-by-hop): nessuna porta
+    assert parse_packet(_ipv6("2001:db8::7", 0, 22)) == ("2001:db8::7", "0", None)
+    assert parse_packet(b"") is None
+    assert parse_packet(b"\x45" + b"\0" * 10) is None
+    assert parse_packet(b"\x70" + b"\0" * 60) is None
+
+
+def test_space_saving_keeps_heavy_hitters():
+    sketch = SpaceSaving(capacity=3)
+    for _ in range(50):
+        sketch.add("a")
+    for _ in range(30):
+        sketch.add("b")
+    for i in range(20):
+        sketch.add(f"noise{i}")
+    top = sketch.top(2)
+    assert [item for item, _, _ in top] == ["a", "b"]
+    assert top[0] == ("a", 50, 0) and top[1] == ("b", 30, 0)
+    assert sketch.total == 100 and len(sketch.counts) == 3
+    # garanzia dello sketch: conteggio - errore <= frequenza reale <= conteggio
+    for item, count, error in sketch.top(3):
+        if item.startswith("noise"):
+            assert count - error <= 1 <= count
+
+
+def test_space_saving_json_round_trip_and_merge():
+    first, second = SpaceSaving(capacity=2), SpaceSaving(capacity=2)
+    first.add("a", 5)
+    first.add("b", 2)
+    second.add("b", 4)
+    second.add("c", 1)
+    first.merge(SpaceSaving.from_json(second.to_json(), capacity=2))
+    assert first.total == 12
+    assert first.top(5) == [("b", 6, 0), ("a", 5, 0)]
+
+
+def test_drop_stats_observe():
+    stats = DropStats("2026-01-01")
+    stats.observe(_ipv4("198.51.100.7", 6, 22))
+    stats.observe(_ipv4("198.51.100.7", 1))
+    stats.observe(b"")
+    stats.observe(b"\x00garbage")
+    assert stats.sources.top(1) == [("198.51.100.7", 2, 0)]
+    assert stats.ports.top(5) == [("tcp/22", 1, 0)]
+    assert (stats.overruns, stats.unparsed) == (1, 1)
+    restored = DropStats.from_json(stats.to_json())
+    assert restored.protocols.top(5) == stats.protocols.top(5) and restored.unparsed == 1
@@ -0,0 +1,63 @@
+"""Test della pipeline dei feed: normalizzazione e delta rispetto allo snapshot (nft sostituito)."""
+
+import pytest
+
+import feeds
+from feeds import normalize
+
+
+@pytest.fixture
+def scripts(monkeypatch):
+    applied = []
+    monkeypatch.setattr(feeds, "_ensure_feed_set", lambda version: False)
+    monkeypatch.setattr(feeds, "_write_and_apply_nft", applied.append)
+    return applied
+
+
+def test_normalize_dedups_and_merges():
+    keys = normalize(["10.0.0.0/24", "10.0.1.0/24", "10.0.0.7", "bad", "2001:db8::1"])
+    assert [feeds._unpack(k, 4) for k in keys[4]] == [(0x0A000000, 0x0A0001FF)]
+    assert len(keys[6]) == 1
+
+
+def test_first_ingest_flushes_then_only_deltas(tmp_path, scripts):
+    feed = tmp_path / "feed.txt"
+    feed.write_text("203.0.113.1\n203.0.113.2  # commento\n198.51.100.0/24 extra colonna\n")
+    stats = feeds.ingest_feeds(str(tmp_path), [str(feed)], chunk_size=10)
+    assert stats[4] == {"total": 2, "added": 2, "removed": 0, "transactions": 1}
+    assert scripts[0].startswith("flush set inet filter blocklist_v4\n")
+    assert "198.51.100.0/24" in scripts[0] and "203.0.113.1-203.0.113.2" in scripts[0]
+    # v6 vuoto: solo il flush
+    assert scripts[1] == "flush set inet filter blocklist_v6\n"
+
+    scripts.clear()
+    feed.write_text("203.0.113.1\n203.0.113.2\n192.0.2.10\n")
+    stats = feeds.ingest_feeds(str(tmp_path), [str(feed)], chunk_size=10)
+    assert stats[4] == {"total": 2, "added": 1, "removed": 1, "transactions": 2}
+    assert scripts == ["delete element inet filter blocklist_v4 { 198.51.100.0/24 }\n",
+                       "add element inet filter blocklist_v4 { 192.0.2.10 }\n"]
+
+    scripts.clear()
+    assert feeds.ingest_feeds(str(tmp_path), [str(feed)])[4]["transactions"] == 0
+    assert scripts == []
+
+
+def test_failed_apply_drops_the_snapshot(tmp_path, scripts, monkeypatch):
+    feed = tmp_path / "feed.txt"
+    feed.write_text("203.0.113.1\n")
+    feeds.ingest_feeds(str(tmp_path), [str(feed)])
+    assert feeds.load_snapshot(tmp_path, 4) is not None
+
+    def fail(script):
+        raise RuntimeError("nft fallito")
+
+    monkeypatch.setattr(feeds, "_write_and_apply_nft", fail)
+    feed.write_text("203.0.113.9\n")
+    with pytest.raises(RuntimeError):
+        feeds.ingest_feeds(str(tmp_path), [str(feed)])
+    assert feeds.load_snapshot(tmp_path, 4) is None
+
+
+def test_chunking():
+    keys = normalize([f"192.0.2.{i * 2}" for i in range(5)])[4]
+    assert feeds.apply_delta(4, keys, [], chunk_size=2, dry_run=True) == 3
@@ -0,0 +1,73 @@
+"""Test di fleet.apply_fleet con LocalTransport (nessun ssh, nessun nft)."""
+
+import pytest
+
+import nft_exec
+from fleet import LocalTransport, Transport, apply_fleet, format_results
+
+SERVICES = [{"name": "ssh", "port": 22, "protocol": "tcp"}]
+HOSTS = [{"name": "canary1", "canary": True}, {"name": "node1"}, {"name": "node2"}]
+
+
+class FailOn(Transport):
+    """Trasporto che fallisce solo sugli host indicati."""
+
+    def __init__(self, failing):
+        self.failing = set(failing)
+        self.applied = []
+
+    def apply(self, host, content, timeout=60):
+        self.applied.append(host["name"])
+        return host["name"] not in self.failing, "errore simulato" if host["name"] in self.failing else ""
+
+
+def test_transport_is_abstract():
+    with pytest.raises(TypeError):
+        Transport()
+
+
+def test_local_transport_applies_every_host():
+    results = apply_fleet(HOSTS, SERVICES, LocalTransport(cmd=["cat"]))
+    assert [r["host"] for r in results] == ["canary1", "node1", "node2"]
+    assert all(r["ok"] for r in results)
+    # `cat` restituisce la transazione ricevuta: flush della table e poi il contenuto
+    assert all("flush table inet filter" in r["output"] for r in results)
+    assert all("tcp_services" in r["output"] for r in results)
+
+
+def test_canary_failure_skips_the_rest():
+    results = apply_fleet(HOSTS, SERVICES, LocalTransport(cmd=["false"]))
+    by_host = {r["host"]: r for r in results}
+    assert not by_host["canary1"]["ok"] and not by_host["canary1"].get("skipped")
+    assert by_host["node1"]["skipped"] and by_host["node2"]["skipped"]
+    assert "0/3" in format_results(results)
+
+
+def test_canary_by_count_and_per_host_results():
+    hosts = [{"name": "a"}, {"name": "b"}, {"name": "c"}]
+    transport = FailOn({"c"})
+    results = apply_fleet(hosts, SERVICES, transport, canary=1, workers=2)
+    assert transport.applied[0] == "a"
+    assert {r["host"]: r["ok"] for r in results} == {"a": True, "b": True, "c": False}
+    assert not any(r.get("skipped") for r in results)
+
+
+def test_host_overrides_change_the_rendered_ruleset():
+    hosts = [{"name": "n", "overrides": {"extra_services": [{"name": "exporter", "port": 9100}]}}]
+    results = apply_fleet(hosts, SERVICES, LocalTransport(cmd=["cat"]))
+    assert "9100" in results[0]["output"]
+
+
+def test_local_transport_default_goes_through_nft_exec(tmp_path, monkeypatch):
+    fake = tmp_path / "nft"
+    fake.write_text('#!/bin/sh\necho "args: $*"\ncat >/dev/null\n')
+    fake.chmod(0o755)
+    monkeypatch.setattr(nft_exec, "NFT", str(fake))
+    ok, output = LocalTransport().apply({"name": "local"}, "table inet filter {}\n")
+    assert ok and output == "args: -c -f -"
+
+
+def test_summary_says_validated_for_the_default_local_transport():
+    results = [{"host": "local", "ok": True, "seconds": 0.1, "output": ""}]
+    assert "1/1 host validati" in format_results(results, outcome=LocalTransport().outcome)
+    assert "1/1 host applicati" in format_results(results, outcome=LocalTransport(cmd=["cat"]).outcome)
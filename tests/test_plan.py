@@ -0,0 +1,78 @@
+"""Test di plan.compute_plan su snapshot JSON (nessun nft)."""
+
+import copy
+import json
+
+from plan import format_plan, plan_services
+from rules_generator import DEFAULT_RULES, build_tables_from_services
+
+SERVICES = [{"name": "ssh", "port": 22, "protocol": "tcp"}, {"name": "dns", "port": 53, "protocol": "udp"}]
+CFG = dict(DEFAULT_RULES, service_counters=True, ingress_devices=["eth0"])
+ADDRESSES = {"allow": ["10.0.0.0/8"], "deny": ["203.0.113.5", "203.0.113.6"]}
+
+
+def _snapshot():
+    """Snapshot equivalente al ruleset desiderato, come `nft -j list ruleset`."""
+    table, ingress = build_tables_from_services(SERVICES, CFG, ADDRESSES, local=False)
+    data = table.to_json()
+    data["nftables"] += ingress.to_json()["nftables"][1:]
+    return data
+
+
+def _plan(data):
+    return plan_services(data, SERVICES, CFG, ADDRESSES, local=False)
+
+
+def _deny_set(data):
+    return next(o["set"] for o in data["nftables"] if "set" in o and o["set"]["name"] == "deny_v4"
+                and o["set"]["table"] == "filter")
+
+
+def test_matching_snapshot_has_no_changes():
+    assert _plan(_snapshot()) == []
+    assert "Nessuna modifica" in format_plan([], color=False)
+
+
+def test_address_range_in_snapshot():
+    data = _snapshot()
+    deny = _deny_set(data)
+    assert {"range": ["203.0.113.5", "203.0.113.6"]} in deny["elem"]
+    deny["elem"].append({"range": ["198.51.100.1", "198.51.100.9"]})
+    changes = _plan(data)
+    assert [(c["action"], c["target"], c["value"]) for c in changes] == \
+        [("-", "deny_v4", "198.51.100.1-198.51.100.9")]
+    assert "- 198.51.100.1-198.51.100.9" in format_plan(changes, color=False)
+
+
+def test_missing_allow_set_and_rule_are_planned():
+    data = _snapshot()
+    data["nftables"] = [o for o in data["nftables"]
+                        if not ("set" in o and o["set"]["name"] == "allow_v4" and o["set"]["table"] == "filter")
+                        and "@allow_v4" not in json.dumps(o.get("rule"))]
+    changes = _plan(data)
+    assert ("+", "set", "allow_v4") in [(c["action"], c["kind"], c["target"]) for c in changes]
+    assert ("+", "rule", "ip saddr @allow_v4 accept") in [(c["action"], c["kind"], c["value"]) for c in changes]
+
+
+def test_counters_ingress_and_extra_objects():
+    data = _snapshot()
+    # counter dei servizi mancante, table di ingress assente, una chain estranea nella table gestita
+    data["nftables"] = [o for o in data["nftables"]
+                        if not ("map" in o and o["map"]["name"] == "service_counters")
+                        and (next(iter(o.values())).get("family") != "netdev")]
+    data["nftables"].append({"chain": {"family": "inet", "table": "filter", "name": "manual"}})
+    kinds = {(c["action"], c["kind"], c["table"], c["target"]) for c in _plan(data)}
+    assert ("+", "set", "inet filter", "service_counters") in kinds
+    assert ("+", "table", "netdev fwai_ingress", "netdev fwai_ingress") in kinds
+    assert ("-", "chain", "inet filter", "manual") in kinds
+
+
+def test_feed_sets_are_left_out():
+    data = _snapshot()
+    data["nftables"].append({"set": {"family": "inet", "table": "filter", "name": "blocklist_v4",
+                                     "type": "ipv4_addr", "flags": ["interval"], "elem": ["192.0.2.1"]}})
+    feed_rule = copy.deepcopy(next(o for o in data["nftables"] if "@allow_v4" in json.dumps(o.get("rule"))))
+    feed_rule["rule"]["expr"] = [{"match": {"op": "==", "left": {"payload": {"protocol": "ip", "field": "saddr"}},
+                                            "right": "@blocklist_v4"}}, {"drop": None}]
+    data["nftables"].append(feed_rule)
+    assert _plan(data) == []
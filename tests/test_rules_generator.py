@@ -0,0 +1,39 @@
+"""Test del rendering di rules_generator."""
+
+from rules_generator import build_ruleset, order_rules, with_counter
+from ruleset import Rule, expr_to_text
+
+VMAP_RULE = "meta l4proto . th dport vmap @service_verdicts"
+
+
+def test_with_counter_puts_counter_before_vmap_key():
+    assert with_counter(VMAP_RULE) == "counter " + VMAP_RULE
+    assert with_counter("tcp dport @tcp_services accept") == "tcp dport @tcp_services counter accept"
+    assert with_counter("counter " + VMAP_RULE) == "counter " + VMAP_RULE
+
+
+def test_rule_counters_in_vmap_mode_render_valid_syntax():
+    table = build_ruleset("192.168.1.0/24", [22], [53], set_mode="vmap",
+                          actions={("tcp", 22): "accept", ("udp", 53): "drop"}, counters=True)
+    text = table.to_text()
+    assert "counter " + VMAP_RULE in text
+    assert "dport counter vmap" not in text
+    rule = next(r for r in table.chains["input"].rules if "vmap" in r.text)
+    assert rule.expr[0] == {"counter": None}
+    assert expr_to_text(rule.expr) == VMAP_RULE
+    assert Rule.parse(rule.text).expr == rule.expr
+
+
+def test_order_rules_only_permutes_consecutive_accepts():
+    rules = [("ct", "ct state established,related accept"),
+             ("ssh", "tcp dport 22 accept"),
+             ("deny_v4", "ip saddr @deny_v4 drop"),
+             ("tcp_services", "tcp dport @tcp_services accept"),
+             ("udp_services", "udp dport @udp_services accept"),
+             ("service_verdicts", VMAP_RULE),
+             ("icmp", "icmp type echo-request accept")]
+    order = ["icmp", "udp_services", "ssh", "tcp_services"]
+    assert [k for k, _ in order_rules(rules, order)] == \
+        ["ssh", "ct", "deny_v4", "udp_services", "tcp_services", "service_verdicts", "icmp"]
+    # chiavi senza statistiche: ordine originale, dopo quelle note
+    assert order_rules(rules, []) == rules
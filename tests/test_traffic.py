@@ -0,0 +1,44 @@
+"""Test del ring buffer delle serie di traffico."""
+
+from traffic import Ring, collect_once, query, top_services
+
+
+def test_ring_deltas_reset_and_wraparound(tmp_path):
+    ring = Ring(tmp_path / "svc_ssh.ring", slots=3)
+    assert not ring.observe(100, 10, 1000)          # prima lettura: solo base
+    assert ring.observe(160, 15, 1600)
+    assert ring.observe(220, 3, 300)                # counter azzerato (ruleset ricaricato)
+    assert not ring.observe(220, 4, 400)            # durata nulla: nessun campione
+    assert ring.observe(300, 6, 500)
+    assert ring.observe(360, 7, 700)                # quarto campione: sovrascrive il primo
+    assert list(ring.samples()) == [(220, 60, 3, 300), (300, 80, 2, 100), (360, 60, 1, 200)]
+    assert list(ring.samples(since=300)) == [(360, 60, 1, 200)]
+
+
+def test_ring_persists_with_fixed_size(tmp_path):
+    path = tmp_path / "svc_ssh.ring"
+    ring = Ring(path, slots=4)
+    ring.observe(100, 0, 0)
+    ring.observe(200, 10, 1000)
+    ring.save()
+    size = path.stat().st_size
+    loaded = Ring.load(path, slots=4)
+    assert list(loaded.samples()) == [(200, 100, 10, 1000)]
+    for t in range(300, 1300, 100):
+        loaded.observe(t, t, t * 10)
+    loaded.save()
+    assert path.stat().st_size == size
+    path.write_bytes(b"garbage")
+    assert list(Ring.load(path).samples()) == []
+
+
+def test_collect_and_top_services(tmp_path):
+    base = str(tmp_path)
+    collect_once(base, {"svc_ssh": {"packets": 0, "bytes": 0}, "svc_dns": {"packets": 0, "bytes": 0}}, now=100)
+    written = collect_once(base, {"svc_ssh": {"packets": 10, "bytes": 8000},
+                                  "svc_dns": {"packets": 100, "bytes": 4000}}, now=200)
+    assert written == 2
+    ssh = query(base, "svc_ssh")
+    assert (ssh["service"], ssh["packets"], ssh["bytes"], ssh["bps"]) == ("ssh", 10, 8000, 640.0)
+    assert [r["service"] for r in top_services(base, n=5)] == ["ssh", "dns"]
+    assert top_services(base, since=200) == []
@@ -0,0 +1,50 @@
+"""Test dell'isteresi di utils/update_services.py (observe + compute_changes)."""
+
+import pytest
+
+pytest.importorskip("psutil")
+
+from utils.update_services import compute_changes, observe
+
+SSH = {"name": "ssh", "port": 22, "protocol": "tcp"}
+
+
+def _step(services, state, active, now, declared=frozenset()):
+    allowed = {f"{s['protocol']}/{s['port']}" for s in services}
+    state = observe(state, active, allowed, now, remove_grace=900)
+    return state, compute_changes(services, state, active, now, add_grace=60, remove_grace=900, declared=declared)
+
+
+def test_new_port_is_added_only_after_add_grace():
+    active = {(22, "tcp"): "sshd", (8080, "tcp"): "python3"}
+    state, changes = _step([SSH], {}, active, now=1000)
+    assert changes == []
+    state, changes = _step([SSH], state, active, now=1059)
+    assert changes == []
+    state, changes = _step([SSH], state, active, now=1060)
+    assert changes == [("+", {"name": "python3", "port": 8080, "protocol": "tcp"})]
+
+
+def test_short_outage_does_not_remove_and_restarts_add_timer():
+    state, _ = _step([SSH], {}, {(22, "tcp"): "sshd"}, now=0)
+    # ssh sparisce per meno della grace: nessuna rimozione
+    state, changes = _step([SSH], state, {}, now=800)
+    assert changes == []
+    state, changes = _step([SSH], state, {(22, "tcp"): "sshd"}, now=850)
+    assert changes == []
+    state, changes = _step([SSH], state, {}, now=1749)
+    assert changes == []
+    state, changes = _step([SSH], state, {}, now=1750)
+    assert changes == [("-", SSH)]
+
+
+def test_temporary_and_declared_entries_are_left_alone():
+    grant = {"name": "support", "port": 2222, "protocol": "tcp", "ttl": 3600}
+    active = {(9000, "tcp"): "?"}
+    state, _ = _step([grant], {}, active, now=0, declared={"tcp/9000"})
+    # la concessione non è in ascolto da molto più della grace ma ha un ttl: resta
+    state, changes = _step([grant], state, active, now=600, declared={"tcp/9000"})
+    state, changes = _step([grant], state, active, now=1200, declared={"tcp/9000"})
+    assert changes == []
+    state, changes = _step([grant], state, active, now=1200)
+    assert changes == [("+", {"name": "svc_9000", "port": 9000, "protocol": "tcp"})]
@@ -0,0 +1,226 @@
+"""
+traffic.py
+
+Contatori di traffico per servizio e archivio compatto delle serie temporali.
+
+Con `rules: service_counters: true` il ruleset generato contiene un counter nominato
+per servizio (svc_<nome>, vedi rules_generator.service_counter_name) alimentato da
+una sola regola di lookup sulla map @service_counters. I servizi con `limit` hanno in più
+un counter lim_<nome> che conta le nuove connessioni scartate dal limite per sorgente:
+viene raccolto allo stesso modo e riassunto nel digest (top_services(prefix=LIMIT_PREFIX)).
+
+- collect_once(): legge TUTTI i counter con una sola chiamata `nft -j list counters`
+  e salva il delta rispetto alla lettura precedente;
+- ogni servizio ha un ring buffer di dimensione fissa in data/traffic/<counter>.ring:
+  header + array('Q') di slot (fine intervallo, durata, pacchetti, byte). Scrivere un
+  campione non fa crescere il file: lo slot più vecchio viene sovrascritto;
+- query() / top_services(): totali e rate in una finestra, usati anche dal digest
+  giornaliero (nessuna chiamata a nft, solo lettura dei file).
+"""
+
+import json
+import struct
+import subprocess
+import sys
+import time
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import nft_exec
+
+TRAFFIC_DIR = "data/traffic"
+COUNTER_PREFIX = "svc_"
+LIMIT_PREFIX = "lim_"
+DEFAULT_SLOTS = 2016        # una settimana con una lettura ogni 5 minuti
+
+# magic, slot, prossimo slot, slot scritti, ts ultima lettura, pacchetti e byte dell'ultima lettura
+_HEADER = struct.Struct("<4sIIIdQQ")
+_MAGIC = b"FWTS"
+_FIELDS = 4                 # fine intervallo, durata, pacchetti, byte
+
+
+class Ring:
+    """Ring buffer di campioni (delta) di un counter, persistito su file."""
+
+    __slots__ = ("path", "slots", "head", "filled", "last_ts", "last_packets", "last_bytes", "data")
+
+    def __init__(self, path: Path, slots: int = DEFAULT_SLOTS):
+        self.path = path
+        self.slots = slots
+        self.head = self.filled = 0
+        self.last_ts = 0.0
+        self.last_packets = self.last_bytes = 0
+        self.data = array("Q", bytes(8 * _FIELDS * slots))
+
+    @classmethod
+    def load(cls, path: Path, slots: int = DEFAULT_SLOTS) -> "Ring":
+        ring = cls(path, slots)
+        try:
+            raw = path.read_bytes()
+            magic, n, head, filled, last_ts, last_packets, last_bytes = _HEADER.unpack_from(raw)
+            if magic != _MAGIC:
+                raise ValueError("magic non valido")
+            data = array("Q")
+            data.frombytes(raw[_HEADER.size:_HEADER.size + 8 * _FIELDS * n])
+            if len(data) != _FIELDS * n:
+                raise ValueError("file troncato")
+        except FileNotFoundError:
+            return ring
+        except Exception as e:
+            print(f"WARN: serie {path} illeggibile, riparto da zero: {e}", file=sys.stderr)
+            return ring
+        ring.slots, ring.head, ring.filled, ring.data = n, head, filled, data
+        ring.last_ts, ring.last_packets, ring.last_bytes = last_ts, last_packets, last_bytes
+        return ring
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_bytes(_HEADER.pack(_MAGIC, self.slots, self.head, self.filled, self.last_ts,
+                                     self.last_packets, self.last_bytes) + self.data.tobytes())
+        tmp.replace(self.path)
+
+    def observe(self, now: float, packets: int, nbytes: int) -> bool:
+        """
+        Registra una lettura assoluta del counter e salva il delta dalla precedente.
+        La prima lettura fa solo da base. Ritorna True se è stato scritto un campione.
+        """
+        first = self.last_ts == 0
+        # counter più basso della lettura precedente: ruleset ricaricato, si riparte da zero
+        reset = packets < self.last_packets or nbytes < self.last_bytes
+        d_packets = packets if reset else packets - self.last_packets
+        d_bytes = nbytes if reset else nbytes - self.last_bytes
+        duration = now - self.last_ts
+        self.last_ts, self.last_packets, self.last_bytes = now, packets, nbytes
+        if first or duration <= 0:
+            return False
+        i = self.head * _FIELDS
+        self.data[i:i + _FIELDS] = array("Q", (int(now), int(round(duration)), d_packets, d_bytes))
+        self.head = (self.head + 1) % self.slots
+        self.filled = min(self.filled + 1, self.slots)
+        return True
+
+    def samples(self, since: Optional[float] = None):
+        """Campioni (fine, durata, pacchetti, byte) dal più vecchio al più recente."""
+        start = (self.head - self.filled) % self.slots
+        for k in range(self.filled):
+            i = ((start + k) % self.slots) * _FIELDS
+            end, duration, packets, nbytes = self.data[i:i + _FIELDS]
+            if since is None or end > since:
+                yield end, duration, packets, nbytes
+
+
+def _ring_path(base: Path, name: str) -> Path:
+    return base / TRAFFIC_DIR / f"{name}.ring"
+
+
+def read_counters(family: str = "inet", table: str = "filter") -> Dict[str, Dict[str, int]]:
+    """{nome: {"packets", "bytes"}} per i counter dei servizi e dei limiti, con una sola chiamata a nft."""
+    try:
+        out = nft_exec.run(["-j", "list", "counters"])
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"nft -j list counters fallito: {(e.stderr or '').strip()}")
+    counters = {}
+    for obj in json.loads(out.stdout or '{"nftables": []}').get("nftables", []):
+        c = obj.get("counter")
+        if not isinstance(c, dict) or c.get("family") != family or c.get("table") != table:
+            continue
+        if str(c.get("name", "")).startswith((COUNTER_PREFIX, LIMIT_PREFIX)):
+            counters[c["name"]] = {"packets": int(c.get("packets", 0)), "bytes": int(c.get("bytes", 0))}
+    return counters
+
+
+def collect_once(base_dir: str, counters: Optional[Dict] = None, now: Optional[float] = None,
+                 slots: int = DEFAULT_SLOTS) -> int:
+    """Una lettura di tutti i counter; ritorna il numero di campioni scritti."""
+    base = Path(base_dir).expanduser().resolve()
+    counters = read_counters() if counters is None else counters
+    now = time.time() if now is None else now
+    written = 0
+    for name, value in counters.items():
+        ring = Ring.load(_ring_path(base, name), slots)
+        if ring.observe(now, value["packets"], value["bytes"]):
+            written += 1
+        ring.save()
+    return written
+
+
+def query(base_dir: str, name: str, since: Optional[float] = None) -> Dict:
+    """Totali e rate medi (pacchetti/s, bit/s) del counter `name` dopo `since` (epoch)."""
+    ring = Ring.load(_ring_path(Path(base_dir).expanduser().resolve(), name))
+    packets = nbytes = seconds = samples = 0
+    for _, duration, p, b in ring.samples(since):
+        packets += p
+        nbytes += b
+        seconds += duration
+        samples += 1
+    return {
+        "name": name,
+        "service": name.split("_", 1)[-1],
+        "packets": packets,
+        "bytes": nbytes,
+        "seconds": seconds,
+        "samples": samples,
+        "pps": packets / seconds if seconds else 0.0,
+        "bps": 8 * nbytes / seconds if seconds else 0.0,
+    }
+
+
+def top_services(base_dir: str, n: int = 5, since: Optional[float] = None,
+                 prefix: str = COUNTER_PREFIX) -> List[Dict]:
+    """
+    I primi n servizi per byte ricevuti nella finestra (solo lettura dei ring buffer);
+    con prefix=LIMIT_PREFIX i servizi con più connessioni scartate dal limite.
+    """
+    folder = Path(base_dir).expanduser().resolve() / TRAFFIC_DIR
+    if not folder.is_dir():
+        return []
+    rows = [query(base_dir, p.stem, since) for p in folder.glob(f"{prefix}*.ring")]
+    rows = [r for r in rows if r["samples"]]
+    rows.sort(key=lambda r: (-r["bytes"], -r["packets"], r["name"]))
+    return rows[:n]
+
+
+def period_since(period: str = "day", now: Optional[float] = None) -> Optional[float]:
+    """Inizio della finestra per i periodi del digest: day (da mezzanotte), 24h, all."""
+    now = time.time() if now is None else now
+    if period == "day":
+        t = time.localtime(now)
+        return time.mktime((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0, 0, 0, -1))
+    if period == "24h":
+        return now - 86400
+    return None
+
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if n < 1024 or unit == "TiB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+
+def format_top(rows: List[Dict]) -> str:
+    if not rows:
+        return "Nessun dato di traffico (abilita rules: service_counters ed esegui collect)\n"
+    width = max(len(r["service"]) for r in rows)
+    lines = [f"{r['service']:<{width}}  {format_bytes(r['bytes']):>10}  {r['packets']:>12} pkt  "
+             f"{r['pps']:9.1f} pkt/s  {r['bps'] / 1e6:8.3f} Mbit/s" for r in rows]
+    return "\n".join(lines) + "\n"
+
+
+def run_collect(base_dir: str, interval: float = 0) -> int:
+    """
+    Entrypoint CLI: con interval=0 una sola lettura (adatto a un timer systemd),
+    altrimenti una lettura ogni `interval` secondi fino all'interruzione.
+    """
+    while True:
+        try:
+            written = collect_once(base_dir)
+        except Exception as e:
+            print(f"ERR: lettura counter fallita: {e}", file=sys.stderr)
+            return 1
+        print(f"Traffico: {written} campioni salvati")
+        if not interval:
+            return 0
+        time.sleep(interval)
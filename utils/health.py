@@ -1,6 +1,7 @@
-import subprocess
 import socket
 
+import nft_exec
+
 def check_adguard(port=3000):
     try:
         sock = socket.create_connection(("127.0.0.1", port), timeout=2)
@@ -10,8 +11,10 @@ def check_adguard(port=3000):
         return False
 
 def check_nftables_rule(port, protocol):
-    cmd = f"nft list ruleset"
-    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    try:
+        result = nft_exec.run(["list", "ruleset"], check=False)
+    except Exception:
+        return False
     return f"{protocol} dport {port}" in result.stdout
 
 def check_dns(domain="example.com"):
@@ -1,12 +1,10 @@
-import subprocess
+import nft_exec
 
 def apply_rule(port, protocol, action="accept"):
-    cmd = f"nft add rule inet filter input {protocol} dport {port} {action}"
-    subprocess.run(cmd, shell=True)
+    nft_exec.run(["add", "rule", "inet", "filter", "input", protocol, "dport", str(port), action], retries=0, check=False)
 
 def drop_rule(port, protocol):
-    cmd = f"nft add rule inet filter input {protocol} dport {port} drop"
-    subprocess.run(cmd, shell=True)
+    nft_exec.run(["add", "rule", "inet", "filter", "input", protocol, "dport", str(port), "drop"], retries=0, check=False)
 
 def flush_rules():
-    subprocess.run("nft flush ruleset", shell=True)
+    nft_exec.run(["flush", "ruleset"], check=False)
@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
-import os, sys, yaml, psutil
+import json, os, sys, time, yaml, psutil
 
 CONFIG_PATH = "config/services.yaml"
+SERVICES_DIR = "config/services.d"
+STATE_PATH = "data/sync_state.json"
+ADD_GRACE = 60        # secondi di ascolto continuo prima di aggiungere una porta
+REMOVE_GRACE = 900    # secondi di assenza prima di rimuoverla (copre i riavvii dei container)
 
 """
 update_services.py – Gestione interattiva di config/services.yaml
@@ -20,10 +24,16 @@ UTILIZZO:
       Rimuove un servizio da services.yaml.
       Esempio: python utils/update_services.py --remove 53 udp
 
-  python utils/update_services.py --sync
-      Sincronizza automaticamente services.yaml:
-        - aggiunge i servizi attivi mancanti
-        - rimuove quelli non più in ascolto
+  python utils/update_services.py --sync [--add-grace S] [--remove-grace S] [--dry-run]
+      Sincronizza automaticamente services.yaml con isteresi:
+        - aggiunge i servizi in ascolto da almeno ADD_GRACE secondi
+        - rimuove quelli non più in ascolto da almeno REMOVE_GRACE secondi
+        - lo storico delle osservazioni è in data/sync_state.json: va eseguito
+          periodicamente (es. timer systemd), ogni esecuzione è un'osservazione
+        - se non cambia nulla il file non viene riscritto
+        - le voci con ttl/expires (accessi temporanei) non vengono mai rimosse
+        - le porte già dichiarate in config/services.d/*.yaml (es. docker.yaml, api.yaml,
+          gestiti da docker_discovery.py e control_plane.py) non vengono mai aggiunte
 
   python utils/update_services.py
       Avvia la modalità interattiva:
@@ -47,16 +57,60 @@ RED = "\033[91m"
 YELLOW = "\033[93m"
 RESET = "\033[0m"
 
-def load_services():
+def load_config():
     if not os.path.exists(CONFIG_PATH):
-        return []
+        return {}
     with open(CONFIG_PATH) as f:
-        data = yaml.safe_load(f) or {}
-    return data.get("allowed_services", [])
+        return yaml.safe_load(f) or {}
+
+def load_services():
+    return load_config().get("allowed_services", [])
+
+def load_shard_keys():
+    """Chiavi proto/port dei servizi dichiarati in config/services.d/*.yaml (file illeggibili saltati)."""
+    keys = set()
+    if not os.path.isdir(SERVICES_DIR):
+        return keys
+    for fname in sorted(os.listdir(SERVICES_DIR)):
+        if not fname.endswith((".yaml", ".yml")):
+            continue
+        try:
+            with open(os.path.join(SERVICES_DIR, fname)) as f:
+                raw = yaml.safe_load(f)
+            items = raw.get("allowed_services") if isinstance(raw, dict) else raw
+            for item in items or []:
+                keys.add(_key(int(item["port"]), (item.get("protocol") or "tcp").lower()))
+        except Exception as e:
+            print(f"WARN: {fname} ignorato nel sync: {e}", file=sys.stderr)
+    return keys
+
+def _write_atomic(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
 
 def save_services(services):
-    with open(CONFIG_PATH, "w") as f:
-        yaml.safe_dump({"allowed_services": services}, f, sort_keys=False)
+    # le altre sezioni (rules, allow_addresses, blocklist_feeds, ...) restano invariate
+    data = load_config()
+    data["allowed_services"] = services
+    _write_atomic(CONFIG_PATH, yaml.safe_dump(data, sort_keys=False))
+
+def _key(port, proto):
+    return f"{proto}/{port}"
+
+def load_state():
+    try:
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_state(state):
+    _write_atomic(STATE_PATH, json.dumps(state, indent=2, sort_keys=True))
 
 def list_active_ports():
     conns = psutil.net_connections(kind="inet")
@@ -105,11 +159,14 @@ def interactive():
                     name = input("  Nome servizio: ").strip() or proc
                     services.append({"name": name, "port": port, "protocol": proto})
     elif choice == "r":
-        for s in services[:]:
+        keep = []
+        for s in services:
             if (s["port"], s["protocol"]) not in active:
                 ans = input(f"Rimuovere {s['port']}/{s['protocol']} ({s['name']})? [y/N] ").strip().lower()
                 if ans == "y":
-                    services.remove(s)
+                    continue
+            keep.append(s)
+        services = keep
     else:
         print("❌ Nessuna modifica.")
         return
@@ -117,25 +174,81 @@ def interactive():
     save_services(services)
     print("✅ services.yaml aggiornato.")
 
-def sync_services():
+def observe(state, active, allowed, now, remove_grace=REMOVE_GRACE):
+    """
+    Aggiorna lo storico per porta: {"proto/port": {"since": inizio dell'ascolto continuo,
+    "last_seen": ultima osservazione in ascolto, "proc": processo}}.
+    Una porta rivista dopo più di remove_grace secondi riparte con un nuovo "since".
+    """
+    for (port, proto), proc in active.items():
+        h = state.get(_key(port, proto))
+        if h is None or now - h["last_seen"] > remove_grace:
+            h = state[_key(port, proto)] = {"since": now, "proc": proc}
+        h["last_seen"] = now
+        if proc and proc != "?":
+            h["proc"] = proc
+    # i servizi configurati mai osservati partono da adesso: la rimozione attende la grace
+    for key in allowed:
+        state.setdefault(key, {"since": now, "last_seen": now, "proc": "?"})
+    # dimentica le porte non configurate e assenti da più della grace
+    for key in [k for k, h in state.items() if k not in allowed and now - h["last_seen"] > remove_grace]:
+        del state[key]
+    return state
+
+def compute_changes(services, state, active, now, add_grace=ADD_GRACE, remove_grace=REMOVE_GRACE,
+                    declared=frozenset()):
+    """
+    Changeset minimo ([(+|-, servizio)]) confrontando per chiave proto/port
+    le voci di services.yaml con le porte in ascolto e il loro storico.
+    declared: chiavi già dichiarate altrove (services.d), mai aggiunte a services.yaml.
+    """
+    allowed = {_key(s["port"], s["protocol"]): s for s in services}
+    active_keys = {_key(port, proto): (port, proto, proc) for (port, proto), proc in active.items()}
+    changes = []
+    for key, (port, proto, proc) in active_keys.items():
+        if key not in allowed and key not in declared and now - state[key]["since"] >= add_grace:
+            name = proc if proc and proc != "?" else f"svc_{port}"
+            changes.append(("+", {"name": name, "port": port, "protocol": proto}))
+    for key, s in allowed.items():
+        if key in active_keys or s.get("ttl") is not None or s.get("expires") is not None:
+            continue
+        if now - state[key]["last_seen"] >= remove_grace:
+            changes.append(("-", s))
+    return changes
+
+def sync_services(add_grace=ADD_GRACE, remove_grace=REMOVE_GRACE, dry_run=False):
+    now = time.time()
     services = load_services()
-    allowed = {(s["port"], s["protocol"]) for s in services}
     active = list_active_ports()
+    state = observe(load_state(), active, {_key(s["port"], s["protocol"]) for s in services}, now, remove_grace)
+    declared = load_shard_keys()
+    changes = compute_changes(services, state, active, now, add_grace, remove_grace, declared)
 
-    # Aggiungi mancanti
-    for (port, proto), proc in active.items():
-        if (port, proto) not in allowed:
-            services.append({"name": proc or f"svc_{port}", "port": port, "protocol": proto})
-            print(f"➕ Aggiunto {port}/{proto} ({proc})")
-
-    # Rimuovi non più attivi
-    for s in services[:]:
-        if (s["port"], s["protocol"]) not in active:
-            services.remove(s)
-            print(f"➖ Rimosso {s['port']}/{s['protocol']} ({s['name']})")
+    for action, s in changes:
+        icon = "➕ Aggiunto" if action == "+" else "➖ Rimosso"
+        print(f"{icon} {s['port']}/{s['protocol']} ({s['name']})")
+    allowed = {_key(s["port"], s["protocol"]) for s in services} | declared
+    pending = len([1 for port, proto in active if _key(port, proto) not in allowed
+                   and now - state[_key(port, proto)]["since"] < add_grace])
+    if dry_run:
+        print(f"🔎 {len(changes)} modifiche (dry-run), {pending} porte in osservazione.")
+        return changes
 
+    save_state(state)
+    if not changes:
+        print(f"✅ services.yaml già allineato ({pending} porte in osservazione).")
+        return changes
+    removed = {_key(s["port"], s["protocol"]) for action, s in changes if action == "-"}
+    services = [s for s in services if _key(s["port"], s["protocol"]) not in removed]
+    services += [s for action, s in changes if action == "+"]
     save_services(services)
     print("✅ services.yaml sincronizzato.")
+    return changes
+
+def _arg(name, default):
+    if name in sys.argv:
+        return int(sys.argv[sys.argv.index(name) + 1])
+    return default
 
 
 if __name__ == "__main__":
@@ -155,6 +268,7 @@ if __name__ == "__main__":
         save_services(services)
         print(f"✅ Rimosso servizio {port}/{proto}")
     elif "--sync" in sys.argv:
-        sync_services()
+        sync_services(add_grace=_arg("--add-grace", ADD_GRACE), remove_grace=_arg("--remove-grace", REMOVE_GRACE),
+                      dry_run="--dry-run" in sys.argv)
     else:
         interactive()
@@ -1,12 +1,157 @@
 """
-Watchdog minimale: esegue flush_queue e può essere esteso per controllare rete/docker.
-Pensato per essere chiamato da systemd timer ogni N minuti.
+Watchdog: riallinea il ruleset quando la table gestita viene modificata da fuori.
+
+Ciclo continuo (pensato per una unit systemd Type=simple):
+1. a ogni tick calcola il fingerprint della table inet filter (nft_utils.table_fingerprint:
+   struttura + elementi dei set gestiti, senza contatori/handle/scadenze residue);
+2. lo confronta con quello registrato dall'ultimo apply (data/fingerprint, scritto da cli.py);
+3. solo se differiscono (regole modificate, `flush ruleset` di un altro strumento, elementi
+   rimossi a mano, ...) esegue un reconcile completo: `firewall_ai.py --atomic`.
+Il tick costa una manciata di `nft -j list`; il reconcile avviene solo in caso di drift.
+I set dei feed (@blocklist_v4/@blocklist_v6) sono esclusi dal fingerprint: li gestisce feeds.py.
 """
-from telegram_utils import flush_queue
+import argparse
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import nft_exec
+from config import DEFAULT_BASE_DIR
+from feeds import FEED_SETS
+from nft_utils import table_fingerprint
+
+try:
+    import telegram_utils
+except Exception:
+    telegram_utils = None
+
+FINGERPRINT_FILE = "data/fingerprint"
+DEFAULT_TICK = 5             # secondi tra due controlli
+MIN_RECONCILE_GAP = 30       # se un altro strumento continua a modificare la table non si entra in loop
+MAX_RECONCILE_GAP = 600      # tetto del backoff dopo reconcile falliti consecutivi
+METRICS_EVERY = 60           # tick tra due salvataggi delle metriche nft (data/nft_metrics.json)
+QUEUED_MARK = "trigger accodato"   # stampato da firewall_ai.run_coalesced quando il lock è occupato
+
+_SKIP_SETS = tuple(name for name, _, _ in FEED_SETS.values())
+
+
+def current_fingerprint():
+    return table_fingerprint(skip_sets=_SKIP_SETS)
+
+
+def load_fingerprint(base: Path):
+    try:
+        return (base / FINGERPRINT_FILE).read_text(encoding="utf-8").strip() or None
+    except OSError:
+        return None
+
+
+def record_fingerprint(base_dir: str):
+    """Registra il fingerprint dello stato appena applicato (chiamata da cli.py dopo apply)."""
+    path = Path(base_dir).expanduser().resolve() / FINGERPRINT_FILE
+    fp = current_fingerprint()
+    if fp is None:
+        return None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(fp + "\n", encoding="utf-8")
+    tmp.replace(path)
+    return fp
+
+
+def _notify(message: str) -> None:
+    if telegram_utils is not None and hasattr(telegram_utils, "log_and_notify"):
+        try:
+            telegram_utils.log_and_notify(message, level="WARNING")
+        except Exception:
+            pass
+
+
+def _flush_notifications() -> None:
+    # flush_queue non esiste in tutte le versioni di telegram_utils
+    flush = getattr(telegram_utils, "flush_queue", None) or getattr(telegram_utils, "flush", None)
+    if flush is not None:
+        try:
+            flush()
+        except Exception:
+            pass
+
+
+def reconcile_status(base: Path, timeout: float = 120) -> str:
+    """
+    Reconcile completo tramite l'entrypoint (stesso lock e coalescing dei trigger).
+    Ritorna "applied", "failed" oppure "queued": un altro run tiene il lock, il figlio ha solo
+    segnato il flag dirty e il giro aggiuntivo lo eseguirà quel run.
+    """
+    entry = Path(__file__).resolve().parent / "firewall_ai.py"
+    try:
+        p = subprocess.run([sys.executable, str(entry), "--atomic", "--base-dir", str(base)],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        print(f"ERR: reconcile oltre {timeout}s", file=sys.stderr)
+        return "failed"
+    if p.returncode != 0:
+        print(f"ERR: reconcile fallito (exit {p.returncode}): {(p.stderr or '').strip()}", file=sys.stderr)
+        return "failed"
+    return "queued" if QUEUED_MARK in (p.stdout or "") else "applied"
+
+
+def reconcile(base: Path, timeout: float = 120) -> bool:
+    """
+    Come reconcile_status; un run accodato conta come successo: quello in corso eseguirà
+    un giro aggiuntivo e registrerà il fingerprint.
+    """
+    return reconcile_status(base, timeout) != "failed"
+
+
+def check_once(base: Path, last_reconcile: float = 0.0, failures: int = 0):
+    """
+    Un tick. Ritorna (drift rilevato, istante dell'ultimo reconcile, reconcile falliti consecutivi).
+    Un fingerprint mai registrato (primo avvio) conta come drift.
+    Dopo un reconcile fallito l'intervallo minimo raddoppia (fino a MAX_RECONCILE_GAP) e la
+    notifica parte una sola volta per serie di fallimenti; il ripristino successivo viene notificato.
+    """
+    fp = current_fingerprint()
+    if fp is not None and fp == load_fingerprint(base):
+        return False, last_reconcile, failures
+    now = time.monotonic()
+    if now - last_reconcile < min(MAX_RECONCILE_GAP, MIN_RECONCILE_GAP * 2 ** failures):
+        return True, last_reconcile, failures
+    what = "table inet filter assente" if fp is None else "table inet filter modificata"
+    print(f"WARN: drift del ruleset ({what}), reconcile", file=sys.stderr)
+    if reconcile(base):
+        _notify(f"Watchdog: {what} fuori da firewall_ai, ruleset ripristinato")
+        return True, now, 0
+    if failures == 0:
+        _notify(f"Watchdog: {what} fuori da firewall_ai, reconcile FALLITO: ruleset non ripristinato")
+    return True, now, failures + 1
+
+
+def run_watchdog(base_dir: str = DEFAULT_BASE_DIR, tick: float = DEFAULT_TICK, once: bool = False) -> int:
+    base = Path(base_dir).expanduser().resolve()
+    last_reconcile = -MAX_RECONCILE_GAP
+    failures = 0
+    ticks = 0
+    while True:
+        try:
+            _, last_reconcile, failures = check_once(base, last_reconcile, failures)
+        except Exception as e:
+            # compresi timeout e circuito aperto di nft_exec: si riprova al tick successivo
+            print(f"ERR: controllo watchdog fallito: {e}", file=sys.stderr)
+        _flush_notifications()
+        ticks += 1
+        if once or ticks % METRICS_EVERY == 0:
+            nft_exec.save_metrics(str(base))
+        if once:
+            return 0
+        time.sleep(tick)
 
-def run_watchdog():
-    # qui puoi aggiungere controlli di rete, DNS, stato container e ripristino rules
-    flush_queue()
 
 if __name__ == "__main__":
-    run_watchdog()
+    parser = argparse.ArgumentParser(prog="watchdog")
+    parser.add_argument("--base-dir", default=DEFAULT_BASE_DIR, help="Base dir del progetto")
+    parser.add_argument("--tick", type=float, default=DEFAULT_TICK, help="Secondi tra due controlli")
+    parser.add_argument("--once", action="store_true", help="Un solo controllo (es. da timer systemd)")
+    args = parser.parse_args()
+    sys.exit(run_watchdog(args.base_dir, tick=args.tick, once=args.once))